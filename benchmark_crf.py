@@ -0,0 +1,100 @@
+"""
+Timing of the CRF post-processing: pydensecrf, per image and per step as test.py does it,
+against the batched torch CRF of `ptsemseg/inference/crf.py` on all the steps at once.
+
+Synthetic inputs: a random smooth image and noisy per-step probability maps. The agreement
+is the fraction of pixels where both argmax masks are equal (the torch CRF restricts the
+kernels to a local window, the masks are close but not identical).
+
+python benchmark_crf.py --size=584 --batch=4 --steps=6 --device=cuda
+"""
+import time
+import argparse
+import logging
+
+import torch
+import numpy as np
+import torch.nn.functional as F
+
+from ptsemseg.inference.crf import crf_refine
+
+try:
+    import pydensecrf.densecrf as dcrf
+except ImportError:
+    dcrf = None
+
+logger = logging.getLogger('ptsemseg')
+
+
+def synthetic_inputs(batch, steps, size, n_classes=2, seed=0):
+    """[batch, 3, H, W] images in 0-255 and [steps * batch, C, H, W] probabilities, step after step."""
+    torch.manual_seed(seed)
+    images = F.interpolate(torch.rand(batch, 3, size // 16, size // 16), size=(size, size),
+                           mode='bilinear', align_corners=False) * 255.
+    truth = (images.mean(1, keepdim=True) > 127.).float()
+    logits = torch.cat([truth * 2. - 1.] * steps) * 2. + torch.randn(steps * batch, 1, size, size) * 1.5
+    logits = torch.cat([-logits] + [logits] * (n_classes - 1), 1)
+    return images, torch.softmax(logits, 1)
+
+
+def densecrf(probs, images, iterations=50):
+    """The pydensecrf path of test.py, one map after the other, argmax masks [N, H, W]."""
+    batch = images.shape[0]
+    masks = []
+    for n in range(probs.shape[0]):
+        prob = probs[n].numpy()
+        c, h, w = prob.shape
+        unary = np.ascontiguousarray(-np.log(np.clip(prob, 1e-8, 1.)).reshape(c, -1), dtype=np.float32)
+        img = np.ascontiguousarray(images[n % batch].numpy().transpose(1, 2, 0).astype(np.uint8))
+        d = dcrf.DenseCRF2D(w, h, c)
+        d.setUnaryEnergy(unary)
+        d.addPairwiseBilateral(sxy=5, srgb=3, rgbim=img, compat=1)
+        q = d.inference(iterations)
+        masks.append(np.argmax(np.array(q), axis=0).reshape(h, w))
+    return np.stack(masks)
+
+
+def timed(fn, repeats, device):
+    result = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        result = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return result, (time.time() - start) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark_crf")
+    parser.add_argument("--size", nargs="?", type=int, default=512, help="side of the square images")
+    parser.add_argument("--batch", nargs="?", type=int, default=4, help="images per batch")
+    parser.add_argument("--steps", nargs="?", type=int, default=6, help="recurrent steps per image")
+    parser.add_argument("--iterations", nargs="?", type=int, default=10, help="mean-field iterations of the torch CRF")
+    parser.add_argument("--radius", nargs="?", type=int, default=4, help="half size of the torch CRF window")
+    parser.add_argument("--repeats", nargs="?", type=int, default=3, help="timed runs, after one warm-up")
+    parser.add_argument("--device", nargs="?", type=str, default="cpu", help="device of the torch CRF")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    device = torch.device(args.device)
+    images, probs = synthetic_inputs(args.batch, args.steps, args.size)
+    n_maps = probs.shape[0]
+
+    with torch.no_grad():
+        refined, seconds = timed(lambda: crf_refine(probs.to(device), images.to(device),
+                                                    args.iterations, args.radius), args.repeats, device)
+    torch_masks = refined.argmax(1).cpu().numpy()
+    logger.info("torch CRF ({}): {} maps in {:.3f} s, {:.1f} ms per map".format(
+        device, n_maps, seconds, 1000. * seconds / n_maps))
+
+    if dcrf is None:
+        logger.info("pydensecrf is not installed, only the torch CRF was timed")
+    else:
+        dense_masks, dense_seconds = timed(lambda: densecrf(probs, images), 1, torch.device('cpu'))
+        logger.info("pydensecrf (50 iterations, serial): {} maps in {:.3f} s, {:.1f} ms per map".format(
+            n_maps, dense_seconds, 1000. * dense_seconds / n_maps))
+        logger.info("Speed-up {:.1f}x, argmax agreement {:.4f}".format(
+            dense_seconds / seconds, float((torch_masks == dense_masks).mean())))
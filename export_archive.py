@@ -0,0 +1,31 @@
+"""
+Export masks of a prediction archive (see `ptsemseg/inference/archive.py`) to PNG files.
+
+python export_archive.py --archive=results/drive/run.psar --out_path=results/drive/run_pngs --names=01_test --steps=1,4
+"""
+import argparse
+import logging
+
+from ptsemseg.inference.archive import PredictionArchive, export_pngs
+
+logger = logging.getLogger('ptsemseg')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export")
+    parser.add_argument("--archive", nargs="?", type=str, default=None, help="prediction archive to read")
+    parser.add_argument("--out_path", nargs="?", type=str, default=None, help="folder of the PNG files")
+    parser.add_argument("--names", nargs="?", type=str, default="", help="comma separated images, all if empty")
+    parser.add_argument("--steps", nargs="?", type=str, default="", help="comma separated steps, all if empty")
+    parser.add_argument("--probs", dest="probs", action="store_true",
+                        help="Also export the stored probabilities | False by default")
+    parser.set_defaults(probs=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    names = [n for n in args.names.split(',') if n] or None
+    steps = [int(s) for s in args.steps.split(',') if s] or None
+    with PredictionArchive(args.archive) as archive:
+        written = export_pngs(archive, args.out_path, names=names, steps=steps, probs=args.probs)
+    logger.info("{} files written to {}".format(written, args.out_path))
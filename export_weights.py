@@ -0,0 +1,32 @@
+"""
+Export the model state of a training checkpoint as a memory-mapped inference weights file
+(see `ptsemseg/inference/weights.py`). validate.py, serve.py and the other inference scripts
+take the weights file as --model_path directly.
+
+python export_weights.py --model_path=runs/drive/.../dru_drive_best_model.pkl
+"""
+import os
+import time
+import argparse
+import logging
+
+from ptsemseg.inference.weights import export_weights, read_weights
+
+logger = logging.getLogger('ptsemseg')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export")
+    parser.add_argument("--model_path", nargs="?", type=str, default=None, help="training checkpoint to export")
+    parser.add_argument("--out_path", nargs="?", type=str, default="",
+                        help="weights file, the checkpoint path with a .weights extension if empty")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    out_path = args.out_path or os.path.splitext(args.model_path)[0] + '.weights'
+    meta = export_weights(args.model_path, out_path)
+    start = time.time()
+    state, _ = read_weights(out_path)
+    logger.info("{} tensors ({:.1f} MB, {}) written to {}, mapped back in {:.1f} ms".format(
+        len(state), os.path.getsize(out_path) / float(1 << 20), meta, out_path, 1000. * (time.time() - start)))
@@ -0,0 +1,90 @@
+"""
+Segment a directory of images with a trained model, decode / forward / encode overlapped.
+
+Images of --img_path (and of its sub-folders) are decoded and resized by a
+thread pool, batched through the model, and their masks are written at the
+original size by a second pool, `name_stepK.png` for every step of the
+recurrent models. Each stage logs its throughput at the end.
+
+python predict_dir.py --config=runs/drive/.../config.yaml --model_path=runs/drive/.../dru_drive_best_model.pkl \
+    --img_path=data/DRIVE/test/images --out_path=results/drive_masks
+"""
+import os
+import logging
+
+import yaml
+import torch
+from PIL import Image
+
+from ptsemseg.inference import get_predictor
+from ptsemseg.inference.pipeline import Pipeline, list_images, image_to_tensor
+from ptsemseg.inference.server import load_model
+from utils_drive import validate_parser
+from validate import step_masks
+
+logger = logging.getLogger('ptsemseg')
+
+
+def make_stages(predictor, device, img_size, img_norm, n_classes):
+    """decode, forward and encode callables of the `Pipeline`, encode returns the files it wrote."""
+    # Binary masks are written in 0 / 255, like validate does.
+    scale = 255 // max(n_classes - 1, 1)
+
+    def decode(item):
+        img = Image.open(item[0])
+        return image_to_tensor(img, img_size, img_norm), img.size
+
+    def forward(images):
+        with torch.no_grad():
+            outputs = predictor(images.to(device))
+        outputs = list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+        masks = step_masks(outputs).cpu().numpy()
+        return [masks[:, n] for n in range(masks.shape[1])]
+
+    def encode(item, size, masks):
+        img_path, out_dir = item
+        name = os.path.splitext(os.path.basename(img_path))[0]
+        os.makedirs(out_dir, exist_ok=True)
+        written = []
+        for step, mask in enumerate(masks):
+            suffix = '_step{}.png'.format(step + 1) if len(masks) > 1 else '.png'
+            written.append(os.path.join(out_dir, name + suffix))
+            Image.fromarray(mask * scale).resize(size, Image.NEAREST).save(written[-1])
+        return written
+
+    return decode, forward, encode
+
+
+if __name__ == "__main__":
+    parser = validate_parser()
+    parser.add_argument("--img_path", nargs="?", type=str, default=None, help="folder of the input images")
+    parser.add_argument("--out_path", nargs="?", type=str, default=None, help="folder of the output masks")
+    parser.add_argument("--n_classes", nargs="?", type=int, default=2, help="number of classes of the model")
+    parser.add_argument("--decode_workers", nargs="?", type=int, default=4, help="threads decoding the images")
+    parser.add_argument("--encode_workers", nargs="?", type=int, default=4, help="threads writing the masks")
+    parser.add_argument("--queue_size", nargs="?", type=int, default=16, help="images waiting between stages")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    with open(args.config) as fp:
+        cfg = yaml.load(fp, Loader=yaml.Loader)
+    if args.model:
+        cfg['model']['arch'] = args.model
+    device = torch.device(args.device)
+    model = load_model(cfg['model'], args.n_classes, args, args.model_path, device)
+
+    img_size = None
+    if cfg['data'].get('img_rows', 'same') != 'same':
+        img_size = (cfg['data']['img_rows'], cfg['data']['img_cols'])
+    img_norm = args.img_norm and cfg['data']['dataset'] not in ['drive']
+    predictor = get_predictor(model, cfg['model']['arch'], args, args.n_classes)
+
+    items = list_images(args.img_path, args.out_path)
+    logger.info("{} images from {}".format(len(items), args.img_path))
+    pipeline = Pipeline(*make_stages(predictor, device, img_size, img_norm, args.n_classes),
+                        batch_size=args.batch_size or 4,
+                        decode_workers=args.decode_workers,
+                        encode_workers=args.encode_workers,
+                        queue_size=args.queue_size)
+    pipeline.run(items)
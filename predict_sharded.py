@@ -0,0 +1,91 @@
+"""
+Segment a large collection of images with several worker processes, restartable.
+
+The images of --img_path (and of its sub-folders, like test_drive.py) are split
+into shards of --shard_size images. Each of the --workers processes is pinned to
+its own group of cores, loads its own copy of the model and runs the shards it
+takes through the `Pipeline` of predict_dir.py. Completed shards are recorded in
+--index (`index.jsonl` under --out_path by default) with the masks written for
+each image; running the same command again only runs the missing shards.
+
+python predict_sharded.py --config=runs/drive/.../config.yaml --model_path=runs/drive/.../dru_drive_best_model.pkl \
+    --img_path=data/frames --out_path=results/frames_masks --device=cpu --workers=8
+"""
+import os
+import logging
+import functools
+
+import yaml
+import torch
+
+from ptsemseg.inference import get_predictor
+from ptsemseg.inference.pipeline import Pipeline, list_images
+from ptsemseg.inference.server import load_model
+from ptsemseg.inference.sharding import make_shards, run_sharded, ShardIndex
+from predict_dir import make_stages
+from utils_drive import validate_parser
+
+logger = logging.getLogger('ptsemseg')
+
+
+def build_worker(cfg, args, rank):
+    """Loads the model in a worker, returns the callable running the items of one shard."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s worker {} %(message)s'.format(rank))
+    device = torch.device(args.device)
+    if device.type == 'cuda' and torch.cuda.device_count() > 1:
+        # One GPU per worker, in turn.
+        device = torch.device('cuda', rank % torch.cuda.device_count())
+    model = load_model(cfg['model'], args.n_classes, args, args.model_path, device)
+
+    img_size = None
+    if cfg['data'].get('img_rows', 'same') != 'same':
+        img_size = (cfg['data']['img_rows'], cfg['data']['img_cols'])
+    img_norm = args.img_norm and cfg['data']['dataset'] not in ['drive']
+    predictor = get_predictor(model, cfg['model']['arch'], args, args.n_classes)
+    decode, forward, encode = make_stages(predictor, device, img_size, img_norm, args.n_classes)
+
+    def process(items):
+        outputs = {}
+
+        def record(item, size, masks):
+            outputs[item[0]] = encode(item, size, masks)
+
+        Pipeline(decode, forward, record,
+                 batch_size=args.batch_size or 4,
+                 decode_workers=args.decode_workers,
+                 encode_workers=args.encode_workers,
+                 queue_size=args.queue_size).run(items)
+        return outputs
+
+    return process
+
+
+if __name__ == "__main__":
+    parser = validate_parser()
+    parser.add_argument("--img_path", nargs="?", type=str, default=None, help="folder of the input images")
+    parser.add_argument("--out_path", nargs="?", type=str, default=None, help="folder of the output masks")
+    parser.add_argument("--index", nargs="?", type=str, default="",
+                        help="index of the completed shards, out_path/index.jsonl if empty")
+    parser.add_argument("--n_classes", nargs="?", type=int, default=2, help="number of classes of the model")
+    parser.add_argument("--workers", nargs="?", type=int, default=1, help="worker processes, one model each")
+    parser.add_argument("--threads_per_worker", nargs="?", type=int, default=0,
+                        help="intra-op threads of each worker, one per pinned core if 0")
+    parser.add_argument("--shard_size", nargs="?", type=int, default=256, help="images per shard")
+    parser.add_argument("--decode_workers", nargs="?", type=int, default=2, help="threads decoding the images")
+    parser.add_argument("--encode_workers", nargs="?", type=int, default=2, help="threads writing the masks")
+    parser.add_argument("--queue_size", nargs="?", type=int, default=16, help="images waiting between stages")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    with open(args.config) as fp:
+        cfg = yaml.load(fp, Loader=yaml.Loader)
+    if args.model:
+        cfg['model']['arch'] = args.model
+
+    items = list_images(args.img_path, args.out_path)
+    shards = make_shards(items, args.shard_size)
+    index = ShardIndex(args.index or os.path.join(args.out_path, 'index.jsonl'))
+    logger.info("{} images from {} in {} shards".format(len(items), args.img_path, len(shards)))
+    run_sharded(shards, functools.partial(build_worker, cfg, args), index,
+                n_workers=args.workers, threads=args.threads_per_worker)
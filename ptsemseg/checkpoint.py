@@ -0,0 +1,205 @@
+"""
+Checkpoint utilities.
+
+Snapshots training state to the CPU on the calling thread and hands the
+pickling and disk I/O to a background worker, so saving a checkpoint does not
+stall the training loop.
+"""
+import os
+import re
+import glob
+import random
+import logging
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+logger = logging.getLogger('ptsemseg')
+
+
+def snapshot_to_cpu(obj):
+    """Deep copies a (nested) state dict, moving every tensor to the CPU.
+
+    The copy is detached from the live model / optimizer, so the next optimizer
+    step can not mutate a checkpoint that is still waiting to be written.
+        :param obj: tensor, dict, list or tuple of those, or any other object.
+    """
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach()
+        return obj.clone() if obj.device.type == 'cpu' else obj.cpu()
+    if isinstance(obj, OrderedDict):
+        return OrderedDict((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    """Returns the python, numpy, torch and CUDA RNG states of this process."""
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    """Restores the RNG states returned by `get_rng_state`."""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state.get('cuda') and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def latest_checkpoint(path, pattern='*_iter_*.pkl'):
+    """Resolves `path` to a checkpoint file.
+
+    A file is returned as is. For a run directory, the iteration checkpoint with
+    the highest iteration is returned, or None if there is none.
+    """
+    if os.path.isfile(path):
+        return path
+    candidates = glob.glob(os.path.join(path, pattern))
+    if not candidates:
+        return None
+
+    def _iteration(p):
+        found = re.findall(r'_iter_(\d+)', os.path.basename(p))
+        return int(found[-1]) if found else -1
+    return max(candidates, key=_iteration)
+
+
+def atomic_save(state, path):
+    """Saves `state` to `path` through a temporary file and a rename, so a crash
+    never leaves a truncated checkpoint behind.
+        :param state: picklable object, usually a dict of state dicts.
+        :param path: target file.
+    """
+    dirname = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def close_on_exit(worker, exc_type):
+    """Closes a background `worker` leaving a `with` block.
+
+    If the block raised, a failure of the close is only logged, so it does not replace the original exception.
+    """
+    if exc_type is None:
+        worker.close()
+        return
+    try:
+        worker.close()
+    except Exception as e:
+        logger.error("Failed to close {} after an error: {}".format(type(worker).__name__, e))
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints on a background thread.
+
+    `save` only snapshots the state to the CPU and queues it. If a write to the
+    same path is still pending, the newer state replaces it, so the queue holds
+    at most one state per path and the caller never waits on the disk.
+
+    Checkpoints saved with a `group` are rotated: only the `keep_last` most
+    recent files of that group are kept on disk.
+    """
+    def __init__(self, keep_last=2):
+        self.keep_last = keep_last
+        self._pending = OrderedDict()
+        self._history = {}
+        self._cond = threading.Condition()
+        self._busy = False
+        self._closed = False
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def save(self, state, path, group=None):
+        """Queues `state` to be written at `path`.
+            :param state: dict of tensors / state dicts.
+            :param path: target file.
+            :param group: rotation group name, None to never rotate this file.
+        """
+        snapshot = snapshot_to_cpu(state)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("CheckpointWriter is closed.")
+            if path in self._pending:
+                logger.info("Replacing pending checkpoint {}".format(path))
+                del self._pending[path]
+            self._pending[path] = (snapshot, group)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending and self._closed:
+                    return
+                path, (state, group) = self._pending.popitem(last=False)
+                self._busy = True
+            try:
+                atomic_save(state, path)
+                logger.info("Checkpoint saved at {}".format(path))
+                if group is not None:
+                    self._rotate(group, path)
+            except Exception as e:
+                logger.error("Failed to save checkpoint {}: {}".format(path, e))
+                self.error = e
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _rotate(self, group, path):
+        history = self._history.setdefault(group, [])
+        if path in history:
+            history.remove(path)
+        history.append(path)
+        while len(history) > max(self.keep_last, 1):
+            old = history.pop(0)
+            if os.path.exists(old):
+                os.remove(old)
+                logger.info("Removed old checkpoint {}".format(old))
+
+    def wait(self):
+        """Blocks until every queued checkpoint is on disk."""
+        with self._cond:
+            while self._pending or self._busy:
+                self._cond.wait()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Flushes the queue and stops the worker thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        close_on_exit(self, exc_type)
@@ -0,0 +1,38 @@
+import functools
+
+from ptsemseg.inference.tta import tta_forward, tta_transforms
+from ptsemseg.inference.tiling import SlidingWindow, tile_grid, blend_window, valid_windows
+from ptsemseg.inference.refine import SparseRefiner, uncertain_pixels
+
+
+def get_predictor(model, arch, args, n_classes):
+    """Callable mapping a batch of images to the model outputs, as asked on the command line.
+
+    Whole images with the test-time augmentations of `tta_transforms`,
+    overlapping tiles of `--tile_size` when it is set, or the steps 2..N
+    refined on the uncertain tiles of `--refine_tile_size` only.
+    """
+    transforms = tta_transforms(args)
+    hidden_size = getattr(args, 'hidden_size', 0)
+    if getattr(args, 'refine_tile_size', 0) > 0:
+        if getattr(args, 'tile_size', 0) > 0:
+            raise ValueError("--refine_tile_size and --tile_size can not be combined")
+        return SparseRefiner(model, arch,
+                             hidden_size=hidden_size,
+                             n_classes=n_classes,
+                             tile_size=args.refine_tile_size,
+                             confidence=getattr(args, 'refine_confidence', 0.9),
+                             change=getattr(args, 'refine_change', 0.05),
+                             batch_size=getattr(args, 'tile_batch_size', 8),
+                             transforms=transforms)
+    if getattr(args, 'tile_size', 0) > 0:
+        return SlidingWindow(model, arch,
+                             tile_size=args.tile_size,
+                             overlap=getattr(args, 'tile_overlap', 0.25),
+                             batch_size=getattr(args, 'tile_batch_size', 4),
+                             blending=getattr(args, 'tile_blending', 'gaussian'),
+                             hidden_size=hidden_size,
+                             n_classes=n_classes,
+                             transforms=transforms)
+    return functools.partial(tta_forward, model, arch, hidden_size=hidden_size, n_classes=n_classes,
+                             transforms=transforms)
@@ -0,0 +1,234 @@
+"""
+Prediction archive: the masks of every step of every image of a run in one file.
+
+Masks are bit-packed (1 bit per pixel for two classes), probability maps are
+optionally stored quantized to uint8. Records are grouped into zlib-compressed
+chunks and an index at the end of the file gives random access by image and
+step, only the chunk holding a record is read and inflated.
+
+Layout: MAGIC | chunk 0 | chunk 1 | ... | index (JSON) | index offset (uint64) | MAGIC
+"""
+import os
+import json
+import math
+import zlib
+import struct
+import logging
+import collections
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger('ptsemseg')
+
+MAGIC = b'PSARCH01'
+FOOTER = struct.Struct('<Q8s')
+
+
+def mask_bits(n_classes):
+    """Bits per pixel of the packed masks of a model with `n_classes` classes."""
+    return max(1, int(math.ceil(math.log2(max(n_classes, 2)))))
+
+
+def pack_mask(mask, bits):
+    """[H, W] integer mask to bytes, `bits` per pixel."""
+    values = np.ascontiguousarray(mask, dtype=np.uint8).reshape(-1)
+    if bits == 1:
+        return np.packbits(values != 0).tobytes()
+    planes = (values[:, None] >> np.arange(bits, dtype=np.uint8)) & 1
+    return np.packbits(planes.reshape(-1)).tobytes()
+
+
+def unpack_mask(data, shape, bits):
+    n = shape[0] * shape[1]
+    flat = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=n * bits)
+    if bits == 1:
+        return flat.reshape(shape)
+    planes = flat.reshape(n, bits).astype(np.uint8)
+    return (planes << np.arange(bits, dtype=np.uint8)).sum(axis=1).astype(np.uint8).reshape(shape)
+
+
+def quantize(prob):
+    """Probabilities in [0, 1] to uint8, uint8 inputs are taken as already quantized."""
+    prob = np.asarray(prob)
+    if prob.dtype == np.uint8:
+        return prob
+    return np.clip(np.round(prob * 255.), 0, 255).astype(np.uint8)
+
+
+class PredictionArchiveWriter(object):
+    """Appends (image, step) records; the file is complete once `close` wrote the index."""
+    def __init__(self, path, n_classes=2, chunk_size=4 << 20, level=6):
+        """
+        :param path: archive file, written to `path + '.tmp'` and renamed on close.
+        :param chunk_size: uncompressed bytes gathered before a chunk is compressed and written.
+        :param level: zlib compression level.
+        """
+        self.path = path
+        self.n_classes = n_classes
+        self.bits = mask_bits(n_classes)
+        self.chunk_size = chunk_size
+        self.level = level
+        self.chunks = []
+        self.entries = collections.OrderedDict()
+        self._buffer = bytearray()
+        self._fp = open(path + '.tmp', 'wb')
+        self._fp.write(MAGIC)
+
+    def add(self, name, step, mask, prob=None):
+        """
+        :param name: image name.
+        :param step: 1-based recurrent step, 1 for the other models.
+        :param mask: [H, W] predicted labels.
+        :param prob: optional [H, W] or [C, H, W] probabilities, floats in [0, 1] or uint8.
+        """
+        mask = np.asarray(mask)
+        if mask.size and int(mask.max()) >= 1 << self.bits:
+            raise ValueError("Label {} of {} does not fit in {} bits".format(int(mask.max()), name, self.bits))
+        packed = pack_mask(mask, self.bits)
+        record = {'chunk': len(self.chunks), 'start': len(self._buffer), 'mask': len(packed),
+                  'shape': list(mask.shape)}
+        self._buffer += packed
+        if prob is not None:
+            prob = quantize(prob)
+            record['prob'] = prob.size
+            record['prob_shape'] = list(prob.shape)
+            self._buffer += np.ascontiguousarray(prob).tobytes()
+        self.entries.setdefault(str(name), {})[str(int(step))] = record
+        if len(self._buffer) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        data = zlib.compress(bytes(self._buffer), self.level)
+        self.chunks.append([self._fp.tell(), len(data)])
+        self._fp.write(data)
+        self._buffer = bytearray()
+
+    def close(self):
+        if self._fp is None:
+            return
+        self._flush()
+        index = json.dumps({'version': 1, 'n_classes': self.n_classes, 'bits': self.bits,
+                            'chunks': self.chunks, 'entries': self.entries}).encode()
+        offset = self._fp.tell()
+        self._fp.write(index)
+        self._fp.write(FOOTER.pack(offset, MAGIC))
+        self._fp.close()
+        self._fp = None
+        os.replace(self.path + '.tmp', self.path)
+        logger.info("{} records in {} chunks written to {}".format(
+            sum(len(steps) for steps in self.entries.values()), len(self.chunks), self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PredictionArchive(object):
+    """Random access reader of a `PredictionArchiveWriter` file."""
+    def __init__(self, path, cached_chunks=4):
+        """
+        :param cached_chunks: number of inflated chunks kept in memory.
+        """
+        self.path = path
+        self._fp = open(path, 'rb')
+        if self._fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a prediction archive".format(path))
+        self._fp.seek(-FOOTER.size, os.SEEK_END)
+        offset, magic = FOOTER.unpack(self._fp.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is truncated, its index was never written".format(path))
+        end = self._fp.seek(0, os.SEEK_END) - FOOTER.size
+        self._fp.seek(offset)
+        index = json.loads(self._fp.read(end - offset).decode())
+        self.n_classes = index['n_classes']
+        self.bits = index['bits']
+        self.chunks = index['chunks']
+        self.entries = index['entries']
+        self.cached_chunks = cached_chunks
+        self._cache = collections.OrderedDict()
+
+    def names(self):
+        return list(self.entries.keys())
+
+    def steps(self, name):
+        return sorted(int(step) for step in self.entries[name])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def _chunk(self, k):
+        if k in self._cache:
+            self._cache.move_to_end(k)
+            return self._cache[k]
+        offset, length = self.chunks[k]
+        self._fp.seek(offset)
+        data = zlib.decompress(self._fp.read(length))
+        self._cache[k] = data
+        if len(self._cache) > self.cached_chunks:
+            self._cache.popitem(last=False)
+        return data
+
+    def _record(self, name, step):
+        record = self.entries[name][str(step)]
+        return record, self._chunk(record['chunk'])
+
+    def mask(self, name, step=None):
+        """[H, W] uint8 labels of `name` at `step`, the last step by default."""
+        step = self.steps(name)[-1] if step is None else step
+        record, data = self._record(name, step)
+        start = record['start']
+        return unpack_mask(data[start:start + record['mask']], record['shape'], self.bits)
+
+    def prob(self, name, step=None):
+        """Stored probabilities of `name` at `step` as float32 in [0, 1], None if they were not stored."""
+        step = self.steps(name)[-1] if step is None else step
+        record, data = self._record(name, step)
+        if 'prob' not in record:
+            return None
+        start = record['start'] + record['mask']
+        prob = np.frombuffer(data[start:start + record['prob']], dtype=np.uint8)
+        return prob.reshape(record['prob_shape']).astype(np.float32) / 255.
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_pngs(archive, out_dir, names=None, steps=None, probs=False):
+    """
+    Writes `name_stepK.png` masks (and `name_stepK_prob.png` with `probs`) of an archive.
+
+    :param archive: `PredictionArchive`.
+    :param names: images to export, all by default.
+    :param steps: 1-based steps to export, all by default.
+    :return: number of files written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    # Binary masks are written in 0 / 255, like validate does.
+    scale = 255 // max(archive.n_classes - 1, 1)
+    written = 0
+    for name in names or archive.names():
+        for step in archive.steps(name):
+            if steps and step not in steps:
+                continue
+            root = os.path.join(out_dir, '{}_step{}'.format(name, step))
+            Image.fromarray(archive.mask(name, step) * scale).save(root + '.png')
+            written += 1
+            prob = archive.prob(name, step) if probs else None
+            if prob is not None and prob.ndim == 2:
+                Image.fromarray(quantize(prob)).save(root + '_prob.png')
+                written += 1
+    return written
@@ -0,0 +1,172 @@
+"""
+Content-addressed cache of model outputs.
+
+An output is stored under the digest of everything it depends on: the
+checkpoint file, the model config, the inference flags (test-time
+augmentations, tiling, refinement) and the input image itself. Re-evaluating
+an unchanged run serves its outputs from disk instead of running the model.
+The cache directory is bounded in size, the least recently used entries are
+evicted first.
+"""
+import os
+import json
+import hashlib
+import logging
+
+import torch
+
+logger = logging.getLogger('ptsemseg')
+
+# Flags of `get_predictor` that change the outputs.
+PREDICTOR_FLAGS = ['eval_flip', 'tta', 'hidden_size', 'tile_size', 'tile_overlap', 'tile_blending',
+                   'refine_tile_size', 'refine_confidence', 'refine_change']
+
+_file_digests = {}
+
+
+def file_digest(path):
+    """sha256 of a file, memoized on its path, size and modification time."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(block)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def tensor_digest(tensor):
+    """sha256 of the values, shape and dtype of a tensor."""
+    tensor = tensor.detach().cpu().contiguous()
+    digest = hashlib.sha256(str((tuple(tensor.shape), str(tensor.dtype))).encode())
+    digest.update(tensor.numpy().tobytes())
+    return digest.hexdigest()
+
+
+def cache_context(model_path, model_cfg, args, n_classes):
+    """Digest of what, besides the input, the outputs of a predictor depend on."""
+    context = {
+        'checkpoint': file_digest(model_path),
+        'model': model_cfg,
+        'n_classes': n_classes,
+        'flags': {flag: getattr(args, flag, None) for flag in PREDICTOR_FLAGS},
+    }
+    return hashlib.sha256(json.dumps(context, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class PredictionCache(object):
+    """Outputs stored one file per key under `root`, at most `max_bytes` in total."""
+    def __init__(self, root, max_bytes=20 << 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        # key: (size, last use), loaded once, kept up to date by get / put.
+        self._entries = {}
+        for sub in os.listdir(root):
+            folder = os.path.join(root, sub)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if name.endswith('.pt'):
+                    stat = os.stat(os.path.join(folder, name))
+                    self._entries[name[:-3]] = (stat.st_size, stat.st_mtime)
+        self._size = sum(size for size, _ in self._entries.values())
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.pt')
+
+    def get(self, key):
+        """Cached outputs of `key` (on the host), None on a miss."""
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            outputs = torch.load(path, map_location='cpu')
+        except (IOError, OSError, RuntimeError, EOFError) as e:
+            logger.warning("Dropping the unreadable cache entry {}: {}".format(path, e))
+            self._remove(key)
+            self.misses += 1
+            return None
+        # The modification time records the last use, it survives restarts.
+        os.utime(path)
+        self._entries[key] = (self._entries[key][0], os.stat(path).st_mtime)
+        self.hits += 1
+        return outputs
+
+    def put(self, key, outputs):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed, readers never see a partial entry.
+        torch.save(outputs, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        if key in self._entries:
+            self._size -= self._entries[key][0]
+        stat = os.stat(path)
+        self._entries[key] = (stat.st_size, stat.st_mtime)
+        self._size += stat.st_size
+        self._evict()
+
+    def _remove(self, key):
+        size, _ = self._entries.pop(key)
+        self._size -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        for key in sorted(self._entries, key=lambda k: self._entries[k][1]):
+            if self._size <= self.max_bytes:
+                break
+            self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size(self):
+        return self._size
+
+
+class CachedPredictor(object):
+    """Wraps a predictor of `get_predictor`: cached images are served from the cache, the others batched."""
+    def __init__(self, predictor, cache, context):
+        """
+        :param cache: `PredictionCache`.
+        :param context: digest of the model and flags, see `cache_context`.
+        """
+        self.predictor = predictor
+        self.cache = cache
+        self.context = context
+
+    def _key(self, images, kwargs, n):
+        digest = hashlib.sha256(self.context.encode())
+        digest.update(tensor_digest(images[n]).encode())
+        # Per image inputs, like the FOV mask of --sparse_tiles.
+        for name in sorted(kwargs):
+            if isinstance(kwargs[name], torch.Tensor):
+                digest.update(name.encode() + tensor_digest(kwargs[name][n]).encode())
+        return digest.hexdigest()
+
+    def __call__(self, images, **kwargs):
+        keys = [self._key(images, kwargs, n) for n in range(images.shape[0])]
+        cached = [self.cache.get(key) for key in keys]
+        missing = [n for n, c in enumerate(cached) if c is None]
+        if missing:
+            index = torch.tensor(missing, device=images.device)
+            sub_kwargs = {k: v[index.to(v.device)] if isinstance(v, torch.Tensor) else v for k, v in kwargs.items()}
+            outputs = self.predictor(images[index], **sub_kwargs)
+            is_list = isinstance(outputs, (list, tuple))
+            steps = list(outputs) if is_list else [outputs]
+            for k, n in enumerate(missing):
+                cached[n] = [s[k].cpu() for s in steps] if is_list else steps[0][k].cpu()
+                self.cache.put(keys[n], cached[n])
+        if isinstance(cached[0], list):
+            return [torch.stack([c[step] for c in cached]).to(images.device) for step in range(len(cached[0]))]
+        return torch.stack(cached).to(images.device)
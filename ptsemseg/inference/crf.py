@@ -0,0 +1,115 @@
+"""
+Batched mean-field CRF refinement in torch, without pydensecrf.
+
+The fully connected kernels of DenseCRF are restricted to a local window of
+`radius` pixels: an appearance (bilateral) kernel on position and colour, and
+an optional smoothness (gaussian) kernel on position only, with Potts
+compatibilities. The kernel weights of every offset are computed once per
+batch, each mean-field iteration is then one shifted multiply-add per offset.
+Any batch of probability maps works: several images, several recurrent steps,
+or both stacked along the batch dimension.
+"""
+import math
+import logging
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger('ptsemseg')
+
+
+def window_offsets(radius):
+    return [(dy, dx) for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1)
+            if (dy, dx) != (0, 0)]
+
+
+def pairwise_weights(image, radius=4, sxy=5., srgb=3., compat=1., gaussian_sxy=3., gaussian_compat=0.):
+    """
+    :param image: [N, 3, H, W] image, in the range `srgb` refers to (0-255 like pydensecrf).
+    :return: [N, K, H, W] weight of the neighbour at each offset of `window_offsets(radius)`,
+        0 outside of the image.
+    """
+    n, _, h, w = image.shape
+    image = image.float()
+    padded = F.pad(image, (radius, radius, radius, radius))
+    inside = F.pad(torch.ones(1, 1, h, w, device=image.device), (radius, radius, radius, radius))
+    weights = []
+    for dy, dx in window_offsets(radius):
+        neighbour = padded[:, :, radius + dy:radius + dy + h, radius + dx:radius + dx + w]
+        valid = inside[:, :, radius + dy:radius + dy + h, radius + dx:radius + dx + w]
+        d2 = float(dy * dy + dx * dx)
+        colour = ((neighbour - image) ** 2).sum(1, keepdim=True)
+        weight = compat * torch.exp(-d2 / (2 * sxy ** 2) - colour / (2 * srgb ** 2))
+        if gaussian_compat > 0:
+            weight = weight + gaussian_compat * math.exp(-d2 / (2 * gaussian_sxy ** 2))
+        weights.append(weight * valid)
+    return torch.cat(weights, 1)
+
+
+def mean_field(probs, weights, radius, iterations=10):
+    """
+    :param probs: [N, C, H, W] class probabilities, the unaries are their negative log.
+    :param weights: [N, K, H, W] from `pairwise_weights`.
+    :return: [N, C, H, W] refined probabilities.
+    """
+    h, w = probs.shape[2:]
+    log_unary = torch.log(probs.clamp(min=1e-8))
+    q = probs
+    for _ in range(iterations):
+        padded = F.pad(q, (radius, radius, radius, radius))
+        message = torch.zeros_like(q)
+        for k, (dy, dx) in enumerate(window_offsets(radius)):
+            message += weights[:, k:k + 1] * padded[:, :, radius + dy:radius + dy + h, radius + dx:radius + dx + w]
+        # Potts model: the penalty of the other labels is the total weight minus the agreeing one,
+        # the total is the same for every label and cancels in the softmax.
+        q = torch.softmax(log_unary + message, 1)
+    return q
+
+
+def crf_refine(probs, image, iterations=10, radius=4, **kernel):
+    """
+    Mean-field refinement of probability maps.
+
+    :param probs: [N, C, H, W] probabilities, or [N, 1, H, W] foreground probabilities.
+    :param image: [M, 3, H, W] images, N a multiple of M: the map i is refined with the image i % M, so the
+        steps of a batch can be stacked step after step. The kernel weights are computed once per image.
+    :param kernel: parameters of `pairwise_weights`.
+    :return: refined probabilities, shaped like `probs`.
+    """
+    single = probs.shape[1] == 1
+    if single:
+        probs = torch.cat([1 - probs, probs], 1)
+    if image.dim() == 3:
+        image = image.unsqueeze(0)
+    weights = pairwise_weights(image.to(probs.device), radius, **kernel)
+    if weights.shape[0] != probs.shape[0]:
+        weights = weights.repeat(probs.shape[0] // weights.shape[0], 1, 1, 1)
+    q = mean_field(probs.float(), weights, radius, iterations)
+    return q[:, 1:] if single else q
+
+
+class CRFPredictor(object):
+    """Post-processes the outputs of a predictor of `get_predictor` with `crf_refine`, all the steps in one batch.
+
+    Multi-channel outputs are returned as log-probabilities (their softmax and argmax are the
+    refined ones), single channel outputs as probabilities, like the models output them.
+    """
+    def __init__(self, predictor, iterations=10, radius=4, image_scale=1., **kernel):
+        """
+        :param image_scale: factor bringing the network inputs to 0-255 for the colour kernel.
+        """
+        self.predictor = predictor
+        self.iterations = iterations
+        self.radius = radius
+        self.image_scale = image_scale
+        self.kernel = kernel
+
+    def __call__(self, images, **kwargs):
+        outputs = self.predictor(images, **kwargs)
+        is_list = isinstance(outputs, (list, tuple))
+        steps = list(outputs) if is_list else [outputs]
+        probs = torch.cat([o if o.shape[1] == 1 else torch.softmax(o, 1) for o in steps])
+        refined = crf_refine(probs, images * self.image_scale, self.iterations, self.radius, **self.kernel)
+        refined = [r if r.shape[1] == 1 else torch.log(r.clamp(min=1e-8))
+                   for r in refined.split(images.shape[0])]
+        return refined if is_list else refined[0]
@@ -0,0 +1,49 @@
+"""
+Ensembles of checkpoints evaluated together.
+
+Every member (a predictor of `get_predictor`, with its own model, steps and
+hidden size) runs on the same decoded and normalized batch, already on the
+device. The class probabilities of their last steps are averaged on the device,
+the merged output is scored like a single model.
+"""
+import logging
+
+import torch
+
+logger = logging.getLogger('ptsemseg')
+
+
+def output_probabilities(output):
+    """[N, C, H, W] class probabilities of a model output.
+
+    Single channel outputs (Dice) are foreground probabilities, they become [1 - p, p];
+    multi-channel outputs are logits.
+    """
+    if output.shape[1] == 1:
+        return torch.cat([1 - output, output], 1)
+    return torch.softmax(output, 1)
+
+
+class EnsemblePredictor(object):
+    """Averages the last step probabilities of several predictors."""
+    def __init__(self, predictors, weights=None):
+        """
+        :param predictors: callables mapping a batch of images to the outputs of one member.
+        :param weights: weight of each member in the average, uniform by default.
+        """
+        self.predictors = list(predictors)
+        self.weights = list(weights) if weights is not None else [1.] * len(self.predictors)
+        if len(self.weights) != len(self.predictors):
+            raise ValueError("{} weights for {} ensemble members".format(len(self.weights), len(self.predictors)))
+
+    def __call__(self, images, **kwargs):
+        """
+        :return: [N, C, H, W] log of the averaged probabilities, so that softmax and argmax apply as to logits.
+        """
+        merged = None
+        for predictor, weight in zip(self.predictors, self.weights):
+            outputs = predictor(images, **kwargs)
+            final = outputs[-1] if isinstance(outputs, (list, tuple)) else outputs
+            probs = output_probabilities(final.float()) * weight
+            merged = probs if merged is None else merged.add_(probs)
+        return torch.log((merged / sum(self.weights)).clamp(min=1e-8))
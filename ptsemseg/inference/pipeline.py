@@ -0,0 +1,150 @@
+"""
+Pipelined inference over a directory of images.
+
+Three stages overlap through bounded queues: a thread pool decodes and resizes
+the images, the calling thread batches them through the model, and a second
+pool encodes and writes the PNG masks. Each stage reports its throughput, so
+the slowest one shows up directly.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger('ptsemseg')
+
+VALID_IMAGES = [".jpg", ".gif", ".png", ".tga", ".tif", ".tiff"]
+
+
+def list_images(img_path, out_path, valid_images=VALID_IMAGES):
+    """
+    Images of `img_path` and of its direct sub-folders, each sub-folder gets its own output folder.
+
+    :return: list of (image path, output folder).
+    """
+    images = []
+    for f in sorted(os.listdir(img_path)):
+        path = os.path.join(img_path, f)
+        if os.path.splitext(f)[1].lower() in valid_images:
+            images.append((path, out_path))
+        elif os.path.isdir(path):
+            for subf in sorted(os.listdir(path)):
+                if os.path.splitext(subf)[1].lower() in valid_images:
+                    images.append((os.path.join(path, subf), os.path.join(out_path, f)))
+    return images
+
+
+def image_to_tensor(img, img_size=None, img_norm=False):
+    """
+    :param img: PIL image.
+    :param img_size: (rows, cols) given to the resize, as in the loaders; None keeps the size.
+    :param img_norm: scale the pixels to [0, 1], else they stay in [0, 255] like `driveLoader`.
+    :return: [3, H, W] float tensor.
+    """
+    img = img.convert('RGB')
+    if img_size is not None:
+        img = img.resize((img_size[0], img_size[1]))
+    img = torch.from_numpy(np.array(img).transpose(2, 0, 1).astype(np.float32))
+    return img / 255. if img_norm else img
+
+
+class StageStats(object):
+    """Items processed and time spent by one stage, over all its workers."""
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.
+        self._lock = threading.Lock()
+
+    def add(self, items, seconds):
+        with self._lock:
+            self.items += items
+            self.busy += seconds
+
+    def __str__(self):
+        rate = self.items / self.busy if self.busy > 0 else 0.
+        return "{}: {} images, {:.1f} s busy, {:.2f} img/s per worker".format(self.name, self.items, self.busy, rate)
+
+
+class Pipeline(object):
+    """decode -> batched forward -> encode, with at most `queue_size` images waiting between two stages."""
+    def __init__(self, decode, forward, encode, batch_size=4, decode_workers=4, encode_workers=4, queue_size=16):
+        """
+        :param decode: callable(item) returning a [C, H, W] tensor and any info kept for `encode`, run on the
+            decode pool.
+        :param forward: callable([N, C, H, W] batch) returning one result per image, run on the calling thread.
+        :param encode: callable(item, info, result), run on the writer pool.
+        """
+        self.decode = decode
+        self.forward = forward
+        self.encode = encode
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.encode_workers = encode_workers
+        self.queue_size = queue_size
+        self.stats = [StageStats('decode'), StageStats('forward'), StageStats('encode')]
+
+    def _timed(self, stats, fn, *args):
+        start = time.time()
+        result = fn(*args)
+        stats.add(1, time.time() - start)
+        return result
+
+    def _feed(self, items, pool, decoded):
+        """Submits the decodes in order, `decoded` holds their futures and bounds the read-ahead."""
+        try:
+            for item in items:
+                decoded.put((item, pool.submit(self._timed, self.stats[0], self.decode, item)))
+        finally:
+            decoded.put(None)
+
+    def _flush(self, batch, writers, pending):
+        start = time.time()
+        results = self.forward(torch.stack([tensor for _, (tensor, _) in batch]))
+        self.stats[1].add(len(batch), time.time() - start)
+        for (item, (_, info)), result in zip(batch, results):
+            # Waits for the oldest write while `queue_size` writes are pending.
+            if len(pending) >= self.queue_size:
+                pending.popleft().result()
+            pending.append(writers.submit(self._timed, self.stats[2], self.encode, item, info, result))
+
+    def run(self, items):
+        """Processes all the `items`, returns the number of images written."""
+        start = time.time()
+        decoded = queue.Queue(maxsize=self.queue_size)
+        pending = collections.deque()
+        with ThreadPoolExecutor(self.decode_workers) as readers, ThreadPoolExecutor(self.encode_workers) as writers:
+            feeder = threading.Thread(target=self._feed, args=(items, readers, decoded), daemon=True)
+            feeder.start()
+            batch = []
+            while True:
+                entry = decoded.get()
+                if entry is None:
+                    break
+                item, future = entry
+                decoded_item = future.result()
+                # Only images of one size share a batch.
+                if batch and (len(batch) == self.batch_size or batch[0][1][0].shape != decoded_item[0].shape):
+                    self._flush(batch, writers, pending)
+                    batch = []
+                batch.append((item, decoded_item))
+            if batch:
+                self._flush(batch, writers, pending)
+            while pending:
+                pending.popleft().result()
+            feeder.join()
+
+        elapsed = time.time() - start
+        for stats in self.stats:
+            logger.info(str(stats))
+        n_images = self.stats[2].items
+        logger.info("{} images in {:.1f} s, {:.2f} img/s end to end".format(
+            n_images, elapsed, n_images / elapsed if elapsed > 0 else 0.))
+        return n_images
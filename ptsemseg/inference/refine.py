@@ -0,0 +1,136 @@
+"""
+Uncertainty-guided sparse refinement for the recurrent models.
+
+The first step runs on the whole image. Each later step is only run on the
+tiles that still contain uncertain pixels: pixels whose most likely class has a
+low probability, or whose probabilities changed a lot at the previous step.
+Elsewhere the segmentation `s` and the hidden state `h` of the previous step
+are carried forward. A refined tile is cut with a halo of context around it,
+only its core is written back.
+"""
+import logging
+
+import torch
+
+from ptsemseg.models import get_initial_states
+from ptsemseg.inference.tta import tta_forward
+from ptsemseg.inference.tiling import valid_windows
+from ptsemseg.inference.ensemble import output_probabilities
+
+logger = logging.getLogger('ptsemseg')
+
+# Stride of the hidden state of dru / sru, see `get_initial_states`.
+HIDDEN_STRIDE = 16
+
+
+def aligned_grid(height, width, tile_size, stride=HIDDEN_STRIDE):
+    """Non overlapping (sx, ex, sy, ey) windows starting on multiples of `tile_size`, the last ones clipped.
+
+    With `tile_size` a multiple of `stride`, every window starts on a cell of the hidden state.
+    """
+    assert tile_size % stride == 0, "tile size {} is not a multiple of {}".format(tile_size, stride)
+    return [(sx, min(sx + tile_size, height), sy, min(sy + tile_size, width))
+            for sx in range(0, height, tile_size)
+            for sy in range(0, width, tile_size)]
+
+
+def uncertain_pixels(prob, previous=None, confidence=0.9, change=0.05):
+    """
+    :param prob: [N, C, H, W] class probabilities of the current step.
+    :param previous: probabilities of the step before, None at the first step.
+    :param confidence: pixels whose most likely class is below this probability are uncertain.
+    :param change: pixels whose probabilities moved by more than this since `previous` are uncertain.
+    :return: [N, H, W] boolean mask of the pixels to refine.
+    """
+    uncertain = prob.max(1)[0] < confidence
+    if previous is not None:
+        uncertain = uncertain | ((prob - previous).abs().max(1)[0] > change)
+    return uncertain
+
+
+class SparseRefiner(object):
+    """Runs the steps 2..N of `dru` / `sru` only on the tiles with uncertain pixels."""
+    def __init__(self, model, arch, hidden_size=32, n_classes=2, tile_size=64, halo=16, confidence=0.9,
+                 change=0.05, batch_size=8, transforms=('identity',)):
+        """
+        :param model: a model with a `step(inputs, h, s)` method, see `ptsemseg.models.dru`.
+        :param tile_size: side of a refined tile, a multiple of the stride of the hidden state (16).
+        :param halo: context added around a tile when it is refined, a multiple of 16 as well.
+            Tiles and crops then start on cells of the hidden state, even on image sizes that are not
+            multiples of `tile_size`.
+        :param confidence: see `uncertain_pixels`.
+        :param change: see `uncertain_pixels`.
+        :param batch_size: number of tiles per step.
+        :param transforms: test-time augmentations, the augmented copies are refined as one batch.
+        """
+        self.model = model
+        self.net = getattr(model, 'module', model)
+        if not hasattr(self.net, 'step'):
+            raise ValueError("Sparse refinement needs a model with a single step method, not {}".format(arch))
+        self.arch = arch
+        self.hidden_size = hidden_size
+        self.n_classes = n_classes
+        self.tile_size = tile_size
+        self.halo = halo
+        self.confidence = confidence
+        self.change = change
+        self.batch_size = batch_size
+        self.transforms = list(transforms)
+        # Tiles refined and tiles considered at the steps 2..N, over all the calls.
+        self.n_refined = 0
+        self.n_tiles = 0
+
+    def _crop(self, window, height, width):
+        sx, ex, sy, ey = window
+        return max(sx - self.halo, 0), min(ex + self.halo, height), max(sy - self.halo, 0), min(ey + self.halo, width)
+
+    def _step_tiles(self, images, h, s, windows, h_next, s_next):
+        """Runs one step on `windows` of the batch, writes the tile cores into `h_next` and `s_next`."""
+        height, width = images.shape[2], images.shape[3]
+        scale = HIDDEN_STRIDE
+        assert self.tile_size % scale == 0 and self.halo % scale == 0
+        crops = [(n, window, self._crop(window, height, width)) for n, window in windows]
+        shapes = {(cx1 - cx0, cy1 - cy0) for _, _, (cx0, cx1, cy0, cy1) in crops}
+        for shape in shapes:
+            group = [c for c in crops if (c[2][1] - c[2][0], c[2][3] - c[2][2]) == shape]
+            for start in range(0, len(group), self.batch_size):
+                batch = group[start:start + self.batch_size]
+                h_tiles, s_tiles = self.net.step(
+                    torch.stack([images[n, :, cx0:cx1, cy0:cy1] for n, _, (cx0, cx1, cy0, cy1) in batch]),
+                    torch.stack([h[n, :, cx0 // scale:cx1 // scale, cy0 // scale:cy1 // scale]
+                                 for n, _, (cx0, cx1, cy0, cy1) in batch]),
+                    torch.stack([s[n, :, cx0:cx1, cy0:cy1] for n, _, (cx0, cx1, cy0, cy1) in batch]))
+                for k, (n, (sx, ex, sy, ey), (cx0, _, cy0, _)) in enumerate(batch):
+                    s_next[n, :, sx:ex, sy:ey] = s_tiles[k, :, sx - cx0:ex - cx0, sy - cy0:ey - cy0]
+                    h_next[n, :, sx // scale:ex // scale, sy // scale:ey // scale] = \
+                        h_tiles[k, :, (sx - cx0) // scale:(ex - cx0) // scale, (sy - cy0) // scale:(ey - cy0) // scale]
+
+    def refine(self, images):
+        """
+        :param images: [N, C, H, W] batch on the device of the model.
+        :return: list of the [N, n_classes, H, W] outputs of every step, like the model forward.
+        """
+        h, s = get_initial_states(self.arch, images, self.hidden_size, self.n_classes)
+        h, s = self.net.step(images, h, s)
+        outputs = [s]
+        windows = [(n, window) for n in range(images.shape[0])
+                   for window in aligned_grid(images.shape[2], images.shape[3], self.tile_size)]
+        # Single channel (Dice) outputs are probabilities already, see `validate.step_probabilities`.
+        prob, previous = output_probabilities(s), None
+
+        for _ in range(1, self.net.steps):
+            selected = valid_windows(windows, uncertain_pixels(prob, previous, self.confidence, self.change))
+            self.n_refined += len(selected)
+            self.n_tiles += len(windows)
+            if selected:
+                # Confident tiles keep the state of the previous step.
+                h_next, s_next = h.clone(), s.clone()
+                self._step_tiles(images, h, s, selected, h_next, s_next)
+                h, s = h_next, s_next
+            previous, prob = prob, output_probabilities(s)
+            outputs.append(s)
+        return outputs
+
+    def __call__(self, images):
+        return tta_forward(self.model, self.arch, images, self.hidden_size, self.n_classes, self.transforms,
+                           forward=self.refine)
@@ -0,0 +1,270 @@
+"""
+Long-running inference service with dynamic batching.
+
+The model is built and its checkpoint loaded once. Requests from concurrent
+clients are queued and grouped into batches of up to `max_batch_size` images:
+a batch is run as soon as it is full, or once the oldest request in it has
+waited `max_latency` seconds. A small local HTTP endpoint (see `serve.py`)
+exposes the service:
+
+    POST /predict?output=mask|prob&steps=k   body: an encoded image (PNG, JPG...)
+    GET  /health
+
+`mask` returns the class of every pixel as a PNG, `prob` the [C, H, W] class
+probabilities as a float32 .npy. For the recurrent models `steps` selects the
+step whose output is returned (the last one by default); a batch only runs as
+many steps as its requests ask for.
+"""
+import io
+import json
+import time
+import queue
+import logging
+import threading
+import collections
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import torch
+import numpy as np
+from PIL import Image
+
+from ptsemseg.models import get_model
+from ptsemseg.inference import get_predictor
+from ptsemseg.inference.pipeline import image_to_tensor
+from ptsemseg.inference.weights import load_into
+
+logger = logging.getLogger('ptsemseg')
+
+# Attribute holding the number of recurrent steps: `steps` for dru / sru, `rnn_steps` for
+# JointSegCTLDireNetRecurrent, reclast and recmid.
+STEP_ATTRS = ['steps', 'rnn_steps']
+
+
+def load_model(model_dict, n_classes, args, model_path, device):
+    """Builds the model of cfg['model'] with `get_model` and loads the checkpoint or weights file at `model_path`."""
+    model = load_into(get_model(model_dict, n_classes, args), model_path, device)
+    model.eval()
+    return model
+
+
+class DynamicBatcher(object):
+    """Groups the submitted requests into batches for `run_batch`, on a background thread.
+
+    Only requests whose inputs have the same shape share a batch, the others wait
+    for the next one in arrival order.
+    """
+    def __init__(self, run_batch, max_batch_size=8, max_latency=0.01):
+        """
+        :param run_batch: callable(inputs, options) returning one result per input.
+        :param max_batch_size: largest batch given to `run_batch`.
+        :param max_latency: seconds a batch waits for more requests, counted from the arrival of its oldest one.
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.n_batches = 0
+        self.n_requests = 0
+        self._queue = queue.Queue()
+        self._deferred = collections.deque()
+        # Set once close() was called, and once the worker reached its end of the queue.
+        self._closing = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='dynamic-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs, **options):
+        """Queues one request, returns a `concurrent.futures.Future` of its result."""
+        if self._closing:
+            raise RuntimeError("The batcher is closed")
+        future = Future()
+        # Arrival time, the deadline of a batch starts when its oldest request was submitted.
+        self._queue.put((inputs, options, future, time.time()))
+        return future
+
+    def pending(self):
+        return self._queue.qsize() + len(self._deferred)
+
+    def _get(self, timeout=None):
+        item = self._queue.get(timeout=timeout)
+        if item is None:
+            self._closed = True
+        return item
+
+    def _next_batch(self):
+        if self._deferred:
+            first = self._deferred.popleft()
+        elif self._closed:
+            return None
+        else:
+            first = self._get()
+            if first is None:
+                return None
+
+        batch, deferred = [first], []
+        shape = tuple(first[0].shape)
+        while self._deferred and len(batch) < self.max_batch_size:
+            item = self._deferred.popleft()
+            (batch if tuple(item[0].shape) == shape else deferred).append(item)
+
+        # A request that waited behind the previous batch, or was deferred, does not wait any longer.
+        deadline = first[3] + self.max_latency
+        while len(batch) < self.max_batch_size and not self._closed:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self._get(timeout)
+            except queue.Empty:
+                break
+            if item is not None:
+                (batch if tuple(item[0].shape) == shape else deferred).append(item)
+        self._deferred.extendleft(reversed(deferred))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                results = self.run_batch([item[0] for item in batch], [item[1] for item in batch])
+            except Exception as e:
+                logger.error("Batch of {} requests failed: {}".format(len(batch), e))
+                for item in batch:
+                    item[2].set_exception(e)
+                continue
+            self.n_batches += 1
+            self.n_requests += len(batch)
+            for item, result in zip(batch, results):
+                item[2].set_result(result)
+
+    def close(self):
+        """Serves the queued requests, then stops the thread."""
+        self._closing = True
+        self._queue.put(None)
+        self._thread.join()
+
+
+class SegmentationService(object):
+    """Decodes the images, runs the batches of `DynamicBatcher` through the model and encodes the answers."""
+    def __init__(self, model, arch, args, n_classes, device, img_size=None, img_norm=False):
+        """
+        :param args: flags of `get_predictor` (--hidden_size, --tta, --tile_size...).
+        :param img_size: (rows, cols) the images are resized to, as in the loaders; None keeps their size.
+        :param img_norm: scale the pixels to [0, 1], else they are fed in [0, 255] like `driveLoader`.
+        """
+        self.model = model
+        self.net = getattr(model, 'module', model)
+        self.arch = arch
+        self.n_classes = n_classes
+        self.device = device
+        self.img_size = img_size
+        self.img_norm = img_norm
+        self.predictor = get_predictor(model, arch, args, n_classes)
+        self.step_attr = next((name for name in STEP_ATTRS if hasattr(self.net, name)), None)
+        self.steps = getattr(self.net, self.step_attr) if self.step_attr is not None else 1
+
+    def preprocess(self, data):
+        """Encoded image bytes to a [3, H, W] float tensor."""
+        return image_to_tensor(Image.open(io.BytesIO(data)), self.img_size, self.img_norm)
+
+    def run_batch(self, images, options):
+        """
+        :param images: list of [3, H, W] tensors of one shape.
+        :param options: per request dict, 'steps' (1-based step returned) and 'output' ('mask' or 'prob').
+        :return: per request (output array, step of the output).
+        """
+        # None asks for the last step.
+        wanted = [max(o['steps'], 1) if o.get('steps') else None for o in options]
+        with torch.no_grad():
+            if self.step_attr is not None:
+                # The batch only unrolls as many steps as its requests need.
+                unrolled = self.steps if None in wanted else min(max(wanted), self.steps)
+                setattr(self.net, self.step_attr, unrolled)
+            try:
+                outputs = self.predictor(torch.stack(images).to(self.device))
+            finally:
+                if self.step_attr is not None:
+                    setattr(self.net, self.step_attr, self.steps)
+            outputs = list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+
+            results = []
+            for i, (step, option) in enumerate(zip(wanted, options)):
+                step = len(outputs) if step is None else min(step, len(outputs))
+                output = outputs[step - 1][i]
+                if option.get('output', 'mask') == 'prob':
+                    # Single channel outputs (Dice) already are probabilities, as in validate.
+                    prob = output if output.shape[0] == 1 else torch.softmax(output, 0)
+                    results.append((prob.float().cpu().numpy(), step))
+                else:
+                    mask = (output[0] >= 0.5) if output.shape[0] == 1 else output.max(0)[1]
+                    results.append((mask.to(torch.uint8).cpu().numpy(), step))
+        return results
+
+    @staticmethod
+    def encode(result, output):
+        """Response body and content type of a result."""
+        buffer = io.BytesIO()
+        if output == 'prob':
+            np.save(buffer, result)
+            return buffer.getvalue(), 'application/octet-stream'
+        Image.fromarray(result).save(buffer, format='PNG')
+        return buffer.getvalue(), 'image/png'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(service, batcher, host='127.0.0.1', port=8000, timeout=60.):
+    """HTTP server answering the requests of one `SegmentationService` through `batcher`."""
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body, content_type='application/json', headers=()):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, code, message):
+            self._reply(code, json.dumps({'error': message}).encode())
+
+        def do_GET(self):
+            if urlparse(self.path).path != '/health':
+                return self._error(404, 'unknown path')
+            self._reply(200, json.dumps({'arch': service.arch, 'steps': service.steps,
+                                         'pending': batcher.pending(), 'batches': batcher.n_batches,
+                                         'requests': batcher.n_requests}).encode())
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                return self._error(404, 'unknown path')
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            output = query.get('output', 'mask')
+            if output not in ['mask', 'prob']:
+                return self._error(400, 'output is mask or prob')
+            try:
+                steps = int(query['steps']) if query.get('steps') else None
+            except ValueError:
+                return self._error(400, 'steps is an integer')
+            try:
+                image = service.preprocess(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except Exception as e:
+                return self._error(400, 'can not decode the image: {}'.format(e))
+            try:
+                result, steps = batcher.submit(image, output=output, steps=steps).result(timeout)
+            except Exception as e:
+                return self._error(500, str(e))
+            body, content_type = service.encode(result, output)
+            self._reply(200, body, content_type, headers=[('X-Steps', str(steps))])
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return _ThreadingHTTPServer((host, port), Handler)
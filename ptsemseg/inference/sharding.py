@@ -0,0 +1,180 @@
+"""
+Sharded inference over large image collections, one model replica per process.
+
+The images are split into shards of `shard_size` images, identified by the
+digest of their paths. Worker processes each pin themselves to their own group
+of CPU cores, set their intra-op thread count, build their model once and take
+shards from a shared queue. The parent process is the only writer of the index,
+a JSON-lines file with one line per completed shard and the files written for
+each image. On a restart, the shards already in the index are skipped; a shard
+interrupted half way is run again from its start.
+"""
+import os
+import json
+import time
+import queue
+import hashlib
+import logging
+import multiprocessing
+
+import torch
+
+logger = logging.getLogger('ptsemseg')
+
+
+def make_shards(items, shard_size):
+    """
+    :param items: list of (image path, output folder), as returned by `list_images`.
+    :return: list of {'id': digest of the image paths, 'items': items of the shard}.
+    """
+    shards = []
+    for start in range(0, len(items), shard_size):
+        chunk = items[start:start + shard_size]
+        digest = hashlib.sha1('\n'.join(path for path, _ in chunk).encode()).hexdigest()[:16]
+        shards.append({'id': digest, 'items': chunk})
+    return shards
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_groups(n_workers, cores=None):
+    """Splits `cores` (the cores this process may use by default) into `n_workers` contiguous groups."""
+    cores = available_cores() if cores is None else list(cores)
+    if n_workers > len(cores):
+        raise ValueError("{} workers for {} cores".format(n_workers, len(cores)))
+    size, extra = divmod(len(cores), n_workers)
+    groups, start = [], 0
+    for rank in range(n_workers):
+        end = start + size + (1 if rank < extra else 0)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def pin_worker(cores, threads=0):
+    """Restricts the calling process to `cores`, with `threads` intra-op threads (one per core if 0)."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads or len(cores))
+
+
+class ShardIndex(object):
+    """JSON-lines record of the completed shards, appended by a single process."""
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, 'rb+') as fp:
+                data = fp.read()
+                if data and not data.endswith(b'\n'):
+                    # The last line of a killed run is incomplete, it is dropped and its shard is run again.
+                    # Otherwise the next record would be appended to it.
+                    data = data[:data.rfind(b'\n') + 1]
+                    fp.truncate(len(data))
+            for line in data.decode().splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.records[record['shard']] = record
+
+    def completed(self):
+        return set(self.records)
+
+    def record(self, shard_id, outputs, **info):
+        """
+        :param outputs: {image path: [files written]}.
+        :param info: extra fields of the line, like the worker and its time.
+        """
+        record = dict(info, shard=shard_id, outputs=outputs)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'a') as fp:
+            fp.write(json.dumps(record) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.records[shard_id] = record
+
+    def outputs(self):
+        """{image path: [files written]} over all the completed shards."""
+        merged = {}
+        for record in self.records.values():
+            merged.update(record['outputs'])
+        return merged
+
+
+def _worker(rank, cores, threads, build, tasks, results):
+    pin_worker(cores, threads)
+    process = build(rank)
+    while True:
+        shard = tasks.get()
+        if shard is None:
+            break
+        start = time.time()
+        try:
+            outputs = process(shard['items'])
+        except Exception as e:
+            logger.exception("Worker {} failed on shard {}".format(rank, shard['id']))
+            results.put((shard['id'], rank, None, repr(e)))
+            continue
+        results.put((shard['id'], rank, outputs, time.time() - start))
+
+
+def run_sharded(shards, build, index, n_workers=1, threads=0, cores=None):
+    """
+    Runs the shards not in `index` over `n_workers` processes.
+
+    :param build: picklable callable(rank) run once in each worker, returning a callable(items) that
+        processes the items of a shard and returns {image path: [files written]}.
+    :param index: `ShardIndex`, completed shards are skipped and new ones recorded.
+    :param threads: intra-op threads per worker, one per pinned core if 0.
+    :param cores: cores split between the workers, all the available ones by default.
+    :return: number of shards completed by this run.
+    """
+    done = index.completed()
+    pending = [shard for shard in shards if shard['id'] not in done]
+    logger.info("{} shards, {} already completed, {} to run".format(len(shards), len(done & {s['id'] for s in shards}),
+                                                                    len(pending)))
+    if not pending:
+        return 0
+    n_workers = min(n_workers, len(pending))
+    context = multiprocessing.get_context('spawn')
+    tasks, results = context.Queue(), context.Queue()
+    for shard in pending:
+        tasks.put(shard)
+    for _ in range(n_workers):
+        tasks.put(None)
+    workers = [context.Process(target=_worker, args=(rank, group, threads, build, tasks, results), daemon=True)
+               for rank, group in enumerate(core_groups(n_workers, cores))]
+    for worker in workers:
+        worker.start()
+
+    completed, failed, start = 0, 0, time.time()
+    while completed + failed < len(pending):
+        try:
+            shard_id, rank, outputs, info = results.get(timeout=1.)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        if outputs is None:
+            failed += 1
+            logger.warning("Shard {} failed on worker {}: {}".format(shard_id, rank, info))
+            continue
+        index.record(shard_id, outputs, worker=rank, seconds=info)
+        completed += 1
+        n_images = sum(len(record['outputs']) for record in index.records.values())
+        logger.info("Shard {} done by worker {} in {:.1f} s, {}/{} shards, {} images in the index".format(
+            shard_id, rank, info, completed, len(pending), n_images))
+    for worker in workers:
+        worker.join()
+
+    elapsed = time.time() - start
+    missing = len(pending) - completed
+    if missing:
+        logger.warning("{} shards not completed, run again to resume".format(missing))
+    logger.info("{} shards in {:.1f} s with {} workers".format(completed, elapsed, n_workers))
+    return completed
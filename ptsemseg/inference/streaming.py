@@ -0,0 +1,77 @@
+"""
+Temporal warm-start streaming for the recurrent models on video.
+
+Consecutive frames of a clip look alike. Instead of starting every frame from
+`s0 = ones`, `h0 = ones` and running all the steps, a frame starts from the
+final segmentation and hidden state of the previous frame of its clip and only
+runs `warm_steps` steps. The first frame of a clip (or a frame whose size
+changed) is cold started with all the steps of the model.
+"""
+import logging
+
+import torch
+
+from ptsemseg.models import get_initial_states
+
+logger = logging.getLogger('ptsemseg')
+
+
+class StreamingSegmenter(object):
+    """Segments N parallel frame streams, one frame of each per call."""
+    def __init__(self, model, arch, hidden_size=32, n_classes=2, warm_steps=1):
+        """
+        :param model: a model with a `step(inputs, h, s)` method, see `ptsemseg.models.dru`.
+        :param warm_steps: steps run on a frame started from the state of the previous one.
+        """
+        self.model = model
+        self.net = getattr(model, 'module', model)
+        if not hasattr(self.net, 'step'):
+            raise ValueError("Streaming needs a model with a single step method, not {}".format(arch))
+        self.arch = arch
+        self.hidden_size = hidden_size
+        self.n_classes = n_classes
+        self.warm_steps = warm_steps
+        self.n_frames = 0
+        self.n_steps = 0
+        self.reset()
+
+    def reset(self):
+        """Forgets the state of every stream, their next frames are cold started."""
+        self._h = None
+        self._s = None
+
+    def _run(self, frames, h, s, steps):
+        for _ in range(steps):
+            h, s = self.net.step(frames, h, s)
+        self.n_frames += frames.shape[0]
+        self.n_steps += frames.shape[0] * steps
+        return h, s
+
+    def __call__(self, frames, first=None):
+        """
+        :param frames: [N, C, H, W] the current frame of each stream, on the device.
+        :param first: [N] booleans, True for the streams starting a new clip; None for no new clip.
+        :return: [N, n_classes, H, W] output of the last step run on each frame.
+        """
+        n = frames.shape[0]
+        if first is None:
+            cold = torch.zeros(n, dtype=torch.bool)
+        else:
+            cold = torch.as_tensor(first, dtype=torch.bool).cpu().clone()
+        if self._s is None or self._s.shape[0] != n or self._s.shape[2:] != frames.shape[2:]:
+            cold[:] = True
+        h0, s0 = get_initial_states(self.arch, frames, self.hidden_size, self.n_classes)
+        if bool(cold.all()):
+            h, s = self._run(frames, h0, s0, self.net.steps)
+        else:
+            h, s = self._h.clone(), self._s.clone()
+            warm = (~cold).nonzero().view(-1).to(frames.device)
+            h[warm], s[warm] = self._run(frames[warm], h[warm], s[warm], self.warm_steps)
+            if bool(cold.any()):
+                index = cold.nonzero().view(-1).to(frames.device)
+                h[index], s[index] = self._run(frames[index], h0[index], s0[index], self.net.steps)
+        self._h, self._s = h, s
+        return s
+
+    def steps_per_frame(self):
+        return self.n_steps / float(max(self.n_frames, 1))
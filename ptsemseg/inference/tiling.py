@@ -0,0 +1,201 @@
+"""
+Sliding-window inference for images of any size.
+
+Overlapping tiles of one or more images are cut, batched and run through the
+model (recurrent models get initial states sized for the tile), then blended
+back with per-pixel weights. The image may stay on the host while only the
+current batch of tiles lives on the model's device, so images larger than the
+device memory can be processed.
+
+With a validity mask (the FOV of DRIVE, the non-void pixels of the road
+dataset), tiles without any valid pixel are not run and their pixels are
+filled with background.
+"""
+import math
+import logging
+
+import torch
+import torch.nn.functional as F
+
+from ptsemseg.models import model_forward
+from ptsemseg.inference.tta import tta_forward
+
+logger = logging.getLogger('ptsemseg')
+
+# Logit of the background filled in skipped tiles, far in the saturated range of a softmax or a sigmoid.
+BACKGROUND_LOGIT = 20.
+
+
+def tile_starts(size, tile, stride):
+    """Start offsets of the tiles along one axis, the last tile ends on the border."""
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, stride))
+    return starts + [size - tile]
+
+
+def tile_grid(height, width, tile_size, overlap=0.25):
+    """
+    :param tile_size: (tile height, tile width).
+    :param overlap: fraction of a tile shared with its neighbour.
+    :return: list of (sx, ex, sy, ey) windows covering the image.
+    """
+    th, tw = min(tile_size[0], height), min(tile_size[1], width)
+    stride_x = max(1, int(th * (1 - overlap)))
+    stride_y = max(1, int(tw * (1 - overlap)))
+    return [(sx, sx + th, sy, sy + tw)
+            for sx in tile_starts(height, th, stride_x)
+            for sy in tile_starts(width, tw, stride_y)]
+
+
+def blend_window(height, width, mode='gaussian', sigma_scale=1. / 8, device=None):
+    """Per-pixel weight of a tile when blending: 'gaussian' favours tile centres, 'uniform' averages."""
+    if mode == 'uniform':
+        return torch.ones(height, width, device=device)
+    if mode != 'gaussian':
+        raise ValueError("Unknown blending {}".format(mode))
+
+    def _axis(n):
+        x = torch.arange(n, dtype=torch.float32, device=device) - (n - 1) / 2.
+        sigma = max(n * sigma_scale, 1.)
+        return torch.exp(-x ** 2 / (2 * sigma ** 2))
+    window = _axis(height)[:, None] * _axis(width)[None, :]
+    window = window / window.max()
+    # Border pixels only covered by one tile must keep a usable weight.
+    return window.clamp(min=1e-3)
+
+
+def window_valid_counts(windows, mask):
+    """
+    :param windows: (image index, (sx, ex, sy, ey)) pairs.
+    :param mask: [N, H, W] validity mask, non-zero where the pixels are scored.
+    :return: number of valid pixels in each window, from one integral image of the mask.
+    """
+    integral = (mask.detach().cpu() != 0).long().cumsum(1).cumsum(2)
+    integral = F.pad(integral, (1, 0, 1, 0))
+    return [int(integral[n, ex, ey] - integral[n, sx, ey] - integral[n, ex, sy] + integral[n, sx, sy])
+            for n, (sx, ex, sy, ey) in windows]
+
+
+def valid_windows(windows, mask, min_valid=1):
+    """The windows with at least `min_valid` valid pixels in `mask`."""
+    return [w for w, count in zip(windows, window_valid_counts(windows, mask)) if count >= min_valid]
+
+
+def background_like(output, logits=True):
+    """Outputs predicting background (class 0) everywhere, as logits or as probabilities.
+
+    A single channel output (Dice) is a foreground probability whatever `logits`, it is filled with 0.
+    """
+    background = torch.zeros_like(output)
+    if output.shape[1] > 1:
+        high, low = (BACKGROUND_LOGIT, -BACKGROUND_LOGIT) if logits else (1., 0.)
+        background.fill_(low)
+        background[:, 0] = high
+    return background
+
+
+class SlidingWindow(object):
+    """Batched, blended sliding-window inference around any model of `ptsemseg.models`."""
+    def __init__(self, model, arch, tile_size=(576, 576), overlap=0.25, batch_size=4, blending='gaussian',
+                 hidden_size=32, n_classes=2, transforms=('identity',), activation=None, output_device=None):
+        """
+        :param arch: cfg['model']['arch'], selects the recurrent states built for each tile batch.
+        :param tile_size: (height, width) of a tile, a multiple of 32 for the recurrent models.
+        :param batch_size: number of tiles per forward.
+        :param transforms: test-time augmentations run on every tile, see `tta_forward`.
+        :param activation: applied to the outputs of every augmented copy of a tile, before they are averaged
+            and blended (e.g. a softmax), None for raw outputs.
+        :param output_device: where the blended outputs are accumulated, the device of the images by default.
+        """
+        self.model = model
+        self.arch = arch
+        self.tile_size = tile_size if isinstance(tile_size, (tuple, list)) else (tile_size, tile_size)
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.blending = blending
+        self.hidden_size = hidden_size
+        self.n_classes = n_classes
+        self.transforms = list(transforms)
+        self.activation = activation
+        self.output_device = output_device
+        # Tiles run and skipped for lack of valid pixels, over all the calls.
+        self.n_run = 0
+        self.n_skipped = 0
+
+    def model_device(self):
+        return next(self.model.parameters()).device
+
+    def windows(self, images):
+        """(image index, window) of every tile to run, in order."""
+        return [(n, window) for n in range(images.shape[0])
+                for window in tile_grid(images.shape[2], images.shape[3], self.tile_size, self.overlap)]
+
+    def _forward_tiles(self, tiles):
+        forward = None
+        if self.activation is not None:
+            # The mean of the softmaxed copies, not the softmax of their mean.
+            def forward(batch):
+                outputs = model_forward(self.model, self.arch, batch, self.hidden_size, self.n_classes)
+                return [self.activation(o) for o in outputs] if isinstance(outputs, (list, tuple)) \
+                    else self.activation(outputs)
+        return tta_forward(self.model, self.arch, tiles.to(self.model_device()), self.hidden_size,
+                           self.n_classes, self.transforms, forward=forward)
+
+    def __call__(self, images, windows=None, fill=None, mask=None, min_valid=1):
+        """
+        :param images: [N, C, H, W] batch, on the host or on the device.
+        :param windows: (image index, window) pairs to run, all the tiles by default.
+        :param fill: per-step [N, C', H, W] outputs used where no tile was run, zeros by default.
+        :param mask: [N, H, W] validity mask, tiles with less than `min_valid` valid pixels are skipped.
+            Their pixels get `fill`, background by default.
+        :return: blended outputs with the structure of the model output, [N, C', H, W] per step.
+        """
+        device = self.output_device or images.device
+        windows = self.windows(images) if windows is None else windows
+        if mask is not None:
+            kept = valid_windows(windows, mask, min_valid)
+            # One tile still runs on an empty image, the outputs need a shape.
+            kept = kept or windows[:1]
+            self.n_skipped += len(windows) - len(kept)
+            windows = kept
+        self.n_run += len(windows)
+        weights = torch.zeros(images.shape[0], 1, images.shape[2], images.shape[3], device=device)
+        accumulated = None
+        is_list = False
+
+        for start in range(0, len(windows), self.batch_size):
+            batch = windows[start:start + self.batch_size]
+            # Tiles of one batch share a shape; the border tiles of a small image may be smaller.
+            shapes = {(ex - sx, ey - sy) for _, (sx, ex, sy, ey) in batch}
+            for shape in shapes:
+                group = [(n, w) for n, w in batch if (w[1] - w[0], w[3] - w[2]) == shape]
+                tiles = torch.stack([images[n, :, sx:ex, sy:ey] for n, (sx, ex, sy, ey) in group])
+                outputs = self._forward_tiles(tiles)
+                is_list = isinstance(outputs, (list, tuple))
+                steps = list(outputs) if is_list else [outputs]
+                if accumulated is None:
+                    accumulated = [torch.zeros(images.shape[0], o.shape[1], images.shape[2], images.shape[3],
+                                               dtype=o.dtype, device=device) for o in steps]
+                window = blend_window(shape[0], shape[1], self.blending, device=steps[0].device)
+                for k, (n, (sx, ex, sy, ey)) in enumerate(group):
+                    for acc, output in zip(accumulated, steps):
+                        acc[n, :, sx:ex, sy:ey] += (output[k] * window).to(device)
+                    weights[n, :, sx:ex, sy:ey] += window.to(device)
+
+        if accumulated is None:
+            return fill
+        covered = weights > 0
+        blended = [torch.where(covered, acc / weights.clamp(min=1e-12), acc) for acc in accumulated]
+        if fill is None and mask is not None:
+            fills = [background_like(acc, logits=self.activation is None) for acc in accumulated]
+            blended = [torch.where(covered, b, f) for b, f in zip(blended, fills)]
+        elif fill is not None:
+            fills = list(fill) if is_list else [fill]
+            blended = [torch.where(covered, b, f.to(device)) for b, f in zip(blended, fills)]
+        return blended if is_list else blended[0]
+
+
+def n_tiles(height, width, tile_size, overlap=0.25):
+    """Number of tiles `SlidingWindow` runs on an image of this size."""
+    return len(tile_grid(height, width, tile_size, overlap))
@@ -0,0 +1,86 @@
+"""
+Batched test-time augmentation.
+
+The augmented copies of a batch are concatenated along the batch dimension and
+go through the model in a single forward, recurrent states included. Outputs
+are mapped back and averaged on the device.
+"""
+import logging
+from collections import OrderedDict
+
+import torch
+
+from ptsemseg.models import model_forward
+
+logger = logging.getLogger('ptsemseg')
+
+# name: (transform, inverse) on [N, C, W, H] tensors.
+TRANSFORMS = OrderedDict([
+    ('identity', (lambda x: x, lambda x: x)),
+    ('hflip', (lambda x: x.flip(3), lambda x: x.flip(3))),
+    ('vflip', (lambda x: x.flip(2), lambda x: x.flip(2))),
+    ('rot90', (lambda x: x.rot90(1, (2, 3)), lambda x: x.rot90(-1, (2, 3)))),
+])
+
+
+def tta_transforms(args):
+    """Augmentations asked for on the command line: hflip with --eval_flip, plus the comma separated --tta ones."""
+    transforms = ['identity']
+    if getattr(args, 'eval_flip', False):
+        transforms.append('hflip')
+    for name in getattr(args, 'tta', '').split(','):
+        name = name.strip()
+        if not name or name in transforms:
+            continue
+        if name not in TRANSFORMS:
+            raise ValueError("Unknown test-time augmentation {}, expected one of {}".format(
+                name, list(TRANSFORMS.keys())))
+        transforms.append(name)
+    return transforms
+
+
+def _merge(outputs, n_images, transforms):
+    """Splits the batched outputs per augmentation, undoes each and averages them."""
+    if isinstance(outputs, (list, tuple)):
+        return [_merge(output, n_images, transforms) for output in outputs]
+    merged = None
+    for k, name in enumerate(transforms):
+        output = TRANSFORMS[name][1](outputs[k * n_images:(k + 1) * n_images])
+        merged = output if merged is None else merged + output
+    return merged / len(transforms)
+
+
+def _forward(forward, images, transforms):
+    batch = torch.cat([TRANSFORMS[name][0](images) for name in transforms])
+    return _merge(forward(batch), images.shape[0], transforms)
+
+
+def tta_forward(model, arch, images, hidden_size, n_classes, transforms=('identity', 'hflip'), forward=None):
+    """Runs `model` on `images` and its augmented copies, and returns the averaged outputs.
+
+    :param arch: cfg['model']['arch'], selects the initial recurrent states.
+    :param images: [N, C, W, H] batch, already on the device.
+    :param transforms: names from `TRANSFORMS`.
+    :param forward: callable mapping a batch to the outputs, `model_forward` by default.
+    :return: same structure as the model output (a tensor, or a list of tensors, one per step).
+    """
+    transforms = list(transforms)
+    if forward is None:
+        def forward(batch):
+            return model_forward(model, arch, batch, hidden_size, n_classes)
+    if len(transforms) == 1 and transforms[0] == 'identity':
+        return forward(images)
+
+    # A rotation of a non square batch can not be concatenated with the others, it gets its own forward.
+    if images.shape[2] != images.shape[3] and 'rot90' in transforms:
+        others = [name for name in transforms if name != 'rot90']
+        rotated = _forward(forward, images, ['rot90'])
+        if not others:
+            return rotated
+        outputs = _forward(forward, images, others)
+        weight = len(others) / float(len(transforms))
+        if isinstance(outputs, (list, tuple)):
+            return [o * weight + r * (1 - weight) for o, r in zip(outputs, rotated)]
+        return outputs * weight + rotated * (1 - weight)
+
+    return _forward(forward, images, transforms)
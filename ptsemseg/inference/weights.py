@@ -0,0 +1,126 @@
+"""
+Inference weights: the model state of a checkpoint in a flat, memory-mappable file.
+
+Training checkpoints are pickles holding the model, optimizer and scheduler
+states; loading one unpickles everything and `convert_state_dict` copies the
+model tensors once more. The weights file only holds the model tensors, the
+`module.` prefix of DataParallel already stripped, laid out one after the
+other behind a JSON index. Reading it maps the file and views each tensor in
+place, nothing is unpickled or copied until the model takes its parameters.
+
+Layout: MAGIC | index length (uint64) | index (JSON) | padding | tensor data, each tensor aligned to ALIGN bytes
+"""
+import os
+import json
+import struct
+import inspect
+import logging
+import collections
+
+import torch
+import numpy as np
+
+from ptsemseg.utils import convert_state_dict
+
+logger = logging.getLogger('ptsemseg')
+
+MAGIC = b'PSWGHT01'
+HEADER = struct.Struct('<8sQ')
+ALIGN = 64
+
+_DTYPES = {
+    torch.float32: 'float32',
+    torch.float64: 'float64',
+    torch.float16: 'float16',
+    torch.int64: 'int64',
+    torch.int32: 'int32',
+    torch.uint8: 'uint8',
+    torch.int8: 'int8',
+    torch.bool: 'bool',
+}
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def is_weights_file(path):
+    with open(path, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def write_weights(state_dict, path, meta=None):
+    """
+    :param state_dict: model state, `module.` prefixes are stripped.
+    :param meta: JSON serializable information kept in the index (epoch, score...).
+    """
+    state_dict = convert_state_dict(state_dict)
+    tensors, offset = collections.OrderedDict(), 0
+    for name, tensor in state_dict.items():
+        if tensor.dtype not in _DTYPES:
+            raise ValueError("Tensor {} of type {} can not be stored".format(name, tensor.dtype))
+        nbytes = tensor.numel() * tensor.element_size()
+        tensors[name] = {'dtype': _DTYPES[tensor.dtype], 'shape': list(tensor.shape), 'offset': offset,
+                         'nbytes': nbytes}
+        offset = _aligned(offset + nbytes)
+    index = json.dumps({'version': 1, 'meta': meta or {}, 'tensors': tensors}).encode()
+    start = _aligned(HEADER.size + len(index))
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, len(index)))
+        fp.write(index)
+        for name, tensor in state_dict.items():
+            fp.seek(start + tensors[name]['offset'])
+            fp.write(tensor.detach().cpu().contiguous().numpy().tobytes())
+        # The last tensor may end before its padding, the file ends at the data.
+        fp.truncate(start + offset)
+    os.replace(path + '.tmp', path)
+
+
+def export_weights(checkpoint_path, path):
+    """Writes the model state of a training checkpoint (see train_drive.py) as a weights file."""
+    checkpoint = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
+    meta = {k: v for k, v in checkpoint.items()
+            if k not in ['model_state', 'optimizer_state', 'scheduler_state'] and isinstance(v, (int, float, str))}
+    write_weights(checkpoint['model_state'], path, meta)
+    return meta
+
+
+def read_weights(path):
+    """
+    :return: (state dict of tensors viewing the mapped file, meta of the index).
+    The file is mapped copy-on-write, writing to a tensor never changes the file.
+    """
+    with open(path, 'rb') as fp:
+        magic, length = HEADER.unpack(fp.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a weights file".format(path))
+        index = json.loads(fp.read(length).decode())
+    start = _aligned(HEADER.size + length)
+    mapped = np.memmap(path, dtype=np.uint8, mode='c')
+    state = collections.OrderedDict()
+    for name, info in index['tensors'].items():
+        data = mapped[start + info['offset']:start + info['offset'] + info['nbytes']]
+        state[name] = torch.from_numpy(data.view(info['dtype']).reshape(info['shape']))
+    return state, index['meta']
+
+
+def load_state(model_path):
+    """Model state of a weights file or of a training checkpoint, without the `module.` prefix."""
+    if is_weights_file(model_path):
+        return read_weights(model_path)[0]
+    return convert_state_dict(torch.load(model_path, map_location=lambda storage, loc: storage)["model_state"])
+
+
+def load_into(model, model_path, device):
+    """Loads `model_path` into `model` and moves it to `device`.
+
+    On the CPU, with a weights file and a torch whose `load_state_dict` can assign, the
+    parameters keep viewing the mapped file instead of being copied.
+    """
+    mapped = is_weights_file(model_path)
+    state = read_weights(model_path)[0] if mapped else load_state(model_path)
+    if mapped and device.type == 'cpu' and 'assign' in inspect.signature(model.load_state_dict).parameters:
+        model.load_state_dict(state, assign=True)
+    else:
+        model.load_state_dict(state)
+    return model.to(device)
@@ -31,6 +31,7 @@ class driveLoader(data.Dataset):
         img_norm=True,
         version="cityscapes",
         test_mode=False,
+        return_mask=False,
     ):
         """__init__
 
@@ -39,6 +40,7 @@ class driveLoader(data.Dataset):
         :param is_transform:
         :param img_size:
         :param augmentations
+        :param return_mask: also return the field-of-view mask, 1 inside the FOV.
         """
         self.root = root
         self.split = split
@@ -46,6 +48,7 @@ class driveLoader(data.Dataset):
         self.augmentations = None
         # self.augmentations = augmentations
         self.img_norm = img_norm
+        self.return_mask = return_mask
         self.n_classes = 2
         self.img_size = img_size if isinstance(img_size, tuple) else (img_size, img_size)
         # self.files = {}
@@ -146,8 +149,17 @@ class driveLoader(data.Dataset):
         # if self.is_transform:
         img, lbl = self.transform(img, lbl)
 
+        if self.return_mask:
+            return img, lbl, self.transform_mask(mask)
         return img, lbl
 
+    def transform_mask(self, mask):
+        """FOV mask resized like the labels, as a [W, H] uint8 tensor."""
+        mask = Image.fromarray((np.array(mask) > 0).astype(np.uint8))
+        if self.img_size != ('same', 'same'):
+            mask = mask.resize((self.img_size[0], self.img_size[1]), Image.NEAREST)
+        return torch.from_numpy(np.array(mask))
+
     def transform(self, img, lbl):
         """transform
 
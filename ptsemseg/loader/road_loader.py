@@ -37,13 +37,18 @@ class RoadLoader(data.Dataset):
         crop_size=(450, 450),
         augmentations=None,
         img_norm=True,
+        return_mask=False,
     ):
+        """
+        :param return_mask: also return the mask of the valid (non-void) pixels, 0 where the image is white.
+        """
         self.root = os.path.expandwei(root)
         split = 'valid' if split == 'val' else split # Wrap val to valid.
         self.split = split
         self.is_transform = is_transform
         self.augmentations = augmentations
         self.img_norm = img_norm
+        self.return_mask = return_mask
         self.n_classes = 3
 
         # Important here
@@ -108,6 +113,8 @@ class RoadLoader(data.Dataset):
         # if len(np.unique(lbl)) == 3 and self.split == 'train':
         #     logger.warning("Contain void value! after cropping!")
             # return self.__getitem__(index)
+        if self.return_mask:
+            return im, lbl, (lbl != self.void_classes[0]).to(torch.uint8)
         return im, lbl
 
     def transform(self, img, lbl):
@@ -0,0 +1,85 @@
+"""
+Deterministic, resumable sampling.
+
+`ResumableRandomSampler` draws a fixed permutation per epoch from the run seed
+and can start in the middle of an epoch. Together with `SeededDataset`, which
+seeds the augmentation RNGs per sample, a resumed run sees exactly the batches
+it would have seen without the interruption, whatever the number of workers.
+"""
+import random
+
+import numpy as np
+import torch
+from torch.utils import data
+
+
+def sample_seed(seed, epoch, position):
+    """Seed of the augmentations applied to the `position`-th sample of `epoch`."""
+    return ((seed * 1000003 + epoch) * 1000003 + position) % (2 ** 32)
+
+
+class ResumableRandomSampler(data.Sampler):
+    """Shuffles like `RandomSampler`, but from (seed, epoch) only.
+
+    Yields `(index, sample_seed)` pairs, meant to be consumed by `SeededDataset`.
+    """
+    def __init__(self, data_source, seed, epoch=0, start_index=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def set_epoch(self, epoch, start_index=0):
+        """
+        :param epoch: epoch to draw the permutation of.
+        :param start_index: number of samples of this epoch already consumed, batches * batch size,
+            which goes past the end of the epoch when its last batch was partial.
+        """
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        perm = torch.randperm(len(self.data_source), generator=g).tolist()
+        for position in range(self.start_index, len(perm)):
+            yield perm[position], sample_seed(self.seed, self.epoch, position)
+
+    def __len__(self):
+        # Resuming after the last (possibly partial) batch of an epoch leaves nothing to draw.
+        return max(0, len(self.data_source) - self.start_index)
+
+
+class SeededDataset(data.Dataset):
+    """Wraps a loader and seeds `random`, `numpy` and `torch` before every sample.
+
+    The global RNG states are restored afterwards, so using it with
+    `num_workers=0` does not disturb the RNG of the training loop.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        # Only called when the attribute is not found, forward to the wrapped loader.
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, item):
+        index, seed = item
+        py_state = random.getstate()
+        np_state = np.random.get_state()
+        torch_state = torch.get_rng_state()
+        try:
+            random.seed(seed)
+            np.random.seed(seed)
+            # CPU generator only, `torch.manual_seed` would also reseed CUDA.
+            torch.default_generator.manual_seed(seed)
+            return self.dataset[index]
+        finally:
+            random.setstate(py_state)
+            np.random.set_state(np_state)
+            torch.set_rng_state(torch_state)
@@ -0,0 +1,54 @@
+"""
+Frame sequences of the video hand datasets.
+
+EgoHands, GTEA and EYTH list their frames as `<clip>/<prefix><number>` or
+`<clip><number>` names. `FrameSequenceDataset` groups the frames of a loader
+split into clips and iterates them clip after clip, frames in order, telling
+which frame starts a new clip, as `StreamingSegmenter` expects.
+"""
+import os
+import re
+import collections
+
+from torch.utils import data
+
+_FRAME = re.compile(r'^(.*?)(\d+)$')
+
+
+def clip_and_frame(name):
+    """('vid4/frame', 123) from 'vid4/frame123', ('S1_Cheese_C1', 42) from 'S1_Cheese_C1_00000042'."""
+    head, tail = os.path.split(name)
+    match = _FRAME.match(tail)
+    if match is None:
+        return name, 0
+    prefix, number = match.groups()
+    return os.path.join(head, prefix.rstrip('_-')), int(number)
+
+
+class FrameSequenceDataset(data.Dataset):
+    """Frames of `dataset` in clip order, as (image, label, first frame of its clip)."""
+    def __init__(self, dataset, min_frames=1):
+        """
+        :param dataset: loader with a `files[split]` list of frame names, like `egoHandLoader`.
+        :param min_frames: clips with fewer frames are left out.
+        """
+        self.dataset = dataset
+        clips = collections.defaultdict(list)
+        for index, name in enumerate(dataset.files[dataset.split]):
+            clip, frame = clip_and_frame(name)
+            clips[clip].append((frame, index))
+        self.clips = collections.OrderedDict(
+            (clip, [index for _, index in sorted(frames)]) for clip, frames in sorted(clips.items())
+            if len(frames) >= min_frames)
+        self.order = []
+        self.first = []
+        for indices in self.clips.values():
+            self.order += indices
+            self.first += [True] + [False] * (len(indices) - 1)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, position):
+        im, lbl = self.dataset[self.order[position]][:2]
+        return im, lbl, self.first[position]
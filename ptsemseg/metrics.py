@@ -1,18 +1,77 @@
 # Adapted from score written by wkentaro
 # https://github.com/wkentaro/pytorch-fcn/blob/master/torchfcn/utils.py
+import queue
+import logging
+import threading
+
 import IPython
 import numpy as np
+import torch
 # from sklearn import metrics
 
+from ptsemseg.checkpoint import close_on_exit
+
+logger = logging.getLogger('ptsemseg')
+
 def softmax(x):
     """Compute softmax values for each sets of scores in x."""
     return np.exp(x) / np.sum(np.exp(x), axis=0)
 
+def step_ious(label_trues, step_preds, n_classes, void=False):
+    """Mean IoU of every image at every recurrent step, with one bincount for the whole batch.
+
+    Same as `runningScore(n_classes, void)` updated with a single image and step.
+        :param label_trues: [N, W, H] ground truth tensor.
+        :param step_preds: [steps, N, W, H] predicted labels, on the same device.
+        :return: [N, steps] float tensor.
+    """
+    n_steps, n_images = step_preds.shape[:2]
+    lt = label_trues.long().unsqueeze(0).expand_as(step_preds)
+    lp = step_preds.long()
+    n_matrices = n_steps * n_images
+    valid = (lt >= 0) & (lt < (n_classes - 1 if void else n_classes))
+    matrix = torch.arange(n_matrices, device=lp.device).view(n_steps, n_images, *([1] * (lp.dim() - 2)))
+    index = ((matrix * n_classes + lt) * n_classes + lp).masked_fill(valid == 0, n_matrices * n_classes ** 2)
+    hist = torch.bincount(index.reshape(-1), minlength=n_matrices * n_classes ** 2 + 1)[:-1]
+    hist = hist.view(n_steps, n_images, n_classes, n_classes).double()
+    if void:
+        hist = hist[:, :, :-1, :-1]
+
+    diag = torch.diagonal(hist, dim1=-2, dim2=-1)
+    union = hist.sum(dim=-1) + hist.sum(dim=-2) - diag
+    # nanmean over the classes, absent classes do not count.
+    present = (union > 0).double()
+    iou = (diag / union.clamp(min=1)).sum(dim=-1) / present.sum(dim=-1)
+    return iou.t()
+
+
+def mask_void_predictions(label_trues, step_preds, void_classes):
+    """Predictions set to the void label wherever the ground truth is void (ROI only).
+        :param label_trues: [N, W, H] ground truth tensor.
+        :param step_preds: [steps, N, W, H] predicted labels, on the same device.
+        :param void_classes: void label, or the list of the loader (its first one is used).
+    """
+    void = void_classes[0] if isinstance(void_classes, (list, tuple)) else void_classes
+    return step_preds.masked_fill(label_trues.unsqueeze(0) == void, void)
+
+
+def step_distances(step_outputs):
+    """L2 distance between the softmax of consecutive recurrent steps, for every image.
+        :param step_outputs: [steps, N, C, W, H] scores.
+        :return: [N, steps - 1] tensor, column k is the distance between steps k + 1 and k.
+    """
+    prob = torch.softmax(step_outputs, dim=2)
+    n_steps, n_images = prob.shape[:2]
+    return (prob[1:] - prob[:-1]).reshape(n_steps - 1, n_images, -1).norm(dim=2).t()
+
+
 class runningScore(object):
     def __init__(self, n_classes, void=False):
         self.n_classes = n_classes
         self.last_void_class = void
         self.confusion_matrix = np.zeros((n_classes, n_classes))
+        # int64 confusion matrix accumulated on the device of torch inputs, merged in `get_scores`.
+        self.device_confusion_matrix = None
         self._is_usable = False
         # self.label_trues = []
         # self.label_preds = []
@@ -22,8 +81,10 @@ class runningScore(object):
         # self.fp = np.zeros(self.break_even_threshold, np.int)
         self.confusion_matrix_at_threshold = np.zeros((self.break_even_threshold, 2, 2))
         self.break_even = 0.
-        self.n_lp = []
-        self.n_lt = []
+        # Histograms of the foreground probability, of the negative (row 0) and positive (row 1) pixels.
+        # Bin b holds the probabilities in [b / break_even_threshold, (b + 1) / break_even_threshold).
+        self.score_hist = np.zeros((2, self.break_even_threshold + 1), np.int64)
+        self.device_score_hist = None
 
     def _fast_hist(self, label_true, label_pred, n_class):
         mask = (label_true >= 0) & (label_true < n_class)
@@ -33,73 +94,64 @@ class runningScore(object):
         ).reshape(n_class, n_class)
         return hist
 
-    def compute_break_even(self):
+    def _counts_at_thresholds(self):
+        """TP, FP of the prediction `p >= i / break_even_threshold` for every threshold index i, and P, N.
+
+        As in the original thresholding, a probability in the first bin is never positive.
         """
-        Faster way to compute such thing.
-        :return:
+        self._sync()
+        neg, pos = self.score_hist.astype(np.float64)
+        # Number of pixels in bin >= b.
+        tp = np.cumsum(pos[::-1])[::-1]
+        fp = np.cumsum(neg[::-1])[::-1]
+        thresholds = np.maximum(np.arange(self.break_even_threshold + 1), 1)
+        return tp[thresholds], fp[thresholds], pos.sum(), neg.sum()
+
+    def compute_curves(self):
+        """Precision / recall and ROC curves of the foreground class, one point per threshold.
+            :return: dict of numpy arrays, `thresholds` increasing.
         """
-        assert len(self.n_lp) > 0 and len(self.n_lp) == len(self.n_lt)
-        assert np.all([l.shape == p.shape for l, p in zip(self.n_lt, self.n_lp)])
-
-        # total_lp = np.concatenate([np.expand_dims(l, axis=0) for l in self.n_lp])
-        # total_lt = np.concatenate([np.expand_dims(l, axis=0) for l in self.n_lt])
-        total_lp = np.concatenate(self.n_lp)
-        total_lp = (total_lp * self.break_even_threshold).astype(np.int)
-        total_lp = total_lp.astype(np.float) / self.break_even_threshold
-        total_lt = np.concatenate(self.n_lt)
-
-        # metrics.precision_recall_curve()
-        # complete_lp = np.concatenate(self.break_even_threshold * [np.expand_dims(total_lp, axis=0)], axis=0)
-        # cond = np.arange(0, self.break_even_threshold).astype(np.float) / self.break_even_threshold
-        # cond = np.expand_dims(cond, axis=1)
-        # filter_lp = np.where(complete_lp < cond, np.zeros(complete_lp), np.ones_like(complete_lp))
-
-        def _compute_prec_recall(confusion_matrix):
-            hist = confusion_matrix
-            acc_cls = np.diag(hist) / hist.sum(axis=1)
-            acc_cls = np.nanmean(acc_cls)
-            recall = np.diag(hist) / hist.sum(axis=0)
-            recall = np.nanmean(recall)
-            return acc_cls, recall
+        tp, fp, n_pos, n_neg = self._counts_at_thresholds()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = tp / (tp + fp)
+        recall = tp / max(n_pos, 1.)
+        fpr = fp / max(n_neg, 1.)
+        return {
+            'thresholds': np.arange(self.break_even_threshold + 1, dtype=np.float64) / self.break_even_threshold,
+            'precision': precision,
+            'recall': recall,
+            'tpr': recall,
+            'fpr': fpr,
+        }
+
+    def compute_auc(self):
+        """Area under the ROC curve, trapezoidal over the histogram bins."""
+        curves = self.compute_curves()
+        # Thresholds go from accepting everything to (past the last one) accepting nothing.
+        fpr = np.concatenate([curves['fpr'], [0.]])[::-1]
+        tpr = np.concatenate([curves['tpr'], [0.]])[::-1]
+        return float(np.trapz(tpr, fpr))
 
-        def _cut_from_threshold(in_tensor, th):
-            t = np.copy(in_tensor)
-            t[t < th] = 0
-            t[t != 0] = 1
-            t = t.astype(np.int)
-            return t
+    def compute_break_even(self):
+        """
+        P/R break even point from the score histograms.
 
-        def _binary_search_split(start, end):
-            # break condition
-            if start + 1 == end or start == end:
-
-                th = float(start / self.break_even_threshold)
-                p, r = _compute_prec_recall(
-                    self._fast_hist(
-                        total_lt,
-                        _cut_from_threshold(total_lp, th),
-                        2
-                    )
-                )
-                print("End point reach of binary search. found p {} r {} at {}".format(p, r, th))
-                return p, r, th
-            curr = (start + end) // 2
-            th = float(curr) / self.break_even_threshold
-            p, r = _compute_prec_recall(
-                self._fast_hist(
-                    total_lt,
-                    _cut_from_threshold(total_lp, th),
-                    2
-                )
-            )
-            if r < p:
-                # print(f" r < p. go at {curr} , {end}")
-                return _binary_search_split(curr, end)
-            else:
-                # print(f" r >= p. go at {start} , {curr}")
-                return _binary_search_split(start, curr)
-
-        prec, recall, thresh = _binary_search_split(0, self.break_even_threshold)
+        p and r are the class-averaged precision / recall of the confusion
+        matrix [[TN, FP], [FN, TP]] at each threshold; the break even is the
+        last threshold where r < p.
+        :return: p, r, threshold
+        """
+        assert self.score_hist.sum() > 0 or self.device_score_hist is not None
+        tp, fp, n_pos, n_neg = self._counts_at_thresholds()
+        fn = n_pos - tp
+        tn = n_neg - fp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precs = np.nanmean(np.stack([tn / (tn + fp), tp / (fn + tp)]), axis=0)
+            recalls = np.nanmean(np.stack([tn / (tn + fn), tp / (fp + tp)]), axis=0)
+
+        crossing = np.nonzero(recalls[1:self.break_even_threshold] < precs[1:self.break_even_threshold])[0]
+        i = int(crossing[-1]) + 1 if len(crossing) else 0
+        prec, recall, thresh = precs[i], recalls[i], float(i) / self.break_even_threshold
         print('prec {}, recall {}'.format(prec, recall))
         return prec, recall, thresh
 
@@ -129,8 +181,36 @@ class runningScore(object):
         # Find the closest splitting point.
         return float(crossing / self.break_even_threshold), num_crossing
 
+    def _update_torch(self, label_trues, label_preds):
+        """Accumulates a batch of label tensors on their device, without any host sync.
+            :param label_trues: [N, W, H] ground truth tensor.
+            :param label_preds: [N, W, H] predicted labels, on the same device.
+        """
+        n = self.n_classes
+        lt = label_trues.reshape(-1).long()
+        lp = label_preds.reshape(-1).long()
+        mask = (lt >= 0) & (lt < (n - 1 if self.last_void_class else n))
+        # Masked pixels go to an extra bin rather than being indexed out, which would sync.
+        index = (n * lt + lp).masked_fill(mask == 0, n ** 2)
+        hist = torch.bincount(index, minlength=n ** 2 + 1)[:n ** 2].view(n, n)
+        if self.device_confusion_matrix is None:
+            self.device_confusion_matrix = hist
+        else:
+            self.device_confusion_matrix += hist
+
+    def _sync(self):
+        if self.device_confusion_matrix is not None:
+            self.confusion_matrix += self.device_confusion_matrix.cpu().numpy()
+            self.device_confusion_matrix = None
+        if self.device_score_hist is not None:
+            self.score_hist += self.device_score_hist.cpu().numpy()
+            self.device_score_hist = None
+
     def update(self, label_trues, label_preds, step=-1):
         self._is_usable = True
+        if isinstance(label_trues, torch.Tensor):
+            self._update_torch(label_trues, label_preds)
+            return
         for lt, lp in zip(label_trues, label_preds):
             if self.last_void_class:
                 lp = lp[lt < self.n_classes -1]
@@ -186,14 +266,35 @@ class runningScore(object):
             label_trues = label_trues[-1]
             label_preds = label_preds[-1]
 
+        if isinstance(label_trues, torch.Tensor):
+            self._update_raw_torch(label_trues, label_preds)
+            return
+
         for lt, lp in zip(label_trues, label_preds):
             # such only support for binary
             # remove this -1 only take the first two classes
             n_lp = lp[:2, lt < 2]
             n_lt = lt[lt < 2]
             n_lp = softmax(n_lp)[1, :]
-            self.n_lp.append(n_lp)
-            self.n_lt.append(n_lt)
+            bins = np.clip((n_lp * self.break_even_threshold).astype(np.int64), 0, self.break_even_threshold)
+            self.score_hist += np.bincount(
+                n_lt.astype(np.int64) * (self.break_even_threshold + 1) + bins,
+                minlength=2 * (self.break_even_threshold + 1),
+            ).reshape(2, -1)
+
+    def _update_raw_torch(self, label_trues, label_preds):
+        """`update_raw` on the device, label_preds are [N, C, W, H] scores."""
+        n_bins = self.break_even_threshold + 1
+        lt = label_trues.long()
+        prob = torch.softmax(label_preds[:, :2], dim=1)[:, 1]
+        bins = (prob * self.break_even_threshold).long().clamp(0, self.break_even_threshold)
+        valid = (lt >= 0) & (lt < 2)
+        index = (lt * n_bins + bins).masked_fill(valid == 0, 2 * n_bins).reshape(-1)
+        hist = torch.bincount(index, minlength=2 * n_bins + 1)[:2 * n_bins].view(2, n_bins)
+        if self.device_score_hist is None:
+            self.device_score_hist = hist
+        else:
+            self.device_score_hist += hist
 
     def get_scores(self):
         """Returns accuracy score evaluation result.
@@ -203,6 +304,7 @@ class runningScore(object):
             - fwavacc
             - AUC and the P-R break even point.
         """
+        self._sync()
 
         if self.last_void_class:
             hist = self.confusion_matrix[:-1, :-1]
@@ -240,6 +342,91 @@ class runningScore(object):
 
     def reset(self):
         self.confusion_matrix = np.zeros((self.n_classes, self.n_classes))
+        self.device_confusion_matrix = None
+        self.score_hist = np.zeros((2, self.break_even_threshold + 1), np.int64)
+        self.device_score_hist = None
+
+
+class fovScore(object):
+    """DRIVE benchmark metrics inside the field of view, for every recurrent step.
+
+    Vessel probabilities are binned into per-step histograms of the positive and
+    negative FOV pixels, accumulated on the device. AUC-ROC and Se / Sp / Acc / F1
+    at `threshold` all come from their cumulative sums.
+    """
+    def __init__(self, n_steps, n_bins=1000, threshold=0.5):
+        """
+        :param n_steps: number of recurrent steps evaluated.
+        :param n_bins: histogram bins, `threshold * n_bins` should be an integer to threshold exactly.
+        """
+        self.n_steps = n_steps
+        self.n_bins = n_bins
+        self.threshold = threshold
+        self.reset()
+
+    def update(self, probs, labels, fov=None):
+        """
+        :param probs: [steps, N, W, H] vessel probabilities, or a list of [N, W, H] (tensors or numpy).
+        :param labels: [N, W, H] ground truth, 1 for vessels.
+        :param fov: [N, W, H] field-of-view mask, non-zero inside. None to use every pixel.
+        """
+        if isinstance(probs, (list, tuple)):
+            probs = torch.stack([torch.as_tensor(p) for p in probs])
+        probs = torch.as_tensor(probs)
+        labels = torch.as_tensor(labels).to(probs.device).long()
+        n_steps, n = probs.shape[0], self.n_bins + 1
+        assert n_steps == self.n_steps, "Expected {} steps, got {}".format(self.n_steps, n_steps)
+
+        valid = (labels >= 0) & (labels < 2)
+        if fov is not None:
+            valid = valid & (torch.as_tensor(fov).to(probs.device) > 0)
+        bins = (probs * self.n_bins).long().clamp(0, self.n_bins)
+        steps = torch.arange(n_steps, device=probs.device).view(-1, *([1] * labels.dim()))
+        index = ((steps * 2 + labels) * n + bins).masked_fill(valid.unsqueeze(0) == 0, n_steps * 2 * n)
+        hist = torch.bincount(index.reshape(-1), minlength=n_steps * 2 * n + 1)[:-1].view(n_steps, 2, n)
+        if self.device_hist is None:
+            self.device_hist = hist
+        else:
+            self.device_hist += hist
+
+    def get_scores(self):
+        """Returns one dict per step with AUC, Se, Sp, Acc and F1 inside the FOV."""
+        if self.device_hist is not None:
+            self.hist += self.device_hist.cpu().numpy()
+            self.device_hist = None
+        neg, pos = self.hist[:, 0].astype(np.float64), self.hist[:, 1].astype(np.float64)
+        # Pixels with a probability in bin >= b, [steps, bins].
+        tp_ge = np.cumsum(pos[:, ::-1], axis=1)[:, ::-1]
+        fp_ge = np.cumsum(neg[:, ::-1], axis=1)[:, ::-1]
+        n_pos, n_neg = pos.sum(axis=1), neg.sum(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zeros = np.zeros((self.n_steps, 1))
+            tpr = np.concatenate([tp_ge, zeros], axis=1) / n_pos[:, None]
+            fpr = np.concatenate([fp_ge, zeros], axis=1) / n_neg[:, None]
+            auc = np.trapz(tpr[:, ::-1], fpr[:, ::-1], axis=1)
+
+            t = int(np.ceil(self.threshold * self.n_bins))
+            tp, fp = tp_ge[:, t], fp_ge[:, t]
+            fn, tn = n_pos - tp, n_neg - fp
+            se = tp / n_pos
+            sp = tn / n_neg
+            acc = (tp + tn) / (n_pos + n_neg)
+            f1 = 2 * tp / (2 * tp + fp + fn)
+        return [
+            {
+                "AUC : \t": auc[k],
+                "Se : \t": se[k],
+                "Sp : \t": sp[k],
+                "Acc : \t": acc[k],
+                "F1 : \t": f1[k],
+            }
+            for k in range(self.n_steps)
+        ]
+
+    def reset(self):
+        self.hist = np.zeros((self.n_steps, 2, self.n_bins + 1), np.int64)
+        self.device_hist = None
 
 
 class averageMeter(object):
@@ -259,3 +446,57 @@ class averageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+
+
+class MetricsWorker(object):
+    """Runs metric updates on a background thread, so the forward loop never waits on scoring.
+
+    `submit` queues a call and returns at once, unless `max_pending` calls are
+    already waiting, in which case it blocks until the worker catches up. Calls
+    run in submission order, so scorers are only ever updated from the worker:
+    call `wait` before reading their scores.
+    """
+    def __init__(self, max_pending=8):
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='metrics-worker', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues `fn(*args, **kwargs)`. Inputs should not be modified by the caller afterwards."""
+        if self.error is not None:
+            raise self.error
+        self._queue.put((fn, args, kwargs))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                fn, args, kwargs = item
+                if self.error is None:
+                    fn(*args, **kwargs)
+            except Exception as e:
+                logger.error("Metric update failed: {}".format(e))
+                self.error = e
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        """Blocks until every submitted update has run."""
+        self._queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        close_on_exit(self, exc_type)
@@ -1,4 +1,5 @@
 import copy
+import torch
 import torchvision.models as models
 from ptsemseg.models.rcnn import *
 from ptsemseg.models.rcnn2 import *
@@ -81,12 +82,51 @@ def get_model(model_dict, n_classes, args, version=None):
         model = model(n_classes=n_classes, **param_dict)
     elif name == 'deeplabv3':
         model = model(n_classes=n_classes, backbone='resnet')
+    elif name == 'JointSegCTLDireNetRecurrent':
+        model = model(img_ch=4, coarse_steps=param_dict.get('coarse_steps', 0),
+                      coarse_scale=param_dict.get('coarse_scale', 0.5))
     else:
         model = model(img_ch=4)
 
     return model
 
 
+def get_initial_states(arch, images, hidden_size, n_classes):
+    """Initial recurrent states fed to the model together with `images`.
+
+    :param arch: cfg['model']['arch']
+    :param images: input batch [N, C, W, H]
+    :return: tuple of extra forward arguments, empty for non-recurrent models.
+    """
+    N, W, H = images.shape[0], images.shape[2], images.shape[3]
+    kwargs = {'dtype': torch.float32, 'device': images.device}
+    if arch in ['reclast']:
+        return (torch.ones([N, hidden_size, W, H], **kwargs),)
+
+    elif arch in ['recmid']:
+        w, h = W // 2 ** 4, H // 2 ** 4
+        return (torch.ones([N, hidden_size, w, h], **kwargs),)
+
+    elif arch in ['dru', 'sru']:
+        w, h = W // 2 ** 4, H // 2 ** 4
+        return (torch.ones([N, hidden_size, w, h], **kwargs),
+                torch.ones([N, n_classes, W, H], **kwargs))
+
+    elif arch in ['druvgg16', 'druresnet50', 'druresnet50bn', 'druresnet50syncedbn']:
+        w, h = W // 2 ** 4, H // 2 ** 4
+        if arch in ['druresnet50', 'druresnet50bn', 'druresnet50syncedbn']:
+            w, h = W // 2 ** 5, H // 2 ** 5
+        return (torch.ones([N, hidden_size, w, h], **kwargs),
+                torch.zeros([N, n_classes, W, H], **kwargs))
+
+    return ()
+
+
+def model_forward(model, arch, images, hidden_size, n_classes):
+    """Runs `model` on `images`, with the initial states its architecture expects."""
+    return model(images, *get_initial_states(arch, images, hidden_size, n_classes))
+
+
 def _get_model_instance(name):
     try:
         return {
@@ -97,10 +97,18 @@ class dru(nn.Module):
                  is_deconv=True,
                  in_channels=3,
                  is_batchnorm=True,
+                 coarse_steps=0,
+                 coarse_scale=0.5,
                  ):
+        """
+        :param coarse_steps: number of first steps run on the input downsampled by `coarse_scale`,
+            their segmentation and hidden state are upsampled for the full resolution steps.
+        """
         super(dru, self).__init__()
         self.args = args
         self.steps = steps
+        self.coarse_steps = coarse_steps
+        self.coarse_scale = coarse_scale
         self.feature_scale = feature_scale
         self.hidden_size = hidden_size
         self.in_channels = in_channels
@@ -139,31 +147,45 @@ class dru(nn.Module):
         # final conv (without any concat)
         self.conv_down = nn.Conv2d(filters[0], n_classes, 1)
 
-    def forward(self, inputs, h, s):
-        list_st = []
-        for i in range(self.steps):
-            stacked_inputs = torch.cat([inputs, s], dim=1)
+    def step(self, inputs, h, s):
+        """One recurrent step, returns the new hidden state and segmentation (h, s)."""
+        stacked_inputs = torch.cat([inputs, s], dim=1)
 
-            conv1 = self.conv1(stacked_inputs)
-            maxpool1 = self.maxpool1(conv1)
+        conv1 = self.conv1(stacked_inputs)
+        maxpool1 = self.maxpool1(conv1)
 
-            conv2 = self.conv2(maxpool1)
-            maxpool2 = self.maxpool2(conv2)
+        conv2 = self.conv2(maxpool1)
+        maxpool2 = self.maxpool2(conv2)
 
-            conv3 = self.conv3(maxpool2)
-            maxpool3 = self.maxpool3(conv3)
+        conv3 = self.conv3(maxpool2)
+        maxpool3 = self.maxpool3(conv3)
 
-            conv4 = self.conv4(maxpool3)
-            maxpool4 = self.maxpool4(conv4)
+        conv4 = self.conv4(maxpool3)
+        maxpool4 = self.maxpool4(conv4)
 
-            h = self.gru(maxpool4, h)
-            up4 = self.up_concat4(conv4, h)
-            up3 = self.up_concat3(conv3, up4)
-            up2 = self.up_concat2(conv2, up3)
-            up1 = self.up_concat1(conv1, up2)
+        h = self.gru(maxpool4, h)
+        up4 = self.up_concat4(conv4, h)
+        up3 = self.up_concat3(conv3, up4)
+        up2 = self.up_concat2(conv2, up3)
+        up1 = self.up_concat1(conv1, up2)
 
-            s = self.conv_down(up1)
-            list_st += [s]
+        s = self.conv_down(up1)
+        return h, s
+
+    def forward(self, inputs, h, s):
+        list_st = []
+        size = inputs.shape[2:]
+        stride = size[0] // h.shape[2]
+        scaled_inputs = {1.: inputs}
+        for scale in resolution_schedule(self.steps, self.coarse_steps, self.coarse_scale):
+            step_size = scaled_size(size, scale)
+            if scale not in scaled_inputs:
+                scaled_inputs[scale] = resize_to(inputs, step_size)
+            h = resize_to(h, (step_size[0] // stride, step_size[1] // stride))
+            s = resize_to(s, step_size)
+            h, s = self.step(scaled_inputs[scale], h, s)
+            # The outputs of the coarse steps are scored at full resolution.
+            list_st += [resize_to(s, size)]
 
         return list_st
 
@@ -276,65 +276,28 @@ class pspnet(nn.Module):
 
     def tile_predict(self, imgs, include_flip_mode=True):
         """
-        Predict by takin overlapping tiles from the image.
+        Predict by takin overlapping tiles from the image, with `SlidingWindow`.
 
-        Strides are adaptively computed from the imgs shape
-        and input size
+        The original and flipped copies of a tile are softmaxed, then averaged. Tiles are laid every
+        2/3 of a tile and the probabilities of overlapping tiles are averaged. Before `SlidingWindow`,
+        tiles were spread evenly over the image and a pixel kept the probabilities of the last tile
+        covering it, so scores differ slightly where tiles overlap.
 
         :param imgs: torch.Tensor with shape [N, C, H, W] in BGR format
         :param side: int with side length of model input
         :param n_classes: int with number of classes in seg output.
         """
 
-        side_x, side_y = self.input_size
-        n_classes = self.n_classes
-        n_samples, c, h, w = imgs.shape
-        # n = int(max(h,w) / float(side) + 1)
-        n_x = int(h / float(side_x) + 1)
-        n_y = int(w / float(side_y) + 1)
-        stride_x = (h - side_x) / float(n_x)
-        stride_y = (w - side_y) / float(n_y)
-
-        x_ends = [[int(i * stride_x), int(i * stride_x) + side_x] for i in range(n_x + 1)]
-        y_ends = [[int(i * stride_y), int(i * stride_y) + side_y] for i in range(n_y + 1)]
-
-        pred = np.zeros([n_samples, n_classes, h, w])
-        count = np.zeros([h, w])
-
-        slice_count = 0
-        for sx, ex in x_ends:
-            for sy, ey in y_ends:
-                slice_count += 1
-
-                imgs_slice = imgs[:, :, sx:ex, sy:ey]
-                if include_flip_mode:
-                    imgs_slice_flip = torch.from_numpy(
-                        np.copy(imgs_slice.cpu().numpy()[:, :, :, ::-1])
-                    ).float()
-
-                is_model_on_cuda = next(self.parameters()).is_cuda
-
-                inp = Variable(imgs_slice, volatile=True)
-                if include_flip_mode:
-                    flp = Variable(imgs_slice_flip, volatile=True)
-
-                if is_model_on_cuda:
-                    inp = inp.cuda()
-                    if include_flip_mode:
-                        flp = flp.cuda()
-
-                psub1 = F.softmax(self.forward(inp), dim=1).data.cpu().numpy()
-                if include_flip_mode:
-                    psub2 = F.softmax(self.forward(flp), dim=1).data.cpu().numpy()
-                    psub = (psub1 + psub2[:, :, :, ::-1]) / 2.0
-                else:
-                    psub = psub1
-
-                pred[:, :, sx:ex, sy:ey] = psub
-                count[sx:ex, sy:ey] += 1.0
-
-        score = (pred / count[None, None, ...]).astype(np.float32)
-        return score / np.expand_dims(score.sum(axis=1), axis=1)
+        # Imported here, the inference package depends on ptsemseg.models.
+        from ptsemseg.inference.tiling import SlidingWindow
+
+        engine = SlidingWindow(self, 'pspnet', tile_size=self.input_size, overlap=1. / 3, batch_size=1,
+                               blending='uniform', n_classes=self.n_classes,
+                               transforms=['identity', 'hflip'] if include_flip_mode else ['identity'],
+                               activation=lambda x: F.softmax(x, dim=1), output_device=torch.device('cpu'))
+        with torch.no_grad():
+            score = engine(imgs)
+        return (score / score.sum(dim=1, keepdim=True)).numpy()
 
 
 # For Testing Purposes only
@@ -2,7 +2,7 @@ import IPython
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
-from .utils import unetConv2, unetConv1
+from .utils import unetConv2, unetConv1, resolution_schedule, scaled_size, resize_to
 from .unet import UnetEncoder, UnetDecoder, GeneralUNet_v2,unet
 
 
@@ -574,24 +574,35 @@ class myUnet(nn.Module):
         return out
 
 class JointSegCTLDireNetRecurrent(nn.Module):
-    def __init__(self, img_ch=2, output_ch=1,dire_classes=19):
+    def __init__(self, img_ch=2, output_ch=1,dire_classes=19, coarse_steps=0, coarse_scale=0.5):
+        """
+        :param coarse_steps: number of first steps run on the input downsampled by `coarse_scale`.
+        """
         super(JointSegCTLDireNetRecurrent, self).__init__()
         self.rnn_steps = 4
+        self.coarse_steps = coarse_steps
+        self.coarse_scale = coarse_scale
         self.unet=myUnet(img_ch,output_ch)
 
     def forward(self, x):
         # dt=[]
         # dire=[]
         list_seg = []
+        size = x.shape[2:]
+        scaled_x = {1.: x}
         tempSeg=Variable(torch.zeros(x.size()[0],1,x.size()[2],x.size()[3])).cuda()
-        for i in range(self.rnn_steps):
-            
-            stack_inputs = torch.cat([x, tempSeg], dim=1)            
+        for scale in resolution_schedule(self.rnn_steps, self.coarse_steps, self.coarse_scale):
+            step_size = scaled_size(size, scale)
+            if scale not in scaled_x:
+                scaled_x[scale] = resize_to(x, step_size)
+            tempSeg = resize_to(tempSeg, step_size)
+
+            stack_inputs = torch.cat([scaled_x[scale], tempSeg], dim=1)
             seg = self.unet(stack_inputs)
 
             # tempSeg=F.sigmoid(seg)
             tempSeg=seg
-            list_seg+=[seg]
+            list_seg+=[resize_to(seg, size)]
 
 
         return list_seg
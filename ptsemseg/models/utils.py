@@ -964,3 +964,23 @@ def get_upsampling_weight(in_channels, out_channels, kernel_size):
                       dtype=np.float64)
     weight[range(in_channels), range(out_channels), :, :] = filt
     return torch.from_numpy(weight).float()
+
+
+def resolution_schedule(steps, coarse_steps=0, coarse_scale=0.5):
+    """Scale of the input at every recurrent step, the last step always runs at full resolution."""
+    coarse_steps = min(coarse_steps, steps - 1) if coarse_scale != 1 else 0
+    return [coarse_scale] * coarse_steps + [1.] * (steps - coarse_steps)
+
+
+def scaled_size(size, scale, multiple=16):
+    """Spatial size `size` scaled by `scale`, rounded down to a multiple of the network stride."""
+    if scale == 1:
+        return tuple(size)
+    return tuple(max(multiple, int(s * scale) // multiple * multiple) for s in size)
+
+
+def resize_to(x, size, mode="bilinear"):
+    """Resizes the [N, C, H, W] tensor `x` to `size`, a no-op if it already has that size."""
+    if tuple(x.shape[2:]) == tuple(size):
+        return x
+    return F.interpolate(x, size=size, mode=mode, align_corners=False)
@@ -0,0 +1,343 @@
+"""
+Local parallel sweeps over the `train_parser` flags.
+
+A sweep is a YAML file with a `grid` of flag values and `fixed` flags shared by
+every trial, e.g.
+
+    script: train_drive.py
+    slots: 4
+    cpus_per_trial: 4
+    gpus: [0, 1]
+    fixed:
+        config: configs/dataset/drive.yml
+        model: dru
+        prefix: ablation
+    grid:
+        steps: [3, 6]
+        hidden_size: [32, 64]
+        gate: [2, 3]
+
+Each trial runs as its own process. `slots` trials run concurrently, each slot
+pinned to its own set of CPU cores, with the BLAS / OpenMP thread pools limited
+to that many threads.
+
+With a `prune` section (`eta`, `min_fraction`), trials are stopped early by
+successive halving on the validation scores they report during training.
+"""
+import os
+import csv
+import sys
+import json
+import math
+import time
+import hashlib
+import logging
+import itertools
+import subprocess
+
+import yaml
+
+logger = logging.getLogger('ptsemseg')
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+SCALARS_FILE = 'val_scalars.jsonl'
+PRUNED_FILE = 'PRUNED'
+# Scripts taking --run_id / --resume, laying out their runs like train_drive.py and reporting
+# the validation scalars. train_hand.py does none of it.
+SWEEP_SCRIPTS = ['train_drive.py']
+
+
+def check_script(script):
+    """Raises a ValueError if the trials can not be run with `script`."""
+    if os.path.basename(script) not in SWEEP_SCRIPTS:
+        raise ValueError("Sweeps only run {}, not {}".format(', '.join(SWEEP_SCRIPTS), script))
+
+
+def append_scalars(logdir, iteration, scalars):
+    """Appends the validation scalars of `iteration` to the run directory, for the sweep to read.
+        :param scalars: {name: value}, names are stripped from the tabs / colons of `get_scores`.
+    """
+    record = {k.split(':')[0].strip(): float(v) for k, v in scalars.items()}
+    record['iter'] = int(iteration)
+    with open(os.path.join(logdir, SCALARS_FILE), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def read_scalars(logdir):
+    """Returns the records written by `append_scalars`, sorted by iteration."""
+    path = os.path.join(logdir, SCALARS_FILE)
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Line being written right now.
+                continue
+    return sorted(records, key=lambda r: r['iter'])
+
+
+def expand_grid(grid):
+    """Cartesian product of a {flag: [values]} dict, in a stable order."""
+    keys = sorted(grid.keys())
+    values = [grid[k] if isinstance(grid[k], (list, tuple)) else [grid[k]] for k in keys]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def trial_run_id(params):
+    """Deterministic run id of a trial, so its logdir and results can be found again."""
+    key = yaml.safe_dump(params, default_flow_style=True)
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % 10 ** 8 + 1
+
+
+def params_to_argv(params, parser):
+    """Converts {flag: value} to command line arguments, checking the flags exist in `parser`."""
+    argv = []
+    for k in sorted(params.keys()):
+        flag = '--' + k
+        if flag not in parser._option_string_actions:
+            raise ValueError("Unknown flag {} for the training script".format(flag))
+        action = parser._option_string_actions[flag]
+        if action.nargs == 0:
+            # store_true / store_false flags
+            if params[k]:
+                argv.append(flag)
+        else:
+            argv.append('{}={}'.format(flag, params[k]))
+    return argv
+
+
+def slot_cpus(slot, cpus_per_trial, available=None):
+    """CPU cores of a slot, slots take consecutive blocks of the cores this process may use."""
+    available = sorted(available if available is not None else os.sched_getaffinity(0))
+    if cpus_per_trial <= 0:
+        return available
+    start = (slot * cpus_per_trial) % len(available)
+    return [available[(start + i) % len(available)] for i in range(min(cpus_per_trial, len(available)))]
+
+
+class Trial(object):
+    def __init__(self, params, argv, logdir, result_path, train_iters=None):
+        """
+        :param params: the grid values of this trial.
+        :param argv: complete command line flags of the training script.
+        :param logdir: run directory of the trial.
+        :param result_path: results/*.yml written by the validation at the end of training.
+        :param train_iters: total training iterations, the budget used for pruning.
+        """
+        self.params = params
+        self.argv = argv
+        self.logdir = logdir
+        self.result_path = result_path
+        self.train_iters = train_iters
+        self.process = None
+        self.slot = None
+        self.status = 'pending'
+
+    @property
+    def name(self):
+        return '-'.join('{}{}'.format(k, v) for k, v in sorted(self.params.items()))
+
+    def is_done(self):
+        return os.path.exists(self.result_path)
+
+    def is_pruned(self):
+        return os.path.exists(os.path.join(self.logdir, PRUNED_FILE))
+
+
+class SuccessiveHalvingPruner(object):
+    """Asynchronous successive halving (ASHA) on the in-training validation scores.
+
+    Rungs are placed at `min_fraction * train_iters * eta ** k` iterations. When a
+    trial reaches a rung, its best score so far is compared with the scores every
+    other trial had at that rung: it goes on only if it ranks in the top
+    `1 / eta` of them. Nothing is pruned before `eta` trials reached the rung.
+    A trial is judged once per rung, trials arriving later at a rung never undo
+    the promotion of the ones before them.
+    """
+    def __init__(self, eta=3, min_fraction=0.1, metric='Mean IoU'):
+        self.eta = eta
+        self.min_fraction = min_fraction
+        self.metric = metric
+        # {rung budget: {trial name: score}}
+        self.rungs = {}
+        # {(trial name, rung budget): stopped}
+        self.decisions = {}
+
+    def budgets(self, train_iters):
+        budgets = []
+        budget = self.min_fraction * train_iters
+        while budget < train_iters:
+            budgets.append(int(math.ceil(budget)))
+            budget *= self.eta
+        return budgets
+
+    def _record(self, trial):
+        records = read_scalars(trial.logdir)
+        if not records or trial.train_iters is None:
+            return []
+        reached = []
+        for budget in self.budgets(trial.train_iters):
+            scores = [r[self.metric] for r in records if r['iter'] <= budget and self.metric in r]
+            if records[-1]['iter'] < budget or not scores:
+                break
+            self.rungs.setdefault(budget, {})[trial.name] = max(scores)
+            reached.append(budget)
+        return reached
+
+    def should_stop(self, trial, trials):
+        """
+        :param trial: a running trial.
+        :param trials: all the trials of the sweep, finished ones included.
+        """
+        for t in trials:
+            if t is not trial:
+                self._record(t)
+        for budget in self._record(trial):
+            key = (trial.name, budget)
+            if key not in self.decisions:
+                self.decisions[key] = self._judge(trial, budget)
+            if self.decisions[key]:
+                return True
+        return False
+
+    def _judge(self, trial, budget):
+        """Whether `trial`, newly arrived at the rung `budget`, is out of the top `1 / eta`."""
+        scores = self.rungs[budget]
+        if len(scores) < self.eta:
+            return False
+        n_keep = max(1, len(scores) // self.eta)
+        cutoff = sorted(scores.values(), reverse=True)[n_keep - 1]
+        if scores[trial.name] < cutoff:
+            logger.info("Pruning {} at iter {}: {} {:.4f} < top-{} cutoff {:.4f}".format(
+                trial.name, budget, self.metric, scores[trial.name], n_keep, cutoff))
+            return True
+        return False
+
+
+class SweepRunner(object):
+    """Runs trials in a fixed number of slots, one process per trial."""
+    def __init__(self, trials, script, slots=1, cpus_per_trial=0, gpus=None, log_dir='logs/sweep',
+                 poll_interval=5., pruner=None):
+        self.trials = trials
+        self.pruner = pruner
+        check_script(script)
+        self.script = script
+        self.slots = slots
+        self.cpus_per_trial = cpus_per_trial
+        self.gpus = gpus or []
+        self.log_dir = log_dir
+        self.poll_interval = poll_interval
+
+    def _launch(self, trial, slot):
+        cpus = slot_cpus(slot, self.cpus_per_trial)
+        env = dict(os.environ)
+        for var in THREAD_ENV_VARS:
+            env[var] = str(len(cpus))
+        if self.gpus:
+            env['CUDA_VISIBLE_DEVICES'] = str(self.gpus[slot % len(self.gpus)])
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        log_path = os.path.join(self.log_dir, trial.name + '.log')
+        cmd = [sys.executable, self.script] + trial.argv
+        logger.info("Slot {} (cpus {}): {}".format(slot, cpus, ' '.join(cmd)))
+        with open(log_path, 'a') as log_file:
+            trial.process = subprocess.Popen(cmd, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+                                             preexec_fn=lambda: os.sched_setaffinity(0, cpus))
+        trial.slot = slot
+        trial.status = 'running'
+
+    def _finish(self, trial):
+        returncode = trial.process.returncode
+        if trial.status == 'running':
+            trial.status = 'done' if returncode == 0 and trial.is_done() else 'failed'
+        logger.info("Trial {} {} (exit code {})".format(trial.name, trial.status, returncode))
+
+    def on_poll(self, running):
+        """Called at every poll with the running trials, stops the ones the pruner gives up on."""
+        if self.pruner is None:
+            return
+        for trial in running:
+            if trial.process.poll() is None and self.pruner.should_stop(trial, self.trials):
+                trial.status = 'pruned'
+                open(os.path.join(trial.logdir, PRUNED_FILE), 'w').close()
+                trial.process.terminate()
+
+    def run(self):
+        pending = []
+        for trial in self.trials:
+            if trial.is_done():
+                logger.info("Skipping {}, results found at {}".format(trial.name, trial.result_path))
+                trial.status = 'done'
+            elif trial.is_pruned():
+                logger.info("Skipping {}, pruned in a previous sweep".format(trial.name))
+                trial.status = 'pruned'
+            else:
+                pending.append(trial)
+
+        running = []
+        free_slots = list(range(self.slots))
+        try:
+            while pending or running:
+                while pending and free_slots:
+                    trial = pending.pop(0)
+                    self._launch(trial, free_slots.pop(0))
+                    running.append(trial)
+
+                time.sleep(self.poll_interval)
+                self.on_poll(running)
+                for trial in [t for t in running if t.process.poll() is not None]:
+                    self._finish(trial)
+                    running.remove(trial)
+                    free_slots.append(trial.slot)
+        except KeyboardInterrupt:
+            for trial in running:
+                trial.process.terminate()
+            raise
+        return self.trials
+
+
+def _flatten(d, prefix=''):
+    flat = {}
+    for k, v in d.items():
+        key = '{}/{}'.format(prefix, k) if prefix else str(k)
+        if isinstance(v, dict):
+            flat.update(_flatten(v, key))
+        else:
+            flat[key] = v
+    return flat
+
+
+def collect_results(trials, out_path=None):
+    """Gathers the results/*.yml of the trials into one table, written as csv to `out_path`.
+
+    :return: list of rows, one dict per trial with its parameters and flattened metrics.
+    """
+    rows = []
+    for trial in trials:
+        row = dict(trial.params)
+        row['status'] = trial.status
+        row['logdir'] = trial.logdir
+        if trial.is_done():
+            with open(trial.result_path) as f:
+                row.update(_flatten(yaml.load(f, Loader=yaml.Loader) or {}))
+        records = read_scalars(trial.logdir)
+        if records:
+            row['last_iter'] = records[-1]['iter']
+            row['last_val_iou'] = records[-1].get('Mean IoU')
+        rows.append(row)
+
+    if out_path is not None and rows:
+        columns = []
+        for row in rows:
+            columns += [k for k in row.keys() if k not in columns]
+        os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+        with open(out_path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
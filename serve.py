@@ -0,0 +1,61 @@
+"""
+Serve a trained model over a local HTTP endpoint, with dynamic batching.
+
+The model and its checkpoint are loaded once; concurrent requests are batched
+together (see `ptsemseg/inference/server.py`).
+
+python serve.py --config=runs/drive/.../config.yaml --model_path=runs/drive/.../dru_drive_best_model.pkl --port=8000
+curl --data-binary @01_test.tif "http://127.0.0.1:8000/predict?output=mask&steps=2" -o 01_test.png
+"""
+import logging
+
+import yaml
+import torch
+
+from ptsemseg.inference.server import load_model, DynamicBatcher, SegmentationService, make_server
+from utils_drive import validate_parser
+
+logger = logging.getLogger('ptsemseg')
+
+
+if __name__ == "__main__":
+    parser = validate_parser()
+    parser.add_argument("--host", nargs="?", type=str, default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", nargs="?", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--n_classes", nargs="?", type=int, default=2, help="number of classes of the model")
+    parser.add_argument("--max_batch_size", nargs="?", type=int, default=8, help="largest dynamic batch")
+    parser.add_argument("--max_latency", nargs="?", type=float, default=10.,
+                        help="milliseconds a request waits for its batch to fill, from its arrival")
+    parser.add_argument("--timeout", nargs="?", type=float, default=60., help="seconds before a request fails")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    with open(args.config) as fp:
+        cfg = yaml.load(fp, Loader=yaml.Loader)
+    if args.model:
+        cfg['model']['arch'] = args.model
+    arch = cfg['model']['arch']
+    device = torch.device(args.device)
+
+    model = load_model(cfg['model'], args.n_classes, args, args.model_path, device)
+    logger.info("Loaded {} from {}".format(arch, args.model_path))
+
+    # Same input size and scaling as the loader of the dataset, DRIVE images are fed in [0, 255].
+    img_size = None
+    if cfg['data'].get('img_rows', 'same') != 'same':
+        img_size = (cfg['data']['img_rows'], cfg['data']['img_cols'])
+    img_norm = args.img_norm and cfg['data']['dataset'] not in ['drive']
+    service = SegmentationService(model, arch, args, args.n_classes, device, img_size=img_size, img_norm=img_norm)
+
+    batcher = DynamicBatcher(service.run_batch, max_batch_size=args.max_batch_size,
+                             max_latency=args.max_latency / 1000.)
+    server = make_server(service, batcher, args.host, args.port, timeout=args.timeout)
+    logger.info("Serving {} on http://{}:{}".format(arch, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
@@ -16,9 +16,10 @@ from torch.backends import cudnn
 from torch.utils import data
 
 from ptsemseg.models import get_model
+from ptsemseg.inference import tta_forward, tta_transforms
 from ptsemseg.loader import get_loader, get_void_class
 from ptsemseg.utils import get_logger, clean_logger
-from ptsemseg.metrics import runningScore
+from ptsemseg.metrics import runningScore, step_ious, step_distances, mask_void_predictions
 from ptsemseg.utils import convert_state_dict
 from utils import validate_parser
 
@@ -29,15 +30,19 @@ from utils import validate_parser
 
 
 def stats(iou, diff, stage):
+    """
+    :param iou: [images, steps] mean IoU.
+    :param diff: [images, steps - 1] distance between consecutive steps.
+    """
     print('num_img, num_rec', iou.shape)
     img_id = np.arange(len(diff))
     max_id = np.argmax(iou, 1)
     hist = np.bincount(max_id)
-    t = np.arange(2, diff.shape[1] + 1)
-    tick_iou = np.arange(1, diff.shape[1] + 1)
+    t = np.arange(2, iou.shape[1] + 1)
+    tick_iou = np.arange(1, iou.shape[1] + 1)
     curves_diff = []
     curves_miou = []
-    for i in range(diff.shape[1]):
+    for i in range(iou.shape[1]):
         sel_id = img_id[max_id == i]
         if not sel_id.size:
             print('empty rec no detected {}'.format(i))
@@ -48,7 +53,7 @@ def stats(iou, diff, stage):
             curves_miou.append(iou_aver)
     for i in range(len(curves_diff)):
         fig, ax1 = plt.subplots()
-        ax1.plot(t, curves_diff[i][1::], 'bo-', label='Best-RecNo-{}-InstanceNo-{}'.format(i+1, hist[i]))
+        ax1.plot(t, curves_diff[i], 'bo-', label='Best-RecNo-{}-InstanceNo-{}'.format(i+1, hist[i]))
         # print('threshold value stop-now for rec {}'.format(i+1), curves[i][i])
         # if j < 17:
         #     print('threshold value stop-previous for rec {}'.format(i+1), curves[i][i+1])
@@ -194,7 +199,6 @@ def validate(cfg, args, roi_only=False):
     logger.info("Loading model {} from {}".format(cfg['model']['arch'], model_path))
 
     result_path = result_root(cfg, create=True) + '.yml'
-    mysoftmax = torch.nn.Softmax2d()
     with torch.no_grad():
         if cfg['training']['loss']['name'] in ['multi_step_cross_entropy']:
             for loader_type, myloader in enumerate([trainloader, valloader, testloader]):
@@ -208,82 +212,17 @@ def validate(cfg, args, roi_only=False):
                     #     break
                     start_time = timeit.default_timer()
                     images = images.to(device)
-                    if args.eval_flip:
-                        # Flip images in numpy (not support in tensor)
-                        flipped_images = np.copy(images.data.cpu().numpy()[:, :, :, ::-1])
-                        flipped_images = torch.from_numpy(flipped_images).float().to(device)
-
-                        if cfg['model']['arch'] in ['reclast']:
-                            h0 = torch.ones([images.shape[0], args.hidden_size, images.shape[2], images.shape[3]],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0)
-                            outputs_flipped = model(flipped_images, h0)
-
-                        elif cfg['model']['arch'] in ['recmid']:
-                            W, H = images.shape[2], images.shape[3]
-                            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-                            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-                            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0)
-                            outputs_flipped = model(flipped_images, h0)
-
-                        elif cfg['model']['arch'] in ['dru']:
-                            W, H = images.shape[2], images.shape[3]
-                            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-                            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-                            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32, device=device)
-                            s0 = torch.ones([images.shape[0], n_classes, W, H],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0, s0)
-                            outputs_flipped = model(flipped_images, h0)
-
-                        else:
-                            outputs = model(images)
-                            outputs_flipped = model(flipped_images)
-
-                        outputs_list = [output.data.cpu().numpy() for output in outputs]
-                        outputs_flipped_list = [output_flipped.data.cpu().numpy() for output_flipped in outputs_flipped]
-                        outputs_list = [(outputs + outputs_flipped[:, :, :, ::-1]) / 2.0 for
-                                        outputs, outputs_flipped in zip(outputs_list, outputs_flipped_list)]
-                    else:
-                        if cfg['model']['arch'] in ['reclast']:
-                            h0 = torch.ones([images.shape[0], args.hidden_size, images.shape[2], images.shape[3]],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0)
-
-                        elif cfg['model']['arch'] in ['recmid']:
-                            W, H = images.shape[2], images.shape[3]
-                            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-                            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-                            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0)
-
-                        elif cfg['model']['arch'] in ['dru']:
-                            W, H = images.shape[2], images.shape[3]
-                            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-                            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-                            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32, device=device)
-                            s0 = torch.ones([images.shape[0], n_classes, W, H],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0, s0)
-
-                        else:
-                            outputs = model(images)
-
-                        outputs_list = [output.data.cpu().numpy() for output in outputs]
-                        pred = [np.argmax(output, axis=1) for output in outputs_list]
+                    outputs = tta_forward(model, cfg['model']['arch'], images, args.hidden_size, n_classes,
+                                          tta_transforms(args))
 
-                    gt = labels.numpy()
+                    # [steps, N, C, W, H], all the steps of the batch at once, left on the device.
+                    step_outputs = torch.stack([output.data for output in outputs])
+                    step_preds = step_outputs.max(2)[1]
+                    gt = labels.to(device)
 
                     if roi_only:
                         """ Process for ROI, basically, mask the Pred based on GT"""
-                        # IPython.embed()
-                        for k in range(len(pred)):
-                            pred[k] = np.where(gt == valloader.void_classes, valloader.void_classes, pred[k])
+                        step_preds = mask_void_predictions(gt, step_preds, val_loader.void_classes)
 
                     if args.measure_time:
                         elapsed_time = timeit.default_timer() - start_time
@@ -291,50 +230,29 @@ def validate(cfg, args, roi_only=False):
                             print(
                                 "Inference time \
                                   (iter {0:5d}): {1:3.5f} fps".format(
-                                    i + 1, pred[-1].shape[0] / elapsed_time
+                                    i + 1, step_preds.shape[1] / elapsed_time
                                 )
                             )
 
-                    pred_ious = np.zeros(len(pred), np.float32)
-                    diff_of_batch = np.zeros(len(pred), np.float32)
-                    for k in range(len(pred)):
-                        if running_metrics is None:
-                            running_metrics = []
-                            for _ in range(len(pred)):
-                                running_metrics = running_metrics + [runningScore(n_classes, void=is_void_class)
-                                                                     if not roi_only else runningScore(n_classes + 1,
-                                                                                                       roi_only)]
-                        else:
-                            running_metrics[k].update(gt, pred[k], step=k)
-                            score, cls_iu = running_metrics[k].get_scores()
-                            pred_ious[k] = score['Mean IoU : \t']
-                            running_metrics[k].reset()
-                            if update_raw and k == len(pred) - 1:
-                                running_metrics[k].update_raw(gt, outputs_list[k], step=k)
-                        if k > 0:
-                            # distance = np.linalg.norm(outputs_list[k]-outputs_list[k-1])
-                            distance = np.linalg.norm(mysoftmax(torch.from_numpy(outputs_list[k])) -
-                                                      mysoftmax(torch.from_numpy(outputs_list[k - 1])))
-                            diff_of_batch[k] = distance
-                            # print('recurrence {}, diff {}'.format(k, distance))
-
-                    iou_list.append(pred_ious)
-                    diff_list.append(diff_of_batch)
+                    # [N, steps] IoU and [N, steps - 1] distances of every image.
+                    iou_list.append(step_ious(gt, step_preds, n_classes + 1 if roi_only else n_classes,
+                                              void=roi_only or is_void_class).cpu().numpy())
+                    diff_list.append(step_distances(step_outputs).cpu().numpy())
 
                 if loader_type == 0:
                     logger.info('training set performance :')
-                    train_iou = np.asarray(iou_list)
-                    train_diff = np.asarray(diff_list)
+                    train_iou = np.concatenate(iou_list)
+                    train_diff = np.concatenate(diff_list)
                     stats(train_iou, train_diff, 'train')
                 elif loader_type == 1:
                     logger.info('validation set performance :')
-                    val_iou = np.asarray(iou_list)
-                    val_diff = np.asarray(diff_list)
+                    val_iou = np.concatenate(iou_list)
+                    val_diff = np.concatenate(diff_list)
                     stats(val_iou, val_diff, 'val')
                 elif loader_type == 2:
                     logger.info('test set performance')
-                    test_iou = np.asarray(iou_list)
-                    test_diff = np.asarray(diff_list)
+                    test_iou = np.concatenate(iou_list)
+                    test_diff = np.concatenate(diff_list)
                     stats(test_iou, test_diff, 'test')
                 # results[result_tags[loader_type]] = {}
 
@@ -362,23 +280,10 @@ def validate(cfg, args, roi_only=False):
 
                     images = images.to(device)
 
-                    if args.eval_flip:
-                        # Flip images in numpy (not support in tensor)
-                        flipped_images = np.copy(images.data.cpu().numpy()[:, :, :, ::-1])
-                        flipped_images = torch.from_numpy(flipped_images).float().to(device)
-
-                        outputs = model(images)
-                        outputs_flipped = model(flipped_images)
-
-                        outputs = outputs.data.cpu().numpy()
-                        outputs_flipped = outputs_flipped.data.cpu().numpy()
-                        outputs = (outputs + outputs_flipped[:, :, :, ::-1]) / 2.0
-
-                        pred = np.argmax(outputs, axis=1)
-                    else:
-                        outputs = model(images)
-                        outputs = outputs.data.cpu().numpy()
-                        pred = np.argmax(outputs, axis=1)
+                    outputs = tta_forward(model, cfg['model']['arch'], images, args.hidden_size, n_classes,
+                                          tta_transforms(args))
+                    outputs = outputs.data.cpu().numpy()
+                    pred = np.argmax(outputs, axis=1)
 
                     gt = labels.numpy()
 
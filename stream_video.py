@@ -0,0 +1,95 @@
+"""
+Streaming evaluation of dru / sru on the video hand datasets (ego_hand, gtea_hand, eyth_hand).
+
+The frames of the split are read clip after clip (`ptsemseg/loader/sequence.py`).
+The first frame of a clip runs all the steps of the model, every other frame
+starts from the final state of the previous frame and runs --warm_steps steps
+(`ptsemseg/inference/streaming.py`). With --compare_cold every frame is also
+segmented from scratch, as validate.py does, to compare the scores.
+
+python stream_video.py --config=runs/gtea_hand/.../config.yaml --model_path=runs/gtea_hand/.../dru_gtea_hand_best_model.pkl \
+    --warm_steps=1 --compare_cold
+"""
+import time
+import logging
+
+import yaml
+import torch
+from torch.utils import data
+
+from ptsemseg.loader import get_loader
+from ptsemseg.loader.sequence import FrameSequenceDataset
+from ptsemseg.metrics import runningScore
+from ptsemseg.models import model_forward
+from ptsemseg.inference.streaming import StreamingSegmenter
+from utils import validate_parser
+from validate import load_model_and_preprocess, step_masks
+
+logger = logging.getLogger('ptsemseg')
+
+
+def log_scores(name, metrics):
+    score, class_iou, _ = metrics.get_scores()
+    for k, v in score.items():
+        logger.info("{} {} {}".format(name, k, v))
+    for k, v in class_iou.items():
+        logger.info("{} class {} IoU {}".format(name, k, v))
+
+
+if __name__ == "__main__":
+    parser = validate_parser()
+    parser.add_argument("--warm_steps", nargs="?", type=int, default=1,
+                        help="steps of a frame started from the previous one")
+    parser.add_argument("--split", nargs="?", type=str, default="", help="split to stream, the test split if empty")
+    parser.add_argument("--compare_cold", dest="compare_cold", action="store_true",
+                        help="Also score every frame started from scratch | False by default")
+    parser.set_defaults(compare_cold=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    with open(args.config) as fp:
+        cfg = yaml.load(fp, Loader=yaml.Loader)
+    if args.model:
+        cfg['model']['arch'] = args.model
+    arch = cfg['model']['arch']
+    device = torch.device(args.device)
+
+    data_loader = get_loader(cfg['data']['dataset'])
+    loader = data_loader(cfg['data']['path'], split=args.split or cfg['data']['test_split'], is_transform=True,
+                         img_size=(cfg['data']['img_rows'], cfg['data']['img_cols']))
+    frames = FrameSequenceDataset(loader)
+    logger.info("{} frames in {} clips".format(len(frames), len(frames.clips)))
+    # Frames in order, one stream.
+    frameloader = data.DataLoader(frames, batch_size=1, shuffle=False, num_workers=4)
+
+    n_classes = loader.n_classes
+    model, model_path = load_model_and_preprocess(cfg, args, n_classes, device)
+    logger.info("Loading model {} from {}".format(arch, model_path))
+    segmenter = StreamingSegmenter(model, arch, hidden_size=args.hidden_size, n_classes=n_classes,
+                                   warm_steps=args.warm_steps)
+
+    streaming = runningScore(n_classes)
+    cold = runningScore(n_classes) if args.compare_cold else None
+    elapsed = 0.
+    with torch.no_grad():
+        for images, labels, first in frameloader:
+            images, labels = images.to(device), labels.to(device)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            output = segmenter(images, first)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed += time.time() - start
+            streaming.update(labels, step_masks([output])[0].long())
+            if cold is not None:
+                outputs = model_forward(model, arch, images, args.hidden_size, n_classes)
+                cold.update(labels, step_masks(outputs[-1:])[0].long())
+
+    logger.info("{} frames in {:.1f} s, {:.2f} fps, {:.2f} steps per frame (cold start: {})".format(
+        segmenter.n_frames, elapsed, segmenter.n_frames / elapsed if elapsed > 0 else 0.,
+        segmenter.steps_per_frame(), segmenter.net.steps))
+    log_scores('streaming', streaming)
+    if cold is not None:
+        log_scores('cold', cold)
@@ -0,0 +1,97 @@
+"""
+Run a grid of training runs locally, in parallel.
+
+Replaces the jinja templates of `experiments/`: the grid is a YAML file (see
+`ptsemseg/sweep.py`), trials run concurrently in CPU-pinned slots, trials whose
+results/*.yml already exist are skipped and an interrupted trial resumes from
+its latest checkpoint. All results are gathered in one csv table.
+
+With --prune, trials that rank in the bottom of their peers at the same
+iteration budget are stopped early (successive halving on the validation IoU).
+
+python sweep.py --sweep=configs/sweep/drive_ablation.yml --slots=4 --cpus_per_trial=8
+"""
+import os
+import logging
+import argparse
+
+import yaml
+
+from ptsemseg.sweep import expand_grid, trial_run_id, params_to_argv, Trial, SweepRunner, collect_results, \
+    SuccessiveHalvingPruner, check_script
+from ptsemseg.checkpoint import latest_checkpoint
+from utils_drive import train_parser
+from train_drive import load_cfg_with_overwrite
+from validate import result_root
+
+logger = logging.getLogger('ptsemseg')
+
+
+def build_trials(sweep_cfg, parser):
+    trials = []
+    for params in expand_grid(sweep_cfg.get('grid', {})):
+        flags = dict(sweep_cfg.get('fixed', {}))
+        flags.update(params)
+        flags['run_id'] = trial_run_id(flags)
+        argv = params_to_argv(flags, parser)
+
+        # Resolve the run directory and the results file exactly like the training script does.
+        args = parser.parse_args(argv)
+        cfg = load_cfg_with_overwrite(args)
+        logdir = cfg['logdir']
+        if latest_checkpoint(logdir) is not None:
+            argv.append('--resume={}'.format(logdir))
+        trials.append(Trial(params, argv, logdir, result_root(cfg) + '.yml',
+                            train_iters=cfg['training']['train_iters']))
+    return trials
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sweep")
+    parser.add_argument("--sweep", nargs="?", type=str, default="configs/sweep/drive_ablation.yml",
+                        help="Sweep file with the grid of training flags")
+    parser.add_argument("--slots", nargs="?", type=int, default=0, help="number of concurrent trials")
+    parser.add_argument("--cpus_per_trial", nargs="?", type=int, default=-1, help="CPU cores pinned per trial")
+    parser.add_argument("--out", nargs="?", type=str, default="", help="csv table of the results")
+    parser.add_argument("--prune", dest="prune", action="store_true",
+                        help="Enable successive-halving early stopping | False by default")
+    parser.set_defaults(prune=False)
+    parser.add_argument("--eta", nargs="?", type=int, default=3, help="keep the top 1/eta trials at every rung")
+    parser.add_argument("--min_fraction", nargs="?", type=float, default=0.1,
+                        help="first rung, as a fraction of train_iters")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    with open(args.sweep) as fp:
+        sweep_cfg = yaml.load(fp, Loader=yaml.Loader)
+    name = os.path.splitext(os.path.basename(args.sweep))[0]
+
+    # Trials are laid out with the train_drive.py flags, fail before anything is started.
+    script = sweep_cfg.get('script', 'train_drive.py')
+    check_script(script)
+    trials = build_trials(sweep_cfg, train_parser())
+    logger.info("{} trials in sweep {}".format(len(trials), name))
+
+    pruner = None
+    prune_cfg = sweep_cfg.get('prune')
+    if args.prune or prune_cfg:
+        prune_cfg = prune_cfg or {}
+        pruner = SuccessiveHalvingPruner(eta=prune_cfg.get('eta', args.eta),
+                                         min_fraction=prune_cfg.get('min_fraction', args.min_fraction))
+
+    runner = SweepRunner(trials,
+                         script=script,
+                         slots=args.slots or sweep_cfg.get('slots', 1),
+                         cpus_per_trial=args.cpus_per_trial if args.cpus_per_trial >= 0
+                         else sweep_cfg.get('cpus_per_trial', 0),
+                         gpus=sweep_cfg.get('gpus'),
+                         log_dir=os.path.join('logs', 'sweep', name),
+                         pruner=pruner)
+    runner.run()
+
+    out_path = args.out or os.path.join('results', 'sweep', name + '.csv')
+    rows = collect_results(trials, out_path)
+    for row in rows:
+        logger.info(row)
+    logger.info("Results table written to {}".format(out_path))
@@ -0,0 +1,50 @@
+"""
+Testing the prediction archive.
+
+"""
+import os
+
+import numpy as np
+
+from ptsemseg.inference.archive import PredictionArchiveWriter, PredictionArchive, export_pngs, pack_mask, \
+    unpack_mask
+
+
+def test_pack_masks():
+    rng = np.random.RandomState(0)
+    for bits, n_classes in [(1, 2), (2, 3), (3, 7)]:
+        mask = rng.randint(0, n_classes, size=(5, 7)).astype(np.uint8)
+        packed = pack_mask(mask, bits)
+        assert len(packed) == (mask.size * bits + 7) // 8
+        np.testing.assert_array_equal(unpack_mask(packed, mask.shape, bits), mask)
+
+
+def test_archive_random_access(tmpdir):
+    rng = np.random.RandomState(1)
+    path = os.path.join(str(tmpdir), 'run.psar')
+    expected = {}
+    # A small chunk size spreads the records over several chunks.
+    with PredictionArchiveWriter(path, n_classes=2, chunk_size=64) as writer:
+        for name in ['01_test', '02_test', '03_test']:
+            for step in range(1, 4):
+                mask = rng.randint(0, 2, size=(16, 12)).astype(np.uint8)
+                prob = rng.rand(16, 12) if step == 3 else None
+                writer.add(name, step, mask, prob)
+                expected[name, step] = mask, prob
+    assert not os.path.exists(path + '.tmp')
+
+    with PredictionArchive(path, cached_chunks=1) as archive:
+        assert archive.names() == ['01_test', '02_test', '03_test']
+        assert archive.steps('02_test') == [1, 2, 3]
+        assert len(archive.chunks) > 1
+        for (name, step), (mask, prob) in sorted(expected.items(), reverse=True):
+            np.testing.assert_array_equal(archive.mask(name, step), mask)
+            if prob is None:
+                assert archive.prob(name, step) is None
+            else:
+                assert np.abs(archive.prob(name, step) - prob).max() <= 0.5 / 255 + 1e-6
+        np.testing.assert_array_equal(archive.mask('01_test'), expected['01_test', 3][0])
+
+        out_dir = os.path.join(str(tmpdir), 'pngs')
+        assert export_pngs(archive, out_dir, names=['01_test'], steps=[3], probs=True) == 2
+        assert sorted(os.listdir(out_dir)) == ['01_test_step3.png', '01_test_step3_prob.png']
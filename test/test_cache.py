@@ -0,0 +1,63 @@
+"""
+Testing the prediction cache.
+
+"""
+import os
+import time
+import argparse
+
+import torch
+
+from ptsemseg.inference.cache import PredictionCache, CachedPredictor, cache_context
+
+
+def test_cached_predictor_serves_seen_images(tmpdir):
+    calls = []
+
+    def predictor(images):
+        calls.append(images.shape[0])
+        return [images * 2, images * 3]
+
+    cache = PredictionCache(os.path.join(str(tmpdir), 'cache'))
+    cached = CachedPredictor(predictor, cache, 'context')
+    images = torch.randn(3, 1, 4, 4)
+    first = cached(images)
+    assert calls == [3]
+
+    # Two images already seen, only the new one goes through the model.
+    second = cached(torch.cat([images[1:], torch.randn(1, 1, 4, 4)]))
+    assert calls == [3, 1]
+    assert cache.hits == 2 and cache.misses == 4
+    for a, b in zip(first, second):
+        assert torch.equal(a[1:], b[:2])
+
+    # Another context is another model.
+    CachedPredictor(predictor, cache, 'other')(images)
+    assert calls == [3, 1, 3]
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    root = os.path.join(str(tmpdir), 'cache')
+    cache = PredictionCache(root, max_bytes=1 << 30)
+    for key in ['aa1', 'bb2', 'cc3']:
+        cache.put(key, torch.zeros(256))
+        time.sleep(0.01)
+    cache.get('aa1')
+    entry_size = cache.size() // 3
+
+    # Reloaded from disk, the last use survives.
+    cache = PredictionCache(root, max_bytes=2 * entry_size)
+    cache.put('dd4', torch.zeros(256))
+    assert cache.get('bb2') is None and cache.get('cc3') is None
+    assert cache.get('aa1') is not None and len(cache) == 2
+
+
+def test_cache_context(tmpdir):
+    path = os.path.join(str(tmpdir), 'model.pkl')
+    with open(path, 'wb') as fp:
+        fp.write(b'weights')
+    args = argparse.Namespace(eval_flip=True, tta='', hidden_size=32)
+    context = cache_context(path, {'arch': 'dru', 'steps': 3}, args, 2)
+    assert context == cache_context(path, {'arch': 'dru', 'steps': 3}, args, 2)
+    assert context != cache_context(path, {'arch': 'dru', 'steps': 4}, args, 2)
+    assert context != cache_context(path, {'arch': 'dru', 'steps': 3}, argparse.Namespace(eval_flip=False), 2)
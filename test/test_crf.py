@@ -0,0 +1,43 @@
+"""
+Testing the batched CRF refinement.
+
+"""
+import torch
+
+from ptsemseg.inference.crf import crf_refine, CRFPredictor
+
+
+def _noisy_square(n, size=32):
+    image = torch.zeros(n, 3, size, size)
+    image[:, :, 8:24, 8:24] = 255.
+    truth = (image[:, :1] > 0).float()
+    torch.manual_seed(0)
+    flips = (torch.rand(n, 1, size, size) < 0.15).float()
+    noisy = truth * (1 - flips) + (1 - truth) * flips
+    return image, truth, noisy * 0.8 + 0.1
+
+
+def test_crf_removes_isolated_errors():
+    image, truth, prob = _noisy_square(2)
+    refined = crf_refine(prob, image, iterations=5, radius=2)
+    assert refined.shape == prob.shape
+    before = ((prob > 0.5).float() != truth).float().mean()
+    after = ((refined > 0.5).float() != truth).float().mean()
+    assert after < before / 4
+
+
+def test_crf_predictor_refines_every_step():
+    image, truth, prob = _noisy_square(2)
+    logits = torch.log(torch.cat([1 - prob, prob], 1))
+
+    def predictor(images):
+        return [logits, logits]
+
+    outputs = CRFPredictor(predictor, iterations=5, radius=2)(image)
+    assert len(outputs) == 2
+    for output in outputs:
+        assert output.shape == logits.shape
+        assert torch.allclose(torch.softmax(output, 1).sum(1), torch.ones(2, 32, 32), atol=1e-4)
+        assert (output.argmax(1, keepdim=True).float() != truth).float().mean() < 0.05
+    # The two steps of an image share its kernel, their refinements are equal.
+    assert torch.allclose(outputs[0], outputs[1])
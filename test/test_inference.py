@@ -0,0 +1,344 @@
+"""
+Testing the inference engines.
+
+"""
+import os
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from ptsemseg.inference import tta_forward, tta_transforms, SlidingWindow, tile_grid, valid_windows, SparseRefiner
+
+
+def test_tta_forward_is_exact_for_equivariant_models():
+    images = torch.randn(2, 3, 8, 8)
+    calls = []
+
+    def model(x):
+        calls.append(x.shape[0])
+        return [x, 2 * x]
+
+    transforms = ['identity', 'hflip', 'vflip', 'rot90']
+    outputs = tta_forward(model, 'unet', images, 0, 2, transforms)
+    # One forward over the four copies.
+    assert calls == [8]
+    assert torch.allclose(outputs[0], images)
+    assert torch.allclose(outputs[1], 2 * images)
+
+    # Non square batch, the rotation gets its own forward.
+    calls.clear()
+    outputs = tta_forward(lambda x: calls.append(x.shape[0]) or x, 'unet', torch.randn(2, 3, 8, 6), 0, 2, transforms)
+    assert calls == [2, 6]
+    assert outputs.shape == (2, 3, 8, 6)
+
+
+def test_tta_transforms():
+    args = argparse.Namespace(eval_flip=True, tta='vflip, rot90')
+    assert tta_transforms(args) == ['identity', 'hflip', 'vflip', 'rot90']
+    assert tta_transforms(argparse.Namespace(eval_flip=False)) == ['identity']
+
+
+class _Pointwise(torch.nn.Module):
+    """Two steps of a 1x1 convolution, tiles and whole images give the same outputs."""
+    def __init__(self):
+        super(_Pointwise, self).__init__()
+        self.conv = torch.nn.Conv2d(3, 2, 1)
+
+    def forward(self, x):
+        y = self.conv(x)
+        return [y, 2 * y]
+
+
+def test_tile_grid_covers_the_image():
+    covered = torch.zeros(50, 70)
+    for sx, ex, sy, ey in tile_grid(50, 70, (32, 32), overlap=0.25):
+        assert ex - sx == 32 and ey - sy == 32
+        covered[sx:ex, sy:ey] = 1
+    assert covered.all()
+    assert tile_grid(20, 20, (32, 32)) == [(0, 20, 0, 20)]
+
+
+def test_sliding_window_matches_whole_image():
+    model = _Pointwise().eval()
+    images = torch.randn(2, 3, 40, 56)
+    with torch.no_grad():
+        expected = model(images)
+        for blending in ['gaussian', 'uniform']:
+            outputs = SlidingWindow(model, 'unet', tile_size=(16, 24), batch_size=3, blending=blending)(images)
+            for o, e in zip(outputs, expected):
+                assert torch.allclose(o, e, atol=1e-5)
+
+
+def test_sliding_window_activates_every_augmented_copy():
+    model = torch.nn.Conv2d(3, 2, 3, padding=1).eval()
+    images = torch.randn(1, 3, 16, 16)
+    window = SlidingWindow(model, 'unet', tile_size=(16, 16), transforms=['identity', 'hflip'],
+                           activation=lambda x: F.softmax(x, dim=1))
+    with torch.no_grad():
+        expected = (F.softmax(model(images), 1) + F.softmax(model(images.flip(3)), 1).flip(3)) / 2
+        output = window(images)
+    assert torch.allclose(output, expected, atol=1e-6)
+
+
+def test_sparse_tiles_skip_invalid_pixels():
+    model = _Pointwise().eval()
+    images = torch.randn(1, 3, 32, 32)
+    mask = torch.zeros(1, 32, 32, dtype=torch.uint8)
+    mask[0, :10, :10] = 1
+    window = SlidingWindow(model, 'unet', tile_size=(16, 16), overlap=0.)
+    assert len(valid_windows(window.windows(images), mask)) == 1
+
+    with torch.no_grad():
+        expected = model(images)
+        outputs = window(images, mask=mask)
+    assert (window.n_run, window.n_skipped) == (1, 3)
+    for o, e in zip(outputs, expected):
+        assert torch.allclose(o[..., :16, :16], e[..., :16, :16], atol=1e-5)
+        # Background everywhere else.
+        assert (o[:, 0, 16:, :] > 0).all() and (o[:, 1:, 16:, :] < 0).all()
+
+
+def test_sparse_tiles_fill_single_channel_outputs_with_zero():
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 1, 1), torch.nn.Sigmoid()).eval()
+    images = torch.randn(1, 3, 32, 32)
+    mask = torch.zeros(1, 32, 32, dtype=torch.uint8)
+    mask[0, :10, :10] = 1
+    with torch.no_grad():
+        expected = model(images)
+        output = SlidingWindow(model, 'unet', tile_size=(16, 16), overlap=0.)(images, mask=mask)
+    assert torch.allclose(output[..., :16, :16], expected[..., :16, :16], atol=1e-5)
+    # A background probability, not a logit.
+    assert (output[..., 16:, :] == 0).all() and (output[..., :, 16:] == 0).all()
+
+
+class _PointwiseRecurrent(torch.nn.Module):
+    """Recurrent pointwise model: confident where the input is large, uncertain where it is zero."""
+    steps = 3
+
+    def step(self, inputs, h, s):
+        x = 10 * inputs[:, :1] + 0.1 * s[:, :1]
+        return h + 1, torch.cat([x, -x], 1)
+
+    def forward(self, inputs, h, s):
+        outputs = []
+        for _ in range(self.steps):
+            h, s = self.step(inputs, h, s)
+            outputs.append(s)
+        return outputs
+
+
+def test_sparse_refinement_only_runs_uncertain_tiles():
+    model = _PointwiseRecurrent()
+    images = torch.randn(1, 3, 32, 32).sign()
+    images[:, :, :16, :16] = 0
+    refiner = SparseRefiner(model, 'dru', hidden_size=4, n_classes=2, tile_size=16, halo=16)
+    outputs = refiner(images)
+    expected = model(images, torch.ones(1, 4, 2, 2), torch.ones(1, 2, 32, 32))
+
+    assert (refiner.n_refined, refiner.n_tiles) == (2, 8)
+    for o, e in zip(outputs, expected):
+        assert torch.allclose(o[..., :16, :16], e[..., :16, :16])
+    # Confident tiles carried the first step forward.
+    assert torch.equal(outputs[2][..., 16:, :], outputs[0][..., 16:, :])
+
+
+class _BlockRecurrent(torch.nn.Module):
+    """Single channel recurrent model, each 16 x 16 cell of the hidden state sets its pixels."""
+    steps = 3
+
+    def step(self, inputs, h, s):
+        h = h + F.avg_pool2d(inputs[:, :1], 16)
+        up = h.repeat_interleave(16, 2).repeat_interleave(16, 3)
+        up = F.pad(up, (0, inputs.shape[3] - up.shape[3], 0, inputs.shape[2] - up.shape[2]), mode='replicate')
+        return h, torch.sigmoid(10 * (up - 1))
+
+    def forward(self, inputs, h, s):
+        outputs = []
+        for _ in range(self.steps):
+            h, s = self.step(inputs, h, s)
+            outputs.append(s)
+        return outputs
+
+
+def test_sparse_refinement_keeps_the_hidden_state_aligned():
+    from ptsemseg.inference.refine import aligned_grid
+    # 40 x 56 is not a multiple of the tiles, the last ones are clipped instead of shifted.
+    assert aligned_grid(40, 56, 16)[-1] == (32, 40, 48, 56)
+    model = _BlockRecurrent()
+    images = torch.ones(1, 3, 40, 56)
+    images[:, :, 16:, 32:] = 0
+    refiner = SparseRefiner(model, 'dru', hidden_size=1, n_classes=1, tile_size=16, halo=16)
+    outputs = refiner(images)
+    expected = model(images, torch.ones(1, 1, 2, 3), torch.ones(1, 1, 40, 56))
+
+    # The uncertain probabilities of the single channel output are refined, 4 tiles of 12 at each step.
+    assert (refiner.n_refined, refiner.n_tiles) == (8, 24)
+    for o, e in zip(outputs, expected):
+        assert o.shape == e.shape
+        assert torch.allclose(o, e, atol=1e-4)
+
+
+def test_dynamic_batcher_groups_requests():
+    from ptsemseg.inference.server import DynamicBatcher
+    batches = []
+
+    def run_batch(inputs, options):
+        batches.append(len(inputs))
+        return [x.sum().item() * o['scale'] for x, o in zip(inputs, options)]
+
+    batcher = DynamicBatcher(run_batch, max_batch_size=3, max_latency=0.5)
+    futures = [batcher.submit(torch.ones(2, 2), scale=k) for k in range(4)]
+    # Another shape never shares a batch with the others.
+    odd = batcher.submit(torch.ones(3, 3), scale=1)
+    assert [f.result(5) for f in futures] == [0., 4., 8., 12.]
+    assert odd.result(5) == 9.
+    batcher.close()
+    assert sorted(batches) == [1, 1, 3] and batcher.n_requests == 5
+
+
+def test_dynamic_batcher_deadline_starts_at_arrival():
+    from ptsemseg.inference.server import DynamicBatcher
+    calls = []
+
+    def run_batch(inputs, options):
+        calls.append(time.time())
+        time.sleep(0.5 if len(calls) == 1 else 0.)
+        calls.append(time.time())
+        return [None] * len(inputs)
+
+    batcher = DynamicBatcher(run_batch, max_batch_size=2, max_latency=0.3)
+    first = batcher.submit(torch.ones(2, 2))
+    time.sleep(0.4)
+    # Arrives while the first batch runs, its deadline is over when that batch ends.
+    second = batcher.submit(torch.ones(2, 2))
+    first.result(5), second.result(5)
+    batcher.close()
+    assert calls[2] - calls[1] < 0.2
+
+
+class _RnnSteps(torch.nn.Module):
+    """Steps in `rnn_steps`, like JointSegCTLDireNetRecurrent. Step k outputs the logits [0, k - 1.5]."""
+    def __init__(self):
+        super(_RnnSteps, self).__init__()
+        self.rnn_steps = 3
+        self.unrolled = []
+
+    def forward(self, x):
+        self.unrolled.append(self.rnn_steps)
+        background = torch.zeros_like(x[:, :1])
+        return [torch.cat([background, background + k - 1.5], 1) for k in range(1, self.rnn_steps + 1)]
+
+
+def test_service_returns_the_requested_steps():
+    from ptsemseg.inference.server import SegmentationService
+    model = _RnnSteps()
+    service = SegmentationService(model, 'unet', argparse.Namespace(hidden_size=0), 2, torch.device('cpu'))
+    assert service.steps == 3
+    images = [torch.zeros(3, 4, 4)] * 3
+
+    # The last step by default, requests past it are clamped.
+    results = service.run_batch(images, [{}, {'steps': 1}, {'steps': 9}])
+    assert [step for _, step in results] == [3, 1, 3]
+    assert results[0][0].tolist() == [[1] * 4] * 4 and results[1][0].tolist() == [[0] * 4] * 4
+
+    # Only as many steps as asked for are unrolled.
+    results = service.run_batch(images[:2], [{'steps': 1}, {'steps': 2, 'output': 'prob'}])
+    assert [step for _, step in results] == [1, 2]
+    assert results[1][0].shape == (2, 4, 4)
+    assert abs(results[1][0][1, 0, 0] - torch.sigmoid(torch.tensor(0.5)).item()) < 1e-6
+    assert model.unrolled == [3, 2] and model.rnn_steps == 3
+
+
+def test_pipeline_keeps_every_image(tmpdir):
+    from ptsemseg.inference.pipeline import Pipeline, list_images
+    os.makedirs(os.path.join(str(tmpdir), 'sub'))
+    for name in ['a.png', 'b.jpg', 'sub/c.png', 'notes.txt']:
+        open(os.path.join(str(tmpdir), name), 'w').close()
+    items = list_images(str(tmpdir), 'out')
+    assert [os.path.basename(p) for p, _ in items] == ['a.png', 'b.jpg', 'c.png']
+    assert items[2][1] == os.path.join('out', 'sub')
+
+    written, batches = {}, []
+
+    def decode(item):
+        return torch.full((1, 2, 2), float(len(item[0]))), item[0]
+
+    def forward(images):
+        batches.append(images.shape[0])
+        return list(images.sum(dim=(1, 2, 3)))
+
+    pipeline = Pipeline(decode, forward, lambda item, info, result: written.update({info: result.item()}),
+                        batch_size=2, queue_size=1)
+    assert pipeline.run(items) == 3
+    assert batches == [2, 1]
+    assert written == {p: 4. * len(p) for p, _ in items}
+
+
+def test_sharded_run_resumes_from_its_index(tmpdir):
+    from ptsemseg.inference.sharding import make_shards, core_groups, ShardIndex, run_sharded
+    items = [('img{}.png'.format(n), 'out') for n in range(5)]
+    shards = make_shards(items, 2)
+    assert [len(s['items']) for s in shards] == [2, 2, 1]
+    # Shards are named by their images, the same listing gives the same ids.
+    assert [s['id'] for s in make_shards(list(items), 2)] == [s['id'] for s in shards]
+    assert core_groups(3, range(8)) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+
+    path = os.path.join(str(tmpdir), 'index.jsonl')
+    index = ShardIndex(path)
+    for shard in shards:
+        index.record(shard['id'], {p: [p + '.mask'] for p, _ in shard['items']}, worker=0)
+    with open(path, 'a') as fp:
+        fp.write('{"shard": "trunc')
+    # A restart reads the completed shards back, the line of a killed run is ignored.
+    index = ShardIndex(path)
+    assert index.completed() == {s['id'] for s in shards}
+    assert sorted(index.outputs()) == [p for p, _ in items]
+    assert run_sharded(shards, None, index, n_workers=2) == 0
+    # Records appended after the truncated line are read back.
+    index.record('extra', {'img5.png': ['img5.png.mask']}, worker=1)
+    assert ShardIndex(path).completed() == {s['id'] for s in shards} | {'extra'}
+
+
+def test_streaming_warm_starts_from_the_previous_frame():
+    from ptsemseg.inference.streaming import StreamingSegmenter
+    from ptsemseg.loader.sequence import FrameSequenceDataset, clip_and_frame
+    assert clip_and_frame('vid4/frame123') == (os.path.join('vid4', 'frame'), 123)
+    assert clip_and_frame('S1_Cheese_C1_00000042') == ('S1_Cheese_C1', 42)
+
+    class _Frames(object):
+        split = 'test'
+        files = {'test': ['b/frame2', 'a/frame10', 'b/frame1', 'a/frame9']}
+
+        def __getitem__(self, index):
+            return torch.full((3, 32, 32), float(index)), self.files['test'][index]
+
+    frames = FrameSequenceDataset(_Frames())
+    assert [lbl for _, lbl, _ in frames] == ['a/frame9', 'a/frame10', 'b/frame1', 'b/frame2']
+    assert [first for _, _, first in frames] == [True, False, True, False]
+
+    model = _PointwiseRecurrent()
+    segmenter = StreamingSegmenter(model, 'dru', hidden_size=4, n_classes=2, warm_steps=1)
+    images = torch.randn(1, 3, 32, 32)
+    cold = segmenter(images, [True])
+    assert torch.equal(cold, model(images, torch.ones(1, 4, 2, 2), torch.ones(1, 2, 32, 32))[-1])
+    # The next frame runs a single step from the state of the first one.
+    warm = segmenter(images, [False])
+    assert torch.equal(warm, model.step(images, torch.ones(1, 4, 2, 2) + 3, cold)[1])
+    assert segmenter.steps_per_frame() == 2.
+    # A new clip starts from scratch again.
+    assert torch.equal(segmenter(images, [True]), cold)
+
+
+def test_ensemble_averages_probabilities():
+    from ptsemseg.inference.ensemble import EnsemblePredictor
+    images = torch.randn(2, 3, 4, 4)
+    logits = torch.randn(2, 2, 4, 4)
+    dice = torch.rand(2, 1, 4, 4)
+
+    # A recurrent member (its last step counts) and a single channel one.
+    ensemble = EnsemblePredictor([lambda x: [torch.zeros_like(logits), logits], lambda x: dice], weights=[1., 3.])
+    merged = ensemble(images).exp()
+    expected = (torch.softmax(logits, 1) + 3 * torch.cat([1 - dice, dice], 1)) / 4
+    assert torch.allclose(merged, expected, atol=1e-6)
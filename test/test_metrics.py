@@ -0,0 +1,150 @@
+"""
+Testing the running scores.
+
+"""
+import numpy as np
+import torch
+
+from ptsemseg.metrics import runningScore, fovScore, step_ious, step_distances, MetricsWorker, \
+    mask_void_predictions
+from validate import step_masks
+
+
+def _random_labels(n_classes, shape=(4, 16, 16), seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, n_classes, size=shape), rng.randint(0, n_classes, size=shape)
+
+
+def test_torch_confusion_matrix_matches_numpy():
+    for void in [False, True]:
+        lt, lp = _random_labels(3)
+        numpy_score = runningScore(3, void)
+        torch_score = runningScore(3, void)
+        for _ in range(2):
+            numpy_score.update(lt, lp)
+            torch_score.update(torch.from_numpy(lt), torch.from_numpy(lp))
+
+        assert torch_score.device_confusion_matrix.dtype == torch.int64
+        torch_scores, torch_iou, _ = torch_score.get_scores()
+        numpy_scores, numpy_iou, _ = numpy_score.get_scores()
+        assert torch_score.device_confusion_matrix is None
+        np.testing.assert_array_equal(torch_score.confusion_matrix, numpy_score.confusion_matrix)
+        assert torch_scores["Mean IoU : \t"] == numpy_scores["Mean IoU : \t"]
+
+        torch_score.reset()
+        assert torch_score.confusion_matrix.sum() == 0
+
+
+def _raw_batch(seed=0):
+    rng = np.random.RandomState(seed)
+    lt = rng.randint(0, 2, size=(2, 8, 8))
+    # Logits loosely correlated with the labels.
+    lp = rng.randn(2, 2, 8, 8)
+    lp[:, 1] += 2 * lt
+    return lt, lp
+
+
+def test_break_even_from_histograms():
+    lt, lp = _raw_batch()
+    score = runningScore(2)
+    score.update_raw(lt, lp)
+    prec, recall, thresh = score.compute_break_even()
+
+    # Brute force at the returned threshold, as the binary search thresholded the pixels.
+    prob = np.concatenate([(np.exp(p[1]) / np.exp(p[:2]).sum(axis=0)).flatten() for p in lp])
+    prob = (prob * score.break_even_threshold).astype(int).astype(float) / score.break_even_threshold
+    cut = ((prob >= thresh) & (prob != 0)).astype(int)
+    hist = score._fast_hist(lt.flatten(), cut, 2)
+    assert np.isclose(prec, np.nanmean(np.diag(hist) / hist.sum(axis=1)))
+    assert np.isclose(recall, np.nanmean(np.diag(hist) / hist.sum(axis=0)))
+
+    assert 0.5 < score.compute_auc() <= 1.
+    score.reset()
+    assert score.score_hist.sum() == 0
+
+
+def test_break_even_torch_matches_numpy():
+    lt, lp = _raw_batch(1)
+    numpy_score, torch_score = runningScore(2), runningScore(2)
+    numpy_score.update_raw(lt, lp)
+    torch_score.update_raw(torch.from_numpy(lt), torch.from_numpy(lp))
+    assert torch_score.compute_break_even() == numpy_score.compute_break_even()
+
+
+def test_fov_scores():
+    rng = np.random.RandomState(2)
+    labels = torch.from_numpy(rng.randint(0, 2, size=(2, 8, 8)))
+    fov = torch.ones(2, 8, 8, dtype=torch.uint8)
+    fov[:, :2] = 0
+    perfect = labels.float()
+    noisy = torch.from_numpy(rng.rand(2, 8, 8)).float()
+    # Outside of the FOV, wrong on purpose.
+    perfect[:, :2] = 1 - perfect[:, :2]
+
+    score = fovScore(n_steps=2)
+    score.update([noisy, perfect], labels, fov)
+    first, last = score.get_scores()
+    for k in ["AUC : \t", "Se : \t", "Sp : \t", "Acc : \t", "F1 : \t"]:
+        assert last[k] == 1.
+
+    inside = fov.numpy() > 0
+    lt, pred = labels.numpy()[inside], noisy.numpy()[inside] >= 0.5
+    assert np.isclose(first["Acc : \t"], (pred == lt).mean())
+    assert np.isclose(first["Se : \t"], pred[lt == 1].mean())
+
+
+def test_step_ious_match_running_score():
+    rng = np.random.RandomState(3)
+    for void in [False, True]:
+        lt = torch.from_numpy(rng.randint(0, 3, size=(2, 8, 8)))
+        preds = torch.from_numpy(rng.randint(0, 3, size=(4, 2, 8, 8)))
+        ious = step_ious(lt, preds, 3, void=void)
+        assert ious.shape == (2, 4)
+        for n in range(2):
+            for k in range(4):
+                score = runningScore(3, void)
+                score.update(lt[n:n + 1].numpy(), preds[k, n:n + 1].numpy())
+                assert np.isclose(ious[n, k].item(), score.get_scores()[0]["Mean IoU : \t"])
+
+
+def test_step_distances():
+    outputs = torch.randn(3, 2, 2, 4, 4)
+    outputs[2] = outputs[1]
+    distances = step_distances(outputs)
+    assert distances.shape == (2, 2)
+    assert torch.all(distances[:, 1] == 0)
+    expected = (torch.softmax(outputs[1, 0], 0) - torch.softmax(outputs[0, 0], 0)).norm()
+    assert torch.isclose(distances[0, 0], expected)
+
+
+def test_metrics_worker():
+    worker = MetricsWorker(max_pending=2)
+    lt, lp = _random_labels(3)
+    score, expected = runningScore(3), runningScore(3)
+    for _ in range(5):
+        worker.submit(score.update, lt, lp)
+        expected.update(lt, lp)
+    worker.wait()
+    np.testing.assert_array_equal(score.confusion_matrix, expected.confusion_matrix)
+    worker.close()
+
+
+def test_roi_void_masking_matches_numpy():
+    # Like RoadLoader, the void classes are a list.
+    lt, lp = _random_labels(3)
+    preds = np.stack([lp, (lp + 1) % 3])
+    masked = mask_void_predictions(torch.from_numpy(lt), torch.from_numpy(preds), [2])
+    expected = np.stack([np.where(lt == 2, 2, p) for p in preds])
+    np.testing.assert_array_equal(masked.numpy(), expected)
+    ious = step_ious(torch.from_numpy(lt), masked, 3, void=True)
+    assert ious.shape == (4, 2)
+
+
+def test_step_masks_take_the_argmax_of_multi_channel_outputs():
+    # Both channels are above 0.5, the second one wins.
+    logits = torch.tensor([[[[0.6, 0.9]], [[0.7, -1.]]]])
+    probs = torch.tensor([0.2, 0.5]).view(1, 1, 1, 2)
+    masks = step_masks([logits, logits])
+    assert masks.dtype == torch.uint8 and masks.shape == (2, 1, 1, 2)
+    assert masks[0].tolist() == [[[1, 0]]]
+    assert step_masks([probs])[0].tolist() == [[[0, 1]]]
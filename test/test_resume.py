@@ -0,0 +1,97 @@
+"""
+Testing the resumable sampler and the background checkpoint writer.
+
+"""
+import os
+import random
+
+import pytest
+import numpy as np
+import torch
+from torch.utils import data
+
+from ptsemseg.checkpoint import CheckpointWriter, get_rng_state, set_rng_state, latest_checkpoint
+from ptsemseg.loader.sampler import ResumableRandomSampler, SeededDataset
+
+
+class _RandomDataset(object):
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, index):
+        return index, random.random(), np.random.random()
+
+
+def test_sampler_resume_mid_epoch():
+    dataset = list(range(10))
+    sampler = ResumableRandomSampler(dataset, seed=1337, epoch=3)
+    full = list(sampler)
+    assert sorted(i for i, _ in full) == dataset
+
+    sampler.set_epoch(3, start_index=4)
+    assert list(sampler) == full[4:]
+
+    sampler.set_epoch(4)
+    assert list(sampler) != full
+
+
+def test_sampler_resume_at_epoch_boundary():
+    dataset = list(range(10))
+    sampler = ResumableRandomSampler(dataset, seed=1337)
+    # 3 batches of 4 were consumed, the last one partial.
+    for start_index in [10, 12]:
+        sampler.set_epoch(0, start_index=start_index)
+        assert len(sampler) == 0
+        assert list(sampler) == []
+    loader = data.DataLoader(SeededDataset(_RandomDataset()), batch_size=4, sampler=sampler)
+    assert len(loader) == 0 and list(loader) == []
+
+
+def test_seeded_dataset_is_deterministic():
+    dataset = SeededDataset(_RandomDataset())
+    state = get_rng_state()
+    first = dataset[(2, 42)]
+    second = dataset[(2, 42)]
+    assert first == second
+    # The global RNG of the caller is left untouched.
+    after = get_rng_state()
+    assert state['python'] == after['python']
+    assert torch.equal(state['torch'], after['torch'])
+
+
+def test_rng_state_roundtrip():
+    state = get_rng_state()
+    a = (random.random(), np.random.random(), torch.rand(1).item())
+    set_rng_state(state)
+    b = (random.random(), np.random.random(), torch.rand(1).item())
+    assert a == b
+
+
+def test_checkpoint_writer_rotation(tmpdir):
+    writer = CheckpointWriter(keep_last=2)
+    weight = torch.zeros(3)
+    for i in range(1, 5):
+        weight += 1
+        writer.save({'model_state': {'weight': weight}, 'iteration': i},
+                    os.path.join(str(tmpdir), 'dru_drive_iter_{}.pkl'.format(i)), group='iter')
+    writer.close()
+
+    assert sorted(os.listdir(str(tmpdir))) == ['dru_drive_iter_3.pkl', 'dru_drive_iter_4.pkl']
+    latest = latest_checkpoint(str(tmpdir))
+    assert os.path.basename(latest) == 'dru_drive_iter_4.pkl'
+    state = torch.load(latest)
+    assert state['iteration'] == 4
+    # The snapshot is taken at save time, not at write time.
+    assert torch.equal(state['model_state']['weight'], torch.full((3,), 4.))
+
+
+def test_checkpoint_writer_keeps_the_training_error(tmpdir):
+    missing = os.path.join(str(tmpdir), 'missing', 'dru_drive_best_model.pkl')
+    with pytest.raises(KeyError):
+        with CheckpointWriter() as writer:
+            writer.save({'iteration': 1}, missing)
+            raise KeyError('loss')
+    # Without an error in the block, a failed write is raised when leaving it.
+    with pytest.raises(FileNotFoundError):
+        with CheckpointWriter() as writer:
+            writer.save({'iteration': 1}, missing)
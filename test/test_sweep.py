@@ -0,0 +1,80 @@
+"""
+Testing the sweep grid and the successive halving pruner.
+
+"""
+import os
+
+import pytest
+
+from ptsemseg.sweep import expand_grid, trial_run_id, append_scalars, read_scalars, Trial, \
+    SuccessiveHalvingPruner, SweepRunner, check_script
+
+
+def _trial(tmpdir, name, ious, every=100):
+    logdir = os.path.join(str(tmpdir), name)
+    os.makedirs(logdir)
+    for k, iou in enumerate(ious):
+        append_scalars(logdir, (k + 1) * every, {"Mean IoU : \t": iou, "Overall Acc: \t": 0.9})
+    return Trial({'steps': name}, [], logdir, os.path.join(logdir, 'results.yml'), train_iters=1000)
+
+
+def test_expand_grid():
+    grid = expand_grid({'steps': [3, 6], 'gate': [2, 3], 'model': 'dru'})
+    assert len(grid) == 4
+    assert {'steps': 3, 'gate': 2, 'model': 'dru'} in grid
+    assert trial_run_id(grid[0]) == trial_run_id(dict(grid[0]))
+    assert trial_run_id(grid[0]) != trial_run_id(grid[1])
+
+
+def test_scalars_roundtrip(tmpdir):
+    append_scalars(str(tmpdir), 200, {"Mean IoU : \t": 0.5})
+    append_scalars(str(tmpdir), 100, {"Mean IoU : \t": 0.4})
+    records = read_scalars(str(tmpdir))
+    assert [r['iter'] for r in records] == [100, 200]
+    assert records[0]['Mean IoU'] == 0.4
+
+
+def test_successive_halving(tmpdir):
+    pruner = SuccessiveHalvingPruner(eta=3, min_fraction=0.1)
+    assert pruner.budgets(1000) == [100, 300, 900]
+
+    good = _trial(tmpdir, 'good', [0.7])
+    medium = _trial(tmpdir, 'medium', [0.6])
+    bad = _trial(tmpdir, 'bad', [0.3])
+    trials = [good, medium, bad]
+
+    assert not pruner.should_stop(good, trials)
+    assert pruner.should_stop(medium, trials)
+    assert pruner.should_stop(bad, trials)
+
+
+def test_no_pruning_without_peers(tmpdir):
+    pruner = SuccessiveHalvingPruner(eta=3, min_fraction=0.1)
+    good = _trial(tmpdir, 'good', [0.7])
+    bad = _trial(tmpdir, 'bad', [0.3])
+    # Not reached the first rung yet.
+    late = _trial(tmpdir, 'late', [])
+    assert not pruner.should_stop(bad, [good, bad, late])
+
+
+def test_promotion_is_not_undone_by_later_trials(tmpdir):
+    pruner = SuccessiveHalvingPruner(eta=3, min_fraction=0.1)
+    promoted = _trial(tmpdir, 'promoted', [0.7])
+    trials = [promoted, _trial(tmpdir, 'b', [0.3]), _trial(tmpdir, 'c', [0.2])]
+    assert not pruner.should_stop(promoted, trials)
+
+    # Better trials reach the first rung after it, it keeps running.
+    best, second = _trial(tmpdir, 'best', [0.9]), _trial(tmpdir, 'second', [0.85])
+    trials += [best, second]
+    assert not pruner.should_stop(promoted, trials)
+    assert not pruner.should_stop(best, trials)
+    assert pruner.should_stop(second, trials)
+
+
+def test_sweeps_only_run_train_drive():
+    check_script('train_drive.py')
+    check_script(os.path.join('..', 'train_drive.py'))
+    with pytest.raises(ValueError):
+        check_script('train_hand.py')
+    with pytest.raises(ValueError):
+        SweepRunner([], 'train_hand.py')
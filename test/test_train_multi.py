@@ -0,0 +1,65 @@
+"""
+Testing the shared batch training of several models.
+
+"""
+import os
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from ptsemseg.metrics import runningScore, averageMeter
+from ptsemseg.sweep import read_scalars
+from train_multi import ModelRun, train_multi
+
+
+class _NullWriter(object):
+    def add_scalar(self, *args):
+        pass
+
+
+class _TinyRun(ModelRun):
+    """`ModelRun` around a 1x1 convolution on the CPU."""
+    def __init__(self, logdir, cfg):
+        self.args = argparse.Namespace(hidden_size=0)
+        self.cfg = cfg
+        self.arch = 'unet'
+        self.n_classes = 2
+        self.logdir = logdir
+        self.writer = _NullWriter()
+        self.model = torch.nn.Conv2d(3, 2, 1)
+        self.optimizer = torch.optim.SGD(self.model.parameters(), lr=0.1)
+        self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, 10)
+        self.loss_fn = lambda input, target: F.cross_entropy(input, target)
+        self.running_metrics_val = runningScore(2)
+        self.val_loss_meter = averageMeter()
+        self.best_iou = -100.0
+        self.n_steps = 0
+
+    def train_step(self, images, labels):
+        self.n_steps += 1
+        return super(_TinyRun, self).train_step(images, labels)
+
+
+class _Sampler(object):
+    def set_epoch(self, epoch):
+        pass
+
+
+def test_train_multi_counts_like_train_drive(tmpdir):
+    cfg = {'model': {'arch': 'unet'}, 'data': {'dataset': 'drive'},
+           'training': {'train_iters': 5, 'val_interval': 2, 'print_interval': 1,
+                        'loss': {'name': 'cross_entropy'}}}
+    runs = [_TinyRun(os.path.join(str(tmpdir), name), cfg) for name in ['a', 'b']]
+    for run in runs:
+        os.makedirs(run.logdir)
+    batch = (torch.randn(2, 3, 8, 8), torch.randint(0, 2, (2, 8, 8)))
+    args = argparse.Namespace(device='cpu', benchmark=False)
+
+    train_multi(runs, cfg, args, _Sampler(), [batch] * 3, [batch])
+    for run in runs:
+        # train_drive.py stops at the batch with i + 1 == train_iters.
+        assert run.n_steps == 4
+        assert [r['iter'] for r in read_scalars(run.logdir)] == [2, 4, 5]
+        final = torch.load(os.path.join(run.logdir, 'unet_drive_final_model.pkl'))
+        assert final['epoch'] == 5
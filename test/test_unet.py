@@ -5,6 +5,9 @@ Testing the new implementation of UNET vs the old version.
 import torch
 from ptsemseg.models.unet import unet, GeneralUNet_v2, GeneralUNet, UNetBN, UNetGN
 from ptsemseg.models.recurrent_unet import GeneralRecurrentUnet, RecurrentUNetCell, UNetWithGRU, UNetOnlyHidden
+from ptsemseg.models import get_initial_states, model_forward
+from ptsemseg.models.dru import dru
+from ptsemseg.models.utils import resolution_schedule
 from ptsemseg.utils import get_argparser
 from utils import train_parser
 
@@ -154,6 +157,35 @@ def test_runet_with_different_level():
         _test_recurrent_output(out)
 
 
+def test_dru_coarse_to_fine():
+    assert resolution_schedule(4, 2, 0.5) == [0.5, 0.5, 1., 1.]
+    # The last step always runs at full resolution.
+    assert resolution_schedule(2, 5, 0.5) == [0.5, 1.]
+
+    inp = torch.rand(size=[2, 3, 64, 64])
+    h, s = torch.ones([2, 128, 4, 4]), torch.ones([2, 2, 64, 64])
+    model = dru(args, n_classes=2, steps=3, hidden_size=128, feature_scale=4, coarse_steps=2).eval()
+    out = model(inp, h, s)
+    assert len(out) == 3 and all(o.shape == (2, 2, 64, 64) for o in out)
+
+    # Without coarse steps, the forward is the plain recurrence.
+    model.coarse_steps = 0
+    out = model(inp, h, s)
+    for o in out:
+        h, s = model.step(inp, h, s)
+        assert torch.allclose(o, s)
+
+
+def test_initial_states():
+    images = torch.randn(2, 3, 64, 48)
+    h, s = get_initial_states('dru', images, 32, 2)
+    assert h.shape == (2, 32, 4, 3) and s.shape == (2, 2, 64, 48)
+    assert get_initial_states('unet', images, 32, 2) == ()
+
+    calls = []
+    model_forward(lambda *inputs: calls.append([x.shape for x in inputs]), 'recmid', images, 8, 2)
+    assert calls == [[images.shape, (2, 8, 4, 3)]]
+
 
 if __name__ == '__main__':
     # create_models()
@@ -164,4 +196,4 @@ if __name__ == '__main__':
 
     # test_unet_bngn()
     # test_unet_only_hidden()
-    # test_runet_with_different_level()
\ No newline at end of file
+    # test_runet_with_different_level()
@@ -0,0 +1,37 @@
+"""
+Testing the memory-mapped inference weights.
+
+"""
+import os
+from collections import OrderedDict
+
+import torch
+
+from ptsemseg.inference.weights import export_weights, read_weights, load_into, is_weights_file
+
+
+def test_weights_round_trip(tmpdir):
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.BatchNorm2d(4))
+    state = OrderedDict(('module.' + k, v) for k, v in model.state_dict().items())
+    checkpoint = os.path.join(str(tmpdir), 'model.pkl')
+    torch.save({'epoch': 7, 'model_state': state, 'optimizer_state': {}}, checkpoint)
+
+    path = os.path.join(str(tmpdir), 'model.weights')
+    assert export_weights(checkpoint, path) == {'epoch': 7}
+    assert is_weights_file(path) and not is_weights_file(checkpoint)
+
+    loaded, meta = read_weights(path)
+    assert meta == {'epoch': 7}
+    # The DataParallel prefix is gone, every tensor is kept with its type and shape.
+    assert list(loaded) == list(model.state_dict())
+    for k, v in model.state_dict().items():
+        assert loaded[k].dtype == v.dtype and torch.equal(loaded[k], v)
+
+    other = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.BatchNorm2d(4))
+    load_into(other, path, torch.device('cpu'))
+    x = torch.randn(1, 3, 8, 8)
+    assert torch.equal(other.eval()(x), model.eval()(x))
+    # Mapped copy-on-write, the file is never changed by the model.
+    with torch.no_grad():
+        other[0].weight.add_(1)
+    assert torch.equal(read_weights(path)[0]['0.weight'], model[0].weight)
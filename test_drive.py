@@ -8,6 +8,7 @@ import scipy.misc as misc
 from ptsemseg.models import get_model
 from ptsemseg.loader import get_loader, get_data_path
 from ptsemseg.utils import convert_state_dict
+from ptsemseg.inference.pipeline import list_images
 
 try:
     import pydensecrf.densecrf as dcrf
@@ -27,7 +28,6 @@ def test(args):
 
     # Setup image
     print("Read Input Image from : {}".format(args.img_path))
-    img_paths = []
     valid_images = [".jpg", ".gif", ".png", ".tga"]
 
     data_loader = get_loader(args.dataset)
@@ -43,27 +43,8 @@ def test(args):
     model.eval()
     model.to(device)
 
-    flag_subf = False
-    for f in os.listdir(args.img_path):
-        ext = os.path.splitext(f)[1]
-        if ext.lower() not in valid_images:
-            src_subpath = os.path.join(args.img_path, f)
-            tgt_subpath = os.path.join(args.out_path, f)
-            if os.path.exists(src_subpath):
-                if not os.path.exists(tgt_subpath):
-                    os.makedirs(tgt_subpath)
-                for subf in os.listdir(src_subpath):
-                    ext = os.path.splitext(subf)[1]
-                    if ext.lower() not in valid_images:
-                        continue
-                    img_paths.append(os.path.join(src_subpath, subf))
-                    flag_subf = True
-            else:
-                continue
-        else:
-            img_paths.append(os.path.join(args.img_path, f))
-
-    for img_path in img_paths:
+    # Images of sub-folders are written to sub-folders of --out_path.
+    for img_path, out_path in list_images(args.img_path, args.out_path, valid_images):
         img = misc.imread(img_path)
 
         resized_img = misc.imresize(
@@ -123,10 +104,6 @@ def test(args):
                 decoded = pred
                 print("Classes found: ", np.unique(pred))
                 img_name = os.path.basename(img_path)[:-4]
-                out_path = args.out_path
-                if flag_subf:
-                    parent_path = img_path.split(os.sep)[-2]
-                    out_path = os.path.join(out_path, parent_path)
                 if not os.path.exists(out_path):
                     os.makedirs(out_path)
                 img_path_target = os.path.join(out_path, img_name + '_step{}.png'.format(step+1))
@@ -164,10 +141,6 @@ def test(args):
             decoded = pred
             print("Classes found: ", np.unique(pred))
             img_name = os.path.basename(img_path)[:-4]
-            out_path = args.out_path
-            if flag_subf:
-                parent_path = img_path.split(os.sep)[-2]
-                out_path = os.path.join(out_path, parent_path)
             if not os.path.exists(out_path):
                 os.makedirs(out_path)
             img_path_target = os.path.join(out_path, img_name + '.png')
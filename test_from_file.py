@@ -4,6 +4,7 @@ Serve as a convenient wrapper for validate.py.
 """
 import gc
 import os
+import functools
 import timeit
 
 import IPython
@@ -15,6 +16,10 @@ import yaml
 
 from torch.utils import data
 from ptsemseg.loader import get_loader
+from ptsemseg.inference import tta_forward, tta_transforms
+from ptsemseg.inference.archive import PredictionArchiveWriter
+from ptsemseg.inference.cache import PredictionCache, CachedPredictor, cache_context
+from ptsemseg.inference.crf import CRFPredictor
 from ptsemseg.utils import get_logger
 
 from utils import test_parser
@@ -80,7 +85,7 @@ def _save_output(img_path_target, outputs, resized_img, loader, cfg):
     print("Segmentation Mask Saved at: {}".format(img_path_target))
 
 
-def output_masks_to_files(outputs, loader, resized_img, img_name, output_dir, args, cfg):
+def output_masks_to_files(outputs, loader, resized_img, img_name, output_dir, args, cfg, archive=None):
     """
     Save the prediction in ORIGINAL image size. to output_dir
 
@@ -90,11 +95,17 @@ def output_masks_to_files(outputs, loader, resized_img, img_name, output_dir, ar
     :param img_name: img_name
     :param args:
     :param cfg:
+    :param archive: `PredictionArchiveWriter`, the masks are added to it at the model resolution instead.
     :return:
     """
     # img_name = os.path.splitext(os.path.basename(img_path))[0]
     img_name = img_name.replace('/', '-')
     out_path = output_dir
+    if archive is not None:
+        outputs = outputs if args.is_recurrent else [outputs]
+        for step, output in enumerate(outputs):
+            archive.add(img_name, step + 1, np.squeeze(output, axis=0))
+        return
     if args.is_recurrent:
         for step, output in enumerate(outputs):
             img_path_target = os.path.join(out_path, img_name + '_step{}.png'.format(step + 1))
@@ -104,112 +115,18 @@ def output_masks_to_files(outputs, loader, resized_img, img_name, output_dir, ar
         _save_output(img_path_target, outputs, resized_img, loader, cfg)
 
 
-def _evaluate_from_model(model, images, args, cfg, n_classes, device):
+def _evaluate_from_model(model, images, args, cfg, n_classes, device, predictor=None):
     # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    if args.eval_flip:
-        # Flip images in numpy (not support in tensor)
-        flipped_images = np.copy(images.data.cpu().numpy()[:, :, :, ::-1])
-        flipped_images = torch.from_numpy(flipped_images).float().to(device)
-
-        if cfg['model']['arch'] in ['reclast']:
-            h0 = torch.ones([images.shape[0], args.hidden_size, images.shape[2], images.shape[3]],
-                            dtype=torch.float32, device=device)
-            outputs = model(images, h0)
-            outputs_flipped = model(flipped_images, h0)
-
-        elif cfg['model']['arch'] in ['recmid']:
-            W, H = images.shape[2], images.shape[3]
-            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                            dtype=torch.float32, device=device)
-            outputs = model(images, h0)
-            outputs_flipped = model(flipped_images, h0)
-
-        elif cfg['model']['arch'] in ['dru']:
-            W, H = images.shape[2], images.shape[3]
-            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                            dtype=torch.float32, device=device)
-            s0 = torch.ones([images.shape[0], n_classes, W, H],
-                            dtype=torch.float32, device=device)
-            outputs = model(images, h0, s0)
-            outputs_flipped = model(flipped_images, h0, s0)
-
-        elif cfg['model']['arch'] in ['druvgg16', 'druresnet50']:
-            W, H = images.shape[2], images.shape[3]
-            w, h = int(W / 2 ** 4), int(H / 2 ** 4)
-            if cfg['model']['arch'] in ['druresnet50']:
-                w, h = int(W / 2 ** 5), int(H / 2 ** 5)
-            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                            dtype=torch.float32, device=device)
-            s0 = torch.zeros([images.shape[0], n_classes, W, H],
-                             dtype=torch.float32, device=device)
-            outputs = model(images, h0, s0)
-            outputs_flipped = model(flipped_images, h0, s0)
-
-        else:
-            outputs = model(images)
-            outputs_flipped = model(flipped_images)
-
-        if type(outputs) is list:
-            outputs_list = [output.data.cpu().numpy() for output in outputs]
-            outputs_flipped_list = [output_flipped.data.cpu().numpy() for output_flipped in outputs_flipped]
-            outputs_list = [(outputs + outputs_flipped[:, :, :, ::-1]) / 2.0 for
-                            outputs, outputs_flipped in zip(outputs_list, outputs_flipped_list)]
-            pred = [np.argmax(outputs, axis=1) for outputs in outputs_list]
-        else:
-            outputs = outputs.data.cpu().numpy()
-            outputs_flipped = outputs_flipped.data.cpu().numpy()
-            outputs = (outputs + outputs_flipped[:, :, :, ::-1]) / 2.0
-            pred = np.argmax(outputs, axis=1)
-
+    # Original and flipped copies go through the model as one batch, merged on the device.
+    if predictor is not None:
+        outputs = predictor(images.to(device))
     else:
-        if cfg['model']['arch'] in ['reclast']:
-            h0 = torch.ones([images.shape[0], args.hidden_size, images.shape[2], images.shape[3]],
-                            dtype=torch.float32, device=device)
-            outputs = model(images, h0)
-
-        elif cfg['model']['arch'] in ['recmid']:
-            W, H = images.shape[2], images.shape[3]
-            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                            dtype=torch.float32, device=device)
-            outputs = model(images, h0)
-
-        elif cfg['model']['arch'] in ['dru']:
-            W, H = images.shape[2], images.shape[3]
-            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                            dtype=torch.float32, device=device)
-            s0 = torch.ones([images.shape[0], n_classes, W, H],
-                            dtype=torch.float32, device=device)
-            outputs = model(images, h0, s0)
-
-        elif cfg['model']['arch'] in ['druvgg16', 'druresnet50']:
-            W, H = images.shape[2], images.shape[3]
-            w, h = int(W / 2 ** 4), int(H / 2 ** 4)
-            if cfg['model']['arch'] in ['druresnet50']:
-                w, h = int(W / 2 ** 5), int(H / 2 ** 5)
-            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                            dtype=torch.float32, device=device)
-            s0 = torch.zeros([images.shape[0], n_classes, W, H],
-                             dtype=torch.float32, device=device)
-            outputs = model(images, h0, s0)
-
-        else:
-            outputs = model(images)
-
-        outputs_list = [output.data.cpu().numpy() for output in outputs]
-        if len(outputs_list)>1:
-            outputs_list = [output.data.cpu().numpy() for output in outputs]
-            pred = [np.argmax(outputs, axis=1) for outputs in outputs_list]
-        else:
-            outputs = outputs.data.cpu().numpy()
-            pred = np.argmax(outputs, axis=1)
+        outputs = tta_forward(model, cfg['model']['arch'], images.to(device), args.hidden_size, n_classes,
+                              tta_transforms(args))
+    if type(outputs) is list:
+        pred = [output.data.max(1)[1].cpu().numpy() for output in outputs]
+    else:
+        pred = outputs.data.max(1)[1].cpu().numpy()
 
     # if args.eval_flip:
     #     outputs = model(images)
@@ -290,6 +207,27 @@ def test_with_cfg(cfg, args):
     # model_name = cfg['model']['arch']
     # flag_subf = False
 
+    # With --cache_dir, the outputs of unchanged checkpoints and images are read back from the cache.
+    predictor = None
+    if getattr(args, 'cache_dir', ''):
+        predictor = CachedPredictor(
+            functools.partial(tta_forward, model, cfg['model']['arch'], hidden_size=args.hidden_size,
+                              n_classes=n_classes, transforms=tta_transforms(args)),
+            PredictionCache(args.cache_dir, int(args.cache_size_gb * (1 << 30))),
+            cache_context(model_path, cfg['model'], args, n_classes))
+    # With --crf, all the steps are refined in one batch by the built-in CRF.
+    if getattr(args, 'crf', False):
+        predictor = CRFPredictor(
+            predictor or functools.partial(tta_forward, model, cfg['model']['arch'], hidden_size=args.hidden_size,
+                                           n_classes=n_classes, transforms=tta_transforms(args)),
+            args.crf_iterations, args.crf_radius,
+            image_scale=1. if cfg['data']['dataset'] in ['drive'] else 255.)
+
+    archive = None
+    if getattr(args, 'archive', False):
+        # The void label of the ground truth is written in the masks as well.
+        archive = PredictionArchiveWriter(os.path.join(out_path, 'predictions.psar'), n_classes + 1)
+
     # Replace the entire loader, like doing the validation.
     # IPython.embed()
     with torch.no_grad():
@@ -306,7 +244,7 @@ def test_with_cfg(cfg, args):
             start_time = timeit.default_timer()
             images = images.to(device)
             n_classes = loader.n_classes
-            pred = _evaluate_from_model(model, images, args, cfg, n_classes, device)
+            pred = _evaluate_from_model(model, images, args, cfg, n_classes, device, predictor=predictor)
             gt = labels.numpy()
 
             # CHeck the org_lab == labels
@@ -344,7 +282,7 @@ def test_with_cfg(cfg, args):
                     pred[gt == 250] = 2
                     pred[pred == 2] = 0
 
-            output_masks_to_files(pred, loader, orig_img, img_name, out_path, args, cfg)
+            output_masks_to_files(pred, loader, orig_img, img_name, out_path, args, cfg, archive=archive)
 
             # Other unrelated stuff
             if args.measure_time:
@@ -356,6 +294,8 @@ def test_with_cfg(cfg, args):
                             i + 1, pred[-1].shape[0] / elapsed_time
                         )
                     )
+    if archive is not None:
+        archive.close()
 
 
 def run_test(args, run_dirs):
@@ -14,14 +14,17 @@ from torch.nn.modules.batchnorm import _BatchNorm
 from torch.utils import data
 from tqdm import tqdm
 import matplotlib.pyplot as plt
-from ptsemseg.models import get_model
+from ptsemseg.models import get_model, model_forward
 from ptsemseg.loss import get_loss_function
 from ptsemseg.loader import get_loader
+from ptsemseg.loader.sampler import ResumableRandomSampler, SeededDataset
 from ptsemseg.utils import get_logger
-from ptsemseg.metrics import runningScore, averageMeter
+from ptsemseg.metrics import runningScore, averageMeter, MetricsWorker
 from ptsemseg.augmentations import get_composed_augmentations
 from ptsemseg.schedulers import get_scheduler
 from ptsemseg.optimizers import get_optimizer
+from ptsemseg.checkpoint import CheckpointWriter, get_rng_state, set_rng_state, latest_checkpoint
+from ptsemseg.sweep import append_scalars
 
 from tensorboardX import SummaryWriter
 from ptsemseg.models.utils import MergeParametric
@@ -29,6 +32,7 @@ from utils_drive import train_parser, validate_parser, RNG_SEED
 from validate import validate, wrap_str
 from ptsemseg.models.sync_batchnorm.replicate import patch_replication_callback
 
+logger = logging.getLogger('ptsemseg')
 
 def best_model_path(cfg):
     return "{}_{}_best_model.pkl".format(
@@ -36,6 +40,19 @@ def best_model_path(cfg):
         cfg['data']['dataset'])
 
 
+def final_model_path(cfg):
+    return "{}_{}_final_model.pkl".format(
+        cfg['model']['arch'],
+        cfg['data']['dataset'])
+
+
+def iter_model_path(cfg, i):
+    return "{}_{}_iter_{}.pkl".format(
+        cfg['model']['arch'],
+        cfg['data']['dataset'],
+        i)
+
+
 def overwrite(cfg, args):
 
     if args.scale_weight > 0.:
@@ -48,6 +65,10 @@ def overwrite(cfg, args):
     cfg['model']['gate'] = args.gate
     cfg['model']['hidden_size'] = args.hidden_size
     cfg['model']['feature_scale'] = args.feature_scale
+    # Coarse-to-fine schedule of the recurrent steps.
+    if getattr(args, 'coarse_steps', 0) > 0 and cfg['model']['arch'] in ['dru', 'sru', 'JointSegCTLDireNetRecurrent']:
+        cfg['model']['coarse_steps'] = args.coarse_steps
+        cfg['model']['coarse_scale'] = args.coarse_scale
     if args.batch_size != 0:
         cfg['training']['batch_size'] = args.batch_size
     if args.lr_n != 0:
@@ -95,7 +116,7 @@ def load_cfg_with_overwrite(args):
 
     cfg = overwrite(cfg, args)
 
-    cfg['run_id'] = run_id = random.randint(1, 100000)
+    cfg['run_id'] = run_id = args.run_id or random.randint(1, 100000)
     config_name = os.path.basename(args.config)[:-4]
     config_name = args.model + '_' + config_name if len(args.model) > 0 else config_name
 
@@ -160,6 +181,8 @@ def load_cfg_with_overwrite(args):
     cfg['logdir'] = logdir
     # update the resume accordingly
     cfg['training']['resume'] = best_model_path(cfg)
+    if args.resume:
+        cfg['training']['resume'] = latest_checkpoint(args.resume) or args.resume
 
     # with open(os.path.join(logdir, 'config.yaml'), 'w') as fp:
     #     yaml.dump(cfg, fp, default_flow_style=False)
@@ -226,18 +249,58 @@ def init_model(model):
     #             print('error in init ... find this layer ', name)
 
 
-def train(cfg, writer, logger, args):
+def setup_model(cfg, args, n_classes):
+    model = get_model(cfg['model'], n_classes, args)  # .to(device)
 
-    # Setup seeds
-    torch.manual_seed(cfg.get('seed', RNG_SEED))
-    torch.cuda.manual_seed(cfg.get('seed', RNG_SEED))
-    np.random.seed(cfg.get('seed', RNG_SEED))
-    random.seed(cfg.get('seed', RNG_SEED))
+    if cfg['model']['arch'] not in ['unetvgg16', 'unetvgg16gn', 'druvgg16', 'unetresnet50', 'unetresnet50bn',
+                                    'druresnet50', 'druresnet50bn', 'druresnet50syncedbn']:
+        model.apply(weights_init)
+    else:
+        init_model(model)
+
+    model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
+    # if cfg['model']['arch'] in ['druresnet50syncedbn']:
+    #     print('using synchronized batch normalization')
+    #     time.sleep(5)
+    #     patch_replication_callback(model)
+
+    model = model.cuda()
+    # model = torch.nn.DataParallel(model, device_ids=(3, 2))
+    return model
+
+
+def setup_optimizer(cfg, model):
+    optimizer_cls = get_optimizer(cfg)
+    optimizer_params = {k:v for k, v in cfg['training']['optimizer'].items()
+                        if k != 'name'}
+    if cfg['model']['arch'] in ['unetvgg16', 'unetvgg16gn', 'druvgg16', 'druresnet50', 'druresnet50bn', 'druresnet50syncedbn']:
+        optimizer = optimizer_cls([
+            {'params': model.module.paramGroup1.parameters(), 'lr': optimizer_params['lr'] / 10},
+            {'params': model.module.paramGroup2.parameters()}
+        ], **optimizer_params)
+    else:
+        optimizer = optimizer_cls(model.parameters(), **optimizer_params)
+    logger.warning(f"Model parameters in total: {sum([p.numel() for p in model.parameters()])}")
+    logger.warning(f"Trainable parameters in total: {sum(p.numel() for p in model.parameters() if p.requires_grad)}")
+    logger.info("Using optimizer {}".format(optimizer))
+    return optimizer
+
+
+def predictions(cfg, outputs):
+    """Label map of the last recurrent step, left on the device of `outputs`."""
+    if cfg['training']['loss']['name'] in ['multi_step_cross_entropy']:
+        pred = outputs[-1].data.max(1)[1]
+    elif cfg['training']['loss']['name'] in ['multi_step_DiceLoss']:
+        pred = (outputs[-1].data >= 0.5).long()
+    else:
+        pred = outputs.data.max(1)[1]
+    return pred
 
-    # Setup device
-    # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    device = torch.device(args.device)
 
+def setup_dataloaders(cfg):
+    """Augmented train loader, sampled resumably, and the val loader.
+        :return: (train sampler, train loader, val loader, n_classes)
+    """
     # Setup Augmentations
     # augmentations = cfg['training'].get('augmentations', None)
     if cfg['data']['dataset'] in ['cityscapes']:
@@ -282,51 +345,50 @@ def train(cfg, writer, logger, args):
         img_size=(cfg['data']['img_rows'], cfg['data']['img_cols']),)
 
     n_classes = t_loader.n_classes
-    trainloader = data.DataLoader(t_loader,
+    # Shuffling and augmentations only depend on the seed, the epoch and the position in it,
+    # so that a resumed run sees the very same batches.
+    t_sampler = ResumableRandomSampler(t_loader, seed=cfg.get('seed', RNG_SEED))
+    trainloader = data.DataLoader(SeededDataset(t_loader),
                                   batch_size=cfg['training']['batch_size'],
                                   num_workers=cfg['training']['n_workers'],
-                                  shuffle=True)
+                                  sampler=t_sampler)
 
     valloader = data.DataLoader(v_loader,
                                 batch_size=cfg['training']['batch_size'],
                                 num_workers=cfg['training']['n_workers'])
+    return t_sampler, trainloader, valloader, n_classes
+
+
+def train(cfg, writer, logger, args):
+    # Both workers are flushed on the way out, so the best model is on disk before it is validated.
+    with CheckpointWriter(keep_last=cfg['training'].get('keep_checkpoints', 2)) as checkpoint_writer, \
+            MetricsWorker() as metrics_worker:
+        train_loop(cfg, writer, logger, args, checkpoint_writer, metrics_worker)
+
+
+def train_loop(cfg, writer, logger, args, checkpoint_writer, metrics_worker):
+
+    # Setup seeds
+    torch.manual_seed(cfg.get('seed', RNG_SEED))
+    torch.cuda.manual_seed(cfg.get('seed', RNG_SEED))
+    np.random.seed(cfg.get('seed', RNG_SEED))
+    random.seed(cfg.get('seed', RNG_SEED))
+
+    # Setup device
+    # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device(args.device)
+
+    t_sampler, trainloader, valloader, n_classes = setup_dataloaders(cfg)
 
     # Setup Metrics
     running_metrics_val = runningScore(n_classes, cfg['data']['void_class'] > 0)
 
     # Setup Model
     print('trying device {}'.format(device))
-    model = get_model(cfg['model'], n_classes, args)  # .to(device)
-
-    if cfg['model']['arch'] not in ['unetvgg16', 'unetvgg16gn', 'druvgg16', 'unetresnet50', 'unetresnet50bn',
-                                    'druresnet50', 'druresnet50bn', 'druresnet50syncedbn']:
-        model.apply(weights_init)
-    else:
-        init_model(model)
-
-    model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
-    # if cfg['model']['arch'] in ['druresnet50syncedbn']:
-    #     print('using synchronized batch normalization')
-    #     time.sleep(5)
-    #     patch_replication_callback(model)
-
-    model = model.cuda()
-    # model = torch.nn.DataParallel(model, device_ids=(3, 2))
+    model = setup_model(cfg, args, n_classes)
 
     # Setup optimizer, lr_scheduler and loss function
-    optimizer_cls = get_optimizer(cfg)
-    optimizer_params = {k:v for k, v in cfg['training']['optimizer'].items()
-                        if k != 'name'}
-    if cfg['model']['arch'] in ['unetvgg16', 'unetvgg16gn', 'druvgg16', 'druresnet50', 'druresnet50bn', 'druresnet50syncedbn']:
-        optimizer = optimizer_cls([
-            {'params': model.module.paramGroup1.parameters(), 'lr': optimizer_params['lr'] / 10},
-            {'params': model.module.paramGroup2.parameters()}
-        ], **optimizer_params)
-    else:
-        optimizer = optimizer_cls(model.parameters(), **optimizer_params)
-    logger.warning(f"Model parameters in total: {sum([p.numel() for p in model.parameters()])}")
-    logger.warning(f"Trainable parameters in total: {sum(p.numel() for p in model.parameters() if p.requires_grad)}")
-    logger.info("Using optimizer {}".format(optimizer))
+    optimizer = setup_optimizer(cfg, model)
 
     scheduler = get_scheduler(optimizer, cfg['training']['lr_schedule'])
 
@@ -334,16 +396,26 @@ def train(cfg, writer, logger, args):
     logger.info("Using loss {}".format(loss_fn))
 
     start_iter = 0
+    data_epoch, data_batch = 0, 0
+    best_iou = -100.0
+    rng_state = None
     if cfg['training']['resume'] is not None:
         if os.path.isfile(cfg['training']['resume']):
             logger.info(
                 "Loading model and optimizer from checkpoint '{}'".format(cfg['training']['resume'])
             )
-            checkpoint = torch.load(cfg['training']['resume'])
+            checkpoint = torch.load(cfg['training']['resume'], map_location=lambda storage, loc: storage)
             model.load_state_dict(checkpoint["model_state"])
             optimizer.load_state_dict(checkpoint["optimizer_state"])
             scheduler.load_state_dict(checkpoint["scheduler_state"])
             start_iter = checkpoint["epoch"]
+            if "iteration" in checkpoint:
+                # Full training state, continue at the exact iteration and batch.
+                start_iter = checkpoint["iteration"]
+                data_epoch = checkpoint["data_state"]["epoch"]
+                data_batch = checkpoint["data_state"]["batch"]
+                best_iou = checkpoint["best_iou"]
+                rng_state = checkpoint["rng_state"]
             logger.info(
                 "Loaded checkpoint '{}' (iter {})".format(
                     cfg['training']['resume'], checkpoint["epoch"]
@@ -355,7 +427,6 @@ def train(cfg, writer, logger, args):
     val_loss_meter = averageMeter()
     time_meter = averageMeter()
 
-    best_iou = -100.0
     i = start_iter
     flag = True
 
@@ -367,9 +438,15 @@ def train(cfg, writer, logger, args):
 
     logger.info("Set the prediction weights as {}".format(weight))
 
+    if rng_state is not None:
+        set_rng_state(rng_state)
+        logger.info("Resuming at iter {}, epoch {}, batch {}".format(i, data_epoch, data_batch))
+
     while i <= cfg['training']['train_iters'] and flag:
+        t_sampler.set_epoch(data_epoch, data_batch * cfg['training']['batch_size'])
         for (images, labels) in trainloader:
             i += 1
+            data_batch += 1
             start_ts = time.time()
             # scheduler.step()
             model.train()
@@ -390,46 +467,7 @@ def train(cfg, writer, logger, args):
             labels = labels.to(device)
 
             optimizer.zero_grad()
-            if cfg['model']['arch'] in ['reclast']:
-                h0 = torch.ones([images.shape[0], args.hidden_size, images.shape[2], images.shape[3]],
-                                dtype=torch.float32)
-                h0.to(device)
-                outputs = model(images, h0)
-
-            elif cfg['model']['arch'] in ['recmid']:
-                W, H = images.shape[2], images.shape[3]
-                w = int(np.floor(np.floor(np.floor(W/2)/2)/2)/2)
-                h = int(np.floor(np.floor(np.floor(H/2)/2)/2)/2)
-                h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                dtype=torch.float32)
-                h0.to(device)
-                outputs = model(images, h0)
-
-            elif cfg['model']['arch'] in ['dru', 'sru']:
-                W, H = images.shape[2], images.shape[3]
-                w = int(np.floor(np.floor(np.floor(W/2)/2)/2)/2)
-                h = int(np.floor(np.floor(np.floor(H/2)/2)/2)/2)
-                h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                dtype=torch.float32)
-                h0.to(device)
-                s0 = torch.ones([images.shape[0], n_classes, W, H],
-                                dtype=torch.float32)
-                s0.to(device)
-                outputs = model(images, h0, s0)
-
-            elif cfg['model']['arch'] in ['druvgg16', 'druresnet50', 'druresnet50bn', 'druresnet50syncedbn']:
-                W, H = images.shape[2], images.shape[3]
-                w, h = int(W / 2 ** 4), int(H / 2 ** 4)
-                if cfg['model']['arch'] in ['druresnet50', 'druresnet50bn', 'druresnet50syncedbn']:
-                    w, h = int(W / 2 ** 5), int(H / 2 ** 5)
-                h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                dtype=torch.float32, device=device)
-                s0 = torch.zeros([images.shape[0], n_classes, W, H],
-                                 dtype=torch.float32, device=device)
-                outputs = model(images, h0, s0)
-
-            else:
-                outputs = model(images)
+            outputs = model_forward(model, cfg['model']['arch'], images, args.hidden_size, n_classes)
 
             loss = loss_fn(outputs, labels)
             loss.backward()
@@ -479,59 +517,12 @@ def train(cfg, writer, logger, args):
 
                         images_val = images_val.to(device)
                         labels_val = labels_val.to(device)
-                        if cfg['model']['arch'] in ['reclast']:
-                            h0 = torch.ones([images_val.shape[0], args.hidden_size, images_val.shape[2], images_val.shape[3]],
-                                            dtype=torch.float32)
-                            h0.to(device)
-                            outputs = model(images_val, h0)
-
-                        elif cfg['model']['arch'] in ['recmid']:
-                            W, H = images_val.shape[2], images_val.shape[3]
-                            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-                            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-                            h0 = torch.ones([images_val.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32)
-                            h0.to(device)
-                            outputs = model(images_val, h0)
-
-                        elif cfg['model']['arch'] in ['dru', 'sru']:
-                            W, H = images_val.shape[2], images_val.shape[3]
-                            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-                            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-                            h0 = torch.ones([images_val.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32)
-                            h0.to(device)
-                            s0 = torch.ones([images_val.shape[0], n_classes, W, H],
-                                            dtype=torch.float32)
-                            s0.to(device)
-                            outputs = model(images_val, h0, s0)
-
-                        elif cfg['model']['arch'] in ['druvgg16', 'druresnet50', 'druresnet50bn', 'druresnet50syncedbn']:
-                            W, H = images_val.shape[2], images_val.shape[3]
-                            w, h = int(W / 2**4), int(H / 2**4)
-                            if cfg['model']['arch'] in ['druresnet50', 'druresnet50bn', 'druresnet50syncedbn']:
-                                w, h = int(W / 2 ** 5), int(H / 2 ** 5)
-                            h0 = torch.ones([images_val.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32)
-                            h0.to(device)
-                            s0 = torch.zeros([images_val.shape[0], n_classes, W, H],
-                                             dtype=torch.float32)
-                            s0.to(device)
-                            outputs = model(images_val, h0, s0)
-
-                        else:
-                            outputs = model(images_val)
+                        outputs = model_forward(model, cfg['model']['arch'], images_val, args.hidden_size,
+                                                n_classes)
                         val_loss = loss_fn(input=outputs, target=labels_val)
 
-                        if cfg['training']['loss']['name'] in ['multi_step_cross_entropy']:
-                            pred = outputs[-1].data.max(1)[1].cpu().numpy()
-                        elif cfg['training']['loss']['name'] in ['multi_step_DiceLoss']:
-                            pred = outputs[-1].data.cpu().numpy()
-                            pred[pred>=0.5]=1
-                            pred[pred<0.5]=0
-                        else:
-                            pred = outputs.data.max(1)[1].cpu().numpy()
-                        gt = labels_val.data.cpu().numpy()
+                        pred = predictions(cfg, outputs)
+                        gt = labels_val.data
 
 
                         # #----------------- 显示验证结果
@@ -544,9 +535,12 @@ def train(cfg, writer, logger, args):
 
                         logger.debug('pred shape: ', pred.shape, '\t ground-truth shape:',gt.shape)
                         # IPython.embed()
-                        running_metrics_val.update(gt, pred.astype(int))
-                        val_loss_meter.update(val_loss.item())
+                        # Accumulated on the device, synced once in `get_scores`. The loss is read
+                        # on the worker as well, so the next forward is queued without waiting.
+                        metrics_worker.submit(running_metrics_val.update, gt, pred)
+                        metrics_worker.submit(lambda loss: val_loss_meter.update(loss.item()), val_loss)
                     # assert i_val > 0, "Validation dataset is empty for no reason."
+                    metrics_worker.wait()
                 torch.backends.cudnn.benchmark = True
                 writer.add_scalar('loss/val_loss', val_loss_meter.avg, i+1)
                 logger.info("Iter %d Loss: %.4f" % (i + 1, val_loss_meter.avg))
@@ -560,31 +554,52 @@ def train(cfg, writer, logger, args):
                 for k, v in class_iou.items():
                     logger.info('{}: {}'.format(k, v))
                     writer.add_scalar('val_metrics/cls_{}'.format(k), v, i+1)
+                # Mirrored for the sweep pruner.
+                append_scalars(writer.file_writer.get_logdir(), i + 1, score)
 
                 val_loss_meter.reset()
                 running_metrics_val.reset()
 
+                state = {
+                    "epoch": i + 1,
+                    "model_state": model.state_dict(),
+                    "optimizer_state": optimizer.state_dict(),
+                    "scheduler_state": scheduler.state_dict(),
+                    "best_iou": max(best_iou, score["Mean IoU : \t"]),
+                    "iteration": i,
+                    "data_state": {"epoch": data_epoch, "batch": data_batch},
+                    "rng_state": get_rng_state(),
+                }
+                # Written in the background, only the latest `keep_checkpoints` are kept.
+                checkpoint_writer.save(state,
+                                       os.path.join(writer.file_writer.get_logdir(), iter_model_path(cfg, i + 1)),
+                                       group='iter')
                 if score["Mean IoU : \t"] >= best_iou:
                     best_iou = score["Mean IoU : \t"]
-                    state = {
-                        "epoch": i + 1,
-                        "model_state": model.state_dict(),
-                        "optimizer_state": optimizer.state_dict(),
-                        "scheduler_state": scheduler.state_dict(),
-                        "best_iou": best_iou,
-                    }
                     save_path = os.path.join(writer.file_writer.get_logdir(),
                                              best_model_path(cfg))
-                    torch.save(state, save_path)
+                    checkpoint_writer.save(state, save_path)
 
             if (i + 1) == cfg['training']['train_iters']:
                 flag = False
+                # Save the current weights, `state` is only defined once a validation has run.
+                state = {
+                    "epoch": i + 1,
+                    "model_state": model.state_dict(),
+                    "optimizer_state": optimizer.state_dict(),
+                    "scheduler_state": scheduler.state_dict(),
+                    "best_iou": best_iou,
+                    "iteration": i,
+                    "data_state": {"epoch": data_epoch, "batch": data_batch},
+                    "rng_state": get_rng_state(),
+                }
                 save_path = os.path.join(writer.file_writer.get_logdir(),
-                                         "{}_{}_final_model.pkl".format(
-                                             cfg['model']['arch'],
-                                             cfg['data']['dataset']))
-                torch.save(state, save_path)
+                                         final_model_path(cfg))
+                checkpoint_writer.save(state, save_path)
                 break
+        else:
+            data_epoch += 1
+            data_batch = 0
 
 
 if __name__ == "__main__":
@@ -48,6 +48,10 @@ def overwrite(cfg, args):
     cfg['model']['gate'] = args.gate
     cfg['model']['hidden_size'] = args.hidden_size
     cfg['model']['feature_scale'] = args.feature_scale
+    # Coarse-to-fine schedule of the recurrent steps.
+    if getattr(args, 'coarse_steps', 0) > 0 and cfg['model']['arch'] in ['dru', 'sru', 'JointSegCTLDireNetRecurrent']:
+        cfg['model']['coarse_steps'] = args.coarse_steps
+        cfg['model']['coarse_scale'] = args.coarse_scale
     if args.batch_size != 0:
         cfg['training']['batch_size'] = args.batch_size
     if args.lr_n != 0:
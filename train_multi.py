@@ -0,0 +1,211 @@
+"""
+Train several models in one process, from a single augmented batch stream.
+
+Every batch is decoded, augmented and moved to the device once, then each model
+takes its own optimizer step on it. Each model keeps its own config, optimizer,
+scheduler, loss, metrics and run directory, exactly as if it had been trained by
+`train_drive.py` with the same flags.
+
+python train_multi.py --config=configs/dataset/drive.yml --models=dru,sru,recmid,reclast,unet \
+    --losses=multi_step_cross_entropy,multi_step_cross_entropy,multi_step_cross_entropy,multi_step_cross_entropy,cross_entropy
+"""
+import os
+import copy
+import random
+import logging
+
+import yaml
+import torch
+import numpy as np
+from tqdm import tqdm
+
+from tensorboardX import SummaryWriter
+
+from ptsemseg.models import model_forward
+from ptsemseg.loss import get_loss_function
+from ptsemseg.utils import get_logger
+from ptsemseg.metrics import runningScore, averageMeter
+from ptsemseg.schedulers import get_scheduler
+from ptsemseg.checkpoint import CheckpointWriter
+from ptsemseg.sweep import append_scalars
+from utils_drive import train_parser, validate_parser, RNG_SEED
+from train_drive import load_cfg_with_overwrite, setup_dataloaders, setup_model, setup_optimizer, predictions, \
+    best_model_path, final_model_path
+from validate import validate
+
+logger = logging.getLogger('ptsemseg')
+
+
+class ModelRun(object):
+    """One of the models trained on the shared batches, with everything that is not shared."""
+    def __init__(self, args, cfg, n_classes):
+        """
+        :param args: flags of this model, `args.model` and `args.loss` set.
+        :param cfg: config of this model, from `load_cfg_with_overwrite(args)`.
+        """
+        self.args = args
+        self.cfg = cfg
+        self.arch = cfg['model']['arch']
+        self.n_classes = n_classes
+        self.logdir = cfg['logdir']
+        self.writer = SummaryWriter(log_dir=self.logdir)
+        with open(os.path.join(self.logdir, 'config.yaml'), 'w') as fp:
+            yaml.dump(cfg, fp, default_flow_style=False)
+
+        self.model = setup_model(cfg, args, n_classes)
+        self.optimizer = setup_optimizer(cfg, self.model)
+        self.scheduler = get_scheduler(self.optimizer, cfg['training']['lr_schedule'])
+        self.loss_fn = get_loss_function(cfg)
+        self.running_metrics_val = runningScore(n_classes, cfg['data']['void_class'] > 0)
+        self.val_loss_meter = averageMeter()
+        self.best_iou = -100.0
+        logger.info("{}: loss {}, logdir {}".format(self.arch, self.loss_fn, self.logdir))
+
+    def train_step(self, images, labels):
+        self.model.train()
+        self.optimizer.zero_grad()
+        outputs = model_forward(self.model, self.arch, images, self.args.hidden_size, self.n_classes)
+        loss = self.loss_fn(outputs, labels)
+        loss.backward()
+        self.optimizer.step()
+        return loss.item()
+
+    def val_step(self, images, labels):
+        outputs = model_forward(self.model, self.arch, images, self.args.hidden_size, self.n_classes)
+        self.val_loss_meter.update(self.loss_fn(input=outputs, target=labels).item())
+        pred = predictions(self.cfg, outputs)
+        self.running_metrics_val.update(labels.data, pred)
+
+    def state(self, i):
+        return {
+            "epoch": i + 1,
+            "model_state": self.model.state_dict(),
+            "optimizer_state": self.optimizer.state_dict(),
+            "scheduler_state": self.scheduler.state_dict(),
+            "best_iou": self.best_iou,
+        }
+
+
+def model_args(args, name, loss):
+    """Flags of the model `name`, the other flags are shared."""
+    run_args = copy.copy(args)
+    run_args.model = name
+    if loss:
+        run_args.loss = loss
+    return run_args
+
+
+def validate_runs(runs, valloader, i, device, checkpoint_writer, benchmark=False):
+    """One pass over the validation set, every batch is fed to all the models."""
+    torch.backends.cudnn.benchmark = False
+    for run in runs:
+        run.model.eval()
+    with torch.no_grad():
+        for i_val, (images_val, labels_val) in tqdm(enumerate(valloader)):
+            if benchmark and i_val > 10:
+                break
+            images_val = images_val.to(device)
+            labels_val = labels_val.to(device)
+            for run in runs:
+                run.val_step(images_val, labels_val)
+    torch.backends.cudnn.benchmark = True
+
+    for run in runs:
+        run.writer.add_scalar('loss/val_loss', run.val_loss_meter.avg, i + 1)
+        score, class_iou, _ = run.running_metrics_val.get_scores()
+        logger.info("{} Iter {:d} Loss: {:.4f} Mean IoU: {:.4f}".format(
+            run.arch, i + 1, run.val_loss_meter.avg, score["Mean IoU : \t"]))
+        for k, v in score.items():
+            run.writer.add_scalar('val_metrics/{}'.format(k), v, i + 1)
+        for k, v in class_iou.items():
+            run.writer.add_scalar('val_metrics/cls_{}'.format(k), v, i + 1)
+        append_scalars(run.logdir, i + 1, score)
+        run.val_loss_meter.reset()
+        run.running_metrics_val.reset()
+
+        if score["Mean IoU : \t"] >= run.best_iou:
+            run.best_iou = score["Mean IoU : \t"]
+            checkpoint_writer.save(run.state(i), os.path.join(run.logdir, best_model_path(run.cfg)))
+
+
+def train_multi(runs, cfg, args, t_sampler, trainloader, valloader):
+    """
+    :param runs: list of `ModelRun`.
+    :param cfg: config of the first model, its data and training schedule are shared.
+    """
+    device = torch.device(args.device)
+    # Same iteration counter as train_drive.py: incremented first, the last batch is at i + 1 == train_iters.
+    i = 0
+    epoch = 0
+    flag = True
+    with CheckpointWriter() as checkpoint_writer:
+        while i <= cfg['training']['train_iters'] and flag:
+            t_sampler.set_epoch(epoch)
+            for (images, labels) in trainloader:
+                i += 1
+                # Decoded, augmented and copied to the device once for all the models.
+                images = images.to(device)
+                labels = labels.to(device)
+                for run in runs:
+                    loss = run.train_step(images, labels)
+                    if (i + 1) % cfg['training']['print_interval'] == 0:
+                        logger.info("{} Iter [{:d}/{:d}]  Loss: {:.4f}".format(
+                            run.arch, i + 1, cfg['training']['train_iters'], loss))
+                        run.writer.add_scalar('loss/train_loss', loss, i + 1)
+
+                if (i + 1) % cfg['training']['val_interval'] == 0 or \
+                   (i + 1) == cfg['training']['train_iters']:
+                    validate_runs(runs, valloader, i, device, checkpoint_writer, args.benchmark)
+
+                if (i + 1) == cfg['training']['train_iters']:
+                    flag = False
+                    for run in runs:
+                        checkpoint_writer.save(run.state(i), os.path.join(run.logdir, final_model_path(run.cfg)))
+                    break
+            else:
+                epoch += 1
+
+
+if __name__ == "__main__":
+    parser = train_parser()
+    parser.add_argument("--models", nargs="?", type=str, default="dru,sru",
+                        help="comma separated architectures trained together")
+    parser.add_argument("--losses", nargs="?", type=str, default="",
+                        help="comma separated losses, one per model, --loss for all if empty")
+    args = parser.parse_args()
+
+    names = [m.strip() for m in args.models.split(',') if m.strip()]
+    losses = [l.strip() for l in args.losses.split(',')] if args.losses else [''] * len(names)
+    assert len(losses) == len(names), "--losses needs one loss per model in --models"
+
+    run_args = [model_args(args, name, loss) for name, loss in zip(names, losses)]
+    cfgs = [load_cfg_with_overwrite(a) for a in run_args]
+    for c in cfgs[1:]:
+        assert c['data'] == cfgs[0]['data'], "All the models must be trained on the same data"
+    cfg = cfgs[0]
+
+    logger = get_logger(cfg['logdir'], level=logging.WARN if args.prefix == 'benchmark' else logging.INFO)
+    logger.info('Training {} from one data pipeline'.format(', '.join(names)))
+
+    seed = cfg.get('seed', RNG_SEED)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    t_sampler, trainloader, valloader, n_classes = setup_dataloaders(cfg)
+    runs = [ModelRun(a, c, n_classes) for a, c in zip(run_args, cfgs)]
+
+    try:
+        train_multi(runs, cfg, args, t_sampler, trainloader, valloader)
+    except (KeyboardInterrupt) as e:
+        logger.error(e)
+
+    valid_parser = validate_parser(parser)
+    valid_args = valid_parser.parse_args()
+    if args.prefix == 'benchmark':
+        valid_args.benchmark = True
+    for run in runs:
+        logger.info("\nValidate the training result of {}...".format(run.arch))
+        valid_args.model_path = os.path.join(run.logdir, best_model_path(run.cfg))
+        validate(run.cfg, valid_args)
@@ -22,6 +22,9 @@ def train_parser():
     parser.add_argument("--device", nargs="?", type=str, default="cuda:0", help="GPU or CPU to use")
     parser.add_argument("--model", nargs="?", type=str, default="", help="set the model")
     parser.add_argument("--steps", nargs="?", type=int, default=4, help="Recurrent Steps")
+    parser.add_argument("--coarse_steps", nargs="?", type=int, default=0,
+                        help="dru/sru: first recurrent steps run at --coarse_scale of the resolution")
+    parser.add_argument("--coarse_scale", nargs="?", type=float, default=0.5, help="scale of the coarse steps")
     parser.add_argument("--clip", nargs="?", type=float, default=10., help="gradient clip threshold")
     parser.add_argument("--hidden_size", nargs="?", type=int, default=32, help="hidden size")#32
     parser.add_argument("--unet_level", nargs="?", type=int, default=4, help="unet_level")
@@ -37,6 +40,9 @@ def train_parser():
     parser.add_argument("--batch_size", nargs="?", type=int, default=0, help="batch size")
     parser.add_argument("--lr_n", nargs="?", type=int, default=0, help="learning rate n")
     parser.add_argument("--lr_exponent", nargs="?", type=int, default=0, help="learning rate exponent")
+    parser.add_argument("--resume", nargs="?", type=str, default="",
+                        help="checkpoint or run directory to resume training from")
+    parser.add_argument("--run_id", nargs="?", type=int, default=0, help="run id, random if 0")
 
     parser.add_argument(
         '--benchmark',
@@ -95,6 +101,35 @@ def validate_parser(parser=None):
                                   True by default",
     )
     parser.set_defaults(eval_flip=True)
+    parser.add_argument("--tta", nargs="?", type=str, default="",
+                        help="extra test-time augmentations, comma separated among vflip, rot90")
+    parser.add_argument("--tile_size", nargs="?", type=int, default=0,
+                        help="sliding-window inference on tiles of this size, 0 for whole images")
+    parser.add_argument("--tile_overlap", nargs="?", type=float, default=0.25, help="overlap between tiles")
+    parser.add_argument("--tile_batch_size", nargs="?", type=int, default=4, help="tiles per forward")
+    parser.add_argument("--tile_blending", nargs="?", type=str, default="gaussian", help="gaussian or uniform")
+    parser.add_argument("--sparse_tiles", dest="sparse_tiles", action="store_true",
+                        help="Skip the tiles outside of the FOV / valid pixels of the dataset | False by default")
+    parser.set_defaults(sparse_tiles=False)
+    parser.add_argument("--cache_dir", nargs="?", type=str, default="",
+                        help="cache of the model outputs, keyed by checkpoint, flags and image, empty to disable")
+    parser.add_argument("--cache_size_gb", nargs="?", type=float, default=20., help="size bound of --cache_dir")
+    parser.add_argument("--crf", dest="crf", action="store_true",
+                        help="Batched mean-field CRF refinement of every step, no pydensecrf needed | False by default")
+    parser.set_defaults(crf=False)
+    parser.add_argument("--crf_iterations", nargs="?", type=int, default=10, help="mean-field iterations of --crf")
+    parser.add_argument("--crf_radius", nargs="?", type=int, default=4, help="half size of the --crf message window")
+    parser.add_argument("--archive", dest="archive", action="store_true",
+                        help="Store the step masks in one indexed archive instead of PNGs | False by default")
+    parser.add_argument("--archive_probs", dest="archive_probs", action="store_true",
+                        help="Also store the quantized probabilities in the archive | False by default")
+    parser.set_defaults(archive=False, archive_probs=False)
+    parser.add_argument("--refine_tile_size", nargs="?", type=int, default=0,
+                        help="dru/sru: run the steps 2..N only on the uncertain tiles of this size, 0 to disable")
+    parser.add_argument("--refine_confidence", nargs="?", type=float, default=0.9,
+                        help="pixels below this class probability are refined")
+    parser.add_argument("--refine_change", nargs="?", type=float, default=0.05,
+                        help="pixels whose probability changed more than this at the last step are refined")
 
 
     parser.add_argument(
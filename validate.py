@@ -15,10 +15,14 @@ from torch.backends import cudnn
 from torch.utils import data
 
 from ptsemseg.models import get_model
+from ptsemseg.inference import get_predictor, tta_transforms, SparseRefiner
+from ptsemseg.inference.archive import PredictionArchiveWriter
+from ptsemseg.inference.cache import PredictionCache, CachedPredictor, cache_context
+from ptsemseg.inference.crf import CRFPredictor
+from ptsemseg.inference.weights import load_into
 from ptsemseg.loader import get_loader, get_void_class
 from ptsemseg.utils import get_logger, clean_logger
-from ptsemseg.metrics import runningScore
-from ptsemseg.utils import convert_state_dict
+from ptsemseg.metrics import runningScore, fovScore, MetricsWorker
 from utils import validate_parser
 torch.backends.cudnn.benchmark = True
 
@@ -44,6 +48,88 @@ def result_root(cfg, create=False, appe=None):
     return logdir
 
 
+def step_probabilities(outputs_list):
+    """Vessel probability of every step, [steps, N, W, H], from the per-step outputs (tensors or numpy).
+
+    Single channel outputs (Dice) already are probabilities, two channel outputs are logits.
+    """
+    probs = []
+    for output in outputs_list:
+        if not isinstance(output, torch.Tensor):
+            output = torch.from_numpy(np.ascontiguousarray(output))
+        probs.append(output[:, 0] if output.shape[1] == 1 else torch.softmax(output, dim=1)[:, 1])
+    return torch.stack(probs)
+
+
+def step_masks(outputs_list):
+    """Predicted labels of every step as a uint8 [steps, N, W, H] tensor, on the device of the outputs.
+
+    Single channel outputs are thresholded at 0.5, others go through an argmax over the classes (as
+    `predictions` in train_drive.py). Multi-channel outputs used to be thresholded at 0.5 channel by
+    channel, which only scored the first (background) channel against the labels.
+    """
+    return torch.stack([(output[:, 0] >= 0.5) if output.shape[1] == 1 else output.max(1)[1]
+                        for output in outputs_list]).to(torch.uint8)
+
+
+def log_fov_scores(logger, fov_metrics, results):
+    """Logs the DRIVE FOV metrics of every step and adds them to `results` ({step: {}})."""
+    for j, score in enumerate(fov_metrics.get_scores()):
+        logger.info('FOV metrics, RNN step {}'.format(j + 1))
+        results.setdefault(j, {})
+        for k, v in score.items():
+            logger.info(wrap_str("FOV " + k, v))
+            results[j]["FOV " + k] = float(v)
+
+
+def score_recurrent_batch(args, running_metrics, masks, labels, img_name, void_classes=None, archive=None,
+                          probs=None):
+    """Writes out the step masks of a batch and updates the per-step scorers.
+
+    Runs on the `MetricsWorker` thread.
+    :param masks: uint8 [steps, N, W, H] host tensor of the predicted labels.
+    :param void_classes: set to mask the predictions with the void pixels of the ground truth (ROI only).
+    :param archive: `PredictionArchiveWriter` the masks are added to, instead of one PNG per step.
+    :param probs: uint8 [steps, N, W, H] host tensor of quantized probabilities stored in the archive, or None.
+    """
+    pred = list(masks.numpy())
+
+    out_path = args.out_path
+    if args.is_recurrent and archive is not None:
+        for step, output in enumerate(pred):
+            prob = np.squeeze(probs[step].numpy()) if probs is not None else None
+            archive.add(img_name, step + 1, np.squeeze(output), prob)
+    elif args.is_recurrent:
+        print(f"Save the output to : {out_path}")
+        for step, output in enumerate(pred):
+            img_path_target = os.path.join(out_path, img_name + '_step{}.png'.format(step + 1))
+            output = np.squeeze(output)
+            # img = np.array(Image.fromarray(myImage).resize((num_px,num_px)))
+            # output = output.resize((584, 565))
+            # output = misc.imresize(output, (584, 565), "nearest", mode="F")
+            imwrite(img_path_target, output * 255)
+    gt = labels.numpy()
+
+    if void_classes is not None:
+        """ Process for ROI, basically, mask the Pred based on GT"""
+        for k in range(len(pred)):
+            pred[k] = np.where(gt == void_classes, void_classes, pred[k])
+
+    for k in range(len(pred)):
+        running_metrics[k].update(gt, pred[k].astype(int), step=k)
+
+
+def score_batch(running_metrics, pred, labels, void_classes=None):
+    """Non-recurrent counterpart of `score_recurrent_batch`, `pred` is a [N, W, H] host tensor."""
+    pred = pred.numpy().astype(int)
+    gt = labels.numpy()
+
+    if void_classes is not None:
+        pred = np.where(gt == void_classes, void_classes, pred)
+
+    running_metrics.update(gt, pred)
+
+
 def load_model_and_preprocess(cfg, args, n_classes, device):
     if 'NoParamShare' in cfg['model']['arch']:
         args.steps = cfg['model']['steps']
@@ -53,13 +139,9 @@ def load_model_and_preprocess(cfg, args, n_classes, device):
     else:
         model_path = pjoin(cfg['logdir'],cfg['training']['resume'])
     # print(model)
-    state = convert_state_dict(torch.load(model_path, map_location=lambda storage, loc: storage)["model_state"])
-
-    # IPython.embed()
-
-    model.load_state_dict(state)
+    # Training checkpoints, or the memory-mapped weights files of export_weights.py.
+    load_into(model, model_path, device)
     model.eval()
-    model.to(device)
 
     return model, model_path
 
@@ -89,13 +171,21 @@ def validate(cfg, args, roi_only=False):
         update_raw = False
         img_norm = False
 
+    # DRIVE is benchmarked inside the field of view, the loader returns its mask as well.
+    fov_only = cfg['data']['dataset'] in ['drive']
+    # With --sparse_tiles, the tiles without any pixel of the FOV / valid mask of the loader are not run.
+    sparse_tiles = getattr(args, 'sparse_tiles', False) and getattr(args, 'tile_size', 0) > 0 and \
+        cfg['data']['dataset'] in ['drive', 'road']
+    loader_kwargs = {'return_mask': True} if fov_only or sparse_tiles else {}
+
     loader = data_loader(
         data_path,
         split=cfg['data']['val_split'],
         is_transform=True,
         img_size=(cfg['data']['img_rows'],
                   cfg['data']['img_cols']),
-        img_norm=img_norm
+        img_norm=img_norm,
+        **loader_kwargs
     )
 
     test_loader = data_loader(
@@ -104,7 +194,8 @@ def validate(cfg, args, roi_only=False):
         split=cfg['data']['test_split'],
         img_size=(cfg['data']['img_rows'],
                   cfg['data']['img_cols']),
-        img_norm=img_norm
+        img_norm=img_norm,
+        **loader_kwargs
     )
 
     # IPython.embed()
@@ -136,6 +227,27 @@ def validate(cfg, args, roi_only=False):
     model, model_path = load_model_and_preprocess(cfg, args, n_classes, device)
     logger.info("Loading model {} from {}".format(cfg['model']['arch'], model_path))
 
+    # Scoring and PNG writes overlap with the forward of the next batch.
+    metrics_worker = MetricsWorker()
+    void_classes = loader.void_classes if roi_only else None
+    logger.info("Test-time augmentations: {}".format(tta_transforms(args)))
+    # Whole images, or overlapping tiles with --tile_size.
+    engine = get_predictor(model, cfg['model']['arch'], args, n_classes)
+    # With --cache_dir, images already seen by this checkpoint with the same flags skip the model.
+    predictor = engine
+    cache = None
+    if getattr(args, 'cache_dir', ''):
+        cache = PredictionCache(args.cache_dir, int(args.cache_size_gb * (1 << 30)))
+        predictor = CachedPredictor(engine, cache, cache_context(model_path, cfg['model'], args, n_classes))
+    # With --crf, every step is refined by the batched mean-field CRF, after the cache which keeps raw outputs.
+    if getattr(args, 'crf', False):
+        predictor = CRFPredictor(predictor, args.crf_iterations, args.crf_radius,
+                                 image_scale=1. if fov_only or not img_norm else 255.)
+    # With --archive, the step masks of the run go to one indexed file instead of one PNG each.
+    archive = None
+    if getattr(args, 'archive', False):
+        archive = PredictionArchiveWriter(result_root(cfg, create=True) + '.psar', n_classes)
+
     with torch.no_grad():
         if cfg['training']['loss']['name'] in ['multi_step_cross_entropy','multi_step_DiceLoss'] and cfg['model']['arch'] not in ['pspnet']:
             for loader_type, myloader in enumerate([testloader]):
@@ -143,157 +255,54 @@ def validate(cfg, args, roi_only=False):
 
                 computation_time = 0
                 img_no = 0
+                fov_metrics = None
                 if args.benchmark and loader_type == 0:
                     continue
                 # For all the images in this loader.
-                for i, (images, labels) in enumerate(myloader):
+                for i, (images, labels, *fov) in enumerate(myloader):
                     if args.benchmark:
                         if i > 100:
                             break
                     start_time = timeit.default_timer()
                     images = images.to(device)
-                    if args.eval_flip:
-                        # Flip images in numpy (not support in tensor)
-                        flipped_images = np.copy(images.data.cpu().numpy()[:, :, :, ::-1])
-                        flipped_images = torch.from_numpy(flipped_images).float().to(device)
-
-                        if cfg['model']['arch'] in ['reclast']:
-                            h0 = torch.ones([images.shape[0], args.hidden_size, images.shape[2], images.shape[3]],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0)
-                            outputs_flipped = model(flipped_images, h0)
-
-                        elif cfg['model']['arch'] in ['recmid']:
-                            W, H = images.shape[2], images.shape[3]
-                            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-                            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-                            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0)
-                            outputs_flipped = model(flipped_images, h0)
-
-                        elif cfg['model']['arch'] in ['dru', 'sru']:
-                            W, H = images.shape[2], images.shape[3]
-                            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-                            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-                            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32, device=device)
-                            s0 = torch.ones([images.shape[0], n_classes, W, H],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0, s0)
-                            outputs_flipped = model(flipped_images, h0, s0)
-
-                        elif cfg['model']['arch'] in ['druvgg16', 'druresnet50', 'druresnet50syncedbn']:
-                            W, H = images.shape[2], images.shape[3]
-                            w, h = int(W / 2 ** 4), int(H / 2 ** 4)
-                            if cfg['model']['arch'] in ['druresnet50', 'druresnet50syncedbn']:
-                                w, h = int(W / 2 ** 5), int(H / 2 ** 5)
-                            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32, device=device)
-                            s0 = torch.zeros([images.shape[0], n_classes, W, H],
-                                             dtype=torch.float32, device=device)
-                            outputs = model(images, h0, s0)
-                            outputs_flipped = model(flipped_images, h0, s0)
-
-                        else:
-                            outputs = model(images)
-                            outputs_flipped = model(flipped_images)
-
-                        outputs_list = [output.data.cpu().numpy() for output in outputs]
-                        outputs_flipped_list = [output_flipped.data.cpu().numpy() for output_flipped in outputs_flipped]
-                        outputs_list = [(outputs + outputs_flipped[:, :, :, ::-1]) / 2.0 for
-                                        outputs, outputs_flipped in zip(outputs_list, outputs_flipped_list)]
-
-                    else:
-                        if cfg['model']['arch'] in ['reclast']:
-                            h0 = torch.ones([images.shape[0], args.hidden_size, images.shape[2], images.shape[3]],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0)
-
-                        elif cfg['model']['arch'] in ['recmid']:
-                            W, H = images.shape[2], images.shape[3]
-                            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-                            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-                            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0)
-
-                        elif cfg['model']['arch'] in ['dru', 'sru']:
-                            W, H = images.shape[2], images.shape[3]
-                            w = int(np.floor(np.floor(np.floor(W / 2) / 2) / 2) / 2)
-                            h = int(np.floor(np.floor(np.floor(H / 2) / 2) / 2) / 2)
-                            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32, device=device)
-                            s0 = torch.ones([images.shape[0], n_classes, W, H],
-                                            dtype=torch.float32, device=device)
-                            outputs = model(images, h0, s0)
-
-                        elif cfg['model']['arch'] in ['druvgg16', 'druresnet50', 'druresnet50syncedbn']:
-                            W, H = images.shape[2], images.shape[3]
-                            w, h = int(W / 2 ** 4), int(H / 2 ** 4)
-                            if cfg['model']['arch'] in ['druresnet50', 'druresnet50syncedbn']:
-                                w, h = int(W / 2 ** 5), int(H / 2 ** 5)
-                            h0 = torch.ones([images.shape[0], args.hidden_size, w, h],
-                                            dtype=torch.float32, device=device)
-                            s0 = torch.zeros([images.shape[0], n_classes, W, H],
-                                             dtype=torch.float32, device=device)
-                            outputs = model(images, h0, s0)
-
-                        else:
-                            outputs = model(images)
-
-                        outputs_list = [output.data.cpu().numpy() for output in outputs]
+                    # Original and augmented copies go through the model as one batch.
+                    outputs = predictor(images, mask=fov[0]) if sparse_tiles else predictor(images)
 
                     # pred = [np.argmax(outputs, axis=1) for outputs in outputs_list]# list,元素数目为rnn的循环次数，每个元素大小为B*W*H
-                    pred = []
-                    for outputs in outputs_list:
-                        outputs[outputs>=0.5]=1
-                        outputs[outputs<0.5]=0
-                        outputs = np.squeeze(outputs,axis=0)
-                        pred.append(outputs)
-
-                    out_path = args.out_path
+                    if running_metrics is None:
+                        running_metrics = [runningScore(n_classes, void=is_void_class)
+                                           if not roi_only else runningScore(n_classes + 1, roi_only)
+                                           for _ in range(len(outputs))]
+                    if fov_only and fov_metrics is None:
+                        fov_metrics = fovScore(len(outputs))
+
+                    # Probability statistics are histogrammed on the device, only the uint8 masks
+                    # of the steps are copied to the host.
+                    if fov_metrics is not None:
+                        fov_metrics.update(step_probabilities(outputs), labels, fov[0])
+                    if update_raw:
+                        running_metrics[-1].update_raw(labels.to(device), outputs[-1], step=len(outputs) - 1)
+                    masks = step_masks(outputs).cpu()
+                    probs = None
+                    if archive is not None and getattr(args, 'archive_probs', False):
+                        probs = (step_probabilities(outputs) * 255).round().to(torch.uint8).cpu()
                     img_name = testloader.dataset.imgfiles[testloader.dataset.split][i]
-                    print(f"Save the output to : {out_path}")
-                    if args.is_recurrent:
-                        for step, output in enumerate(pred):
-                            img_path_target = os.path.join(out_path, img_name + '_step{}.png'.format(step + 1))
-                            output = np.squeeze(output)
-                            # img = np.array(Image.fromarray(myImage).resize((num_px,num_px)))
-                            # output = output.resize((584, 565))
-                            img = np.array(Image.fromarray(output).resize((584, 565)))
-                            # output = misc.imresize(output, (584, 565), "nearest", mode="F")
-                            imwrite(img_path_target, output)
-                    gt = labels.numpy()
-
-                    if roi_only:
-                        """ Process for ROI, basically, mask the Pred based on GT"""
-                        # IPython.embed()
-                        for k in range(len(pred)):
-                            pred[k] = np.where(gt == loader.void_classes, loader.void_classes, pred[k])
+                    metrics_worker.submit(score_recurrent_batch, args, running_metrics, masks, labels, img_name,
+                                          void_classes=void_classes, archive=archive, probs=probs)
 
                     if args.measure_time:
                         elapsed_time = timeit.default_timer() - start_time
                         computation_time += elapsed_time
-                        img_no += pred[-1].shape[0]
+                        img_no += images.shape[0]
                         if (i + 1) % 5 == 0:
                             logger.warning(
                                 "Inference time \
                                   (iter {0:5d}): {1:3.5f} fps".format(
-                                    i + 1, pred[-1].shape[0] / elapsed_time
+                                    i + 1, images.shape[0] / elapsed_time
                                 )
                             )
-                    for k in range(len(pred)):
-                        if running_metrics is None:
-                            running_metrics = []
-                            for _ in range(len(pred)):
-                                running_metrics = running_metrics + [runningScore(n_classes, void=is_void_class)
-                                                                     if not roi_only else runningScore(n_classes + 1, roi_only)]
-                        else:
-                            running_metrics[k].update(gt, pred[k].astype(int), step=k)
-                            if update_raw and k == len(pred) - 1:
-                                running_metrics[k].update_raw(gt, outputs_list[k], step=k)
 
+                metrics_worker.wait()
                 if args.measure_time:
                     logger.warning(f'{computation_time}, {img_no}')
                     logger.warning("Overall Inference time {} fps".format(img_no*1. / computation_time))
@@ -325,55 +334,46 @@ def validate(cfg, args, roi_only=False):
                     # if j == 2:
                     #     p, r, thresh = running_metrics[j].compute_break_even()
                     #     logger.info(f"P/R Break even at {(p + r) / 2}.")
+                if fov_metrics is not None:
+                    log_fov_scores(logger, fov_metrics, results[result_tags[loader_type]])
                 # running_metrics = None
         else:
             for loader_type, myloader in enumerate([valloader, testloader]):
                 start = timeit.default_timer()
                 computation_time = 0
                 img_no = 0
+                fov_metrics = fovScore(1) if fov_only else None
                 if args.benchmark and loader_type == 0:
                     continue
-                for i, (images, labels) in enumerate(myloader):
+                for i, (images, labels, *fov) in enumerate(myloader):
                     if args.benchmark:
                         if i > 100:
                             break
                     start_time = timeit.default_timer()
                     images = images.to(device)
-                    if args.eval_flip:
-                        outputs = model(images)
-                        # Flip images in numpy (not support in tensor)
-                        outputs = outputs.data.cpu().numpy()
-                        flipped_images = np.copy(images.data.cpu().numpy()[:, :, :, ::-1])
-                        flipped_images = torch.from_numpy(flipped_images).float().to(device)
-                        outputs_flipped = model(flipped_images)
-                        outputs_flipped = outputs_flipped.data.cpu().numpy()
-                        outputs = (outputs + outputs_flipped[:, :, :, ::-1]) / 2.0
-                        pred = np.argmax(outputs, axis=1)
-                    else:
-                        outputs = model(images)
-                        outputs = outputs.data.cpu().numpy()
-                        pred = np.argmax(outputs, axis=1)
-
-                    gt = labels.numpy()
-
-                    if roi_only:
-                        pred = np.where(gt == loader.void_classes, loader.void_classes, pred)
+                    outputs = predictor(images, mask=fov[0]) if sparse_tiles else predictor(images)
+
+                    if update_raw:
+                        running_metrics.update_raw(labels.to(device), outputs)
+                    if fov_metrics is not None:
+                        fov_metrics.update(step_probabilities([outputs]), labels, fov[0])
+                    pred = outputs.max(1)[1]
+                    pred = pred.to(torch.uint8) if n_classes < 256 else pred
+                    metrics_worker.submit(score_batch, running_metrics, pred.cpu(), labels, void_classes=void_classes)
 
                     if args.measure_time:
                         elapsed_time = timeit.default_timer() - start_time
                         computation_time += elapsed_time
-                        img_no += pred.shape[0]
+                        img_no += images.shape[0]
                         if (i + 1) % 5 == 0:
                             logging.warning(
                                 "Inference time \
                                   (iter {0:5d}): {1:3.5f} fps".format(
-                                    i + 1, pred.shape[0] / elapsed_time
+                                    i + 1, images.shape[0] / elapsed_time
                                 )
                             )
-                    running_metrics.update(gt, pred)
-                    if update_raw:
-                        running_metrics.update_raw(gt, outputs)
 
+                metrics_worker.wait()
                 if args.measure_time:
                     logging.warning("{computation_time}, {img_no}")
                     logging.warning("Overall Inference time {} fps".format(img_no * 1. / computation_time))
@@ -404,6 +404,23 @@ def validate(cfg, args, roi_only=False):
                     logger.info(wrap_str("f1 class {}: \t".format(i), class_f1[i]))
                     results[result_tags[loader_type]]['f1{}'.format(i)] = class_f1[i]
 
+                if fov_metrics is not None:
+                    fov_results = {}
+                    log_fov_scores(logger, fov_metrics, fov_results)
+                    results[result_tags[loader_type]].update(fov_results[0])
+
+    metrics_worker.close()
+    if archive is not None:
+        archive.close()
+    if sparse_tiles:
+        logger.info("Sparse tiles: {} run, {} skipped outside of the valid pixels".format(
+            engine.n_run, engine.n_skipped))
+    if isinstance(engine, SparseRefiner):
+        logger.info("Sparse refinement: {} of {} tiles refined at the later steps".format(
+            engine.n_refined, engine.n_tiles))
+    if cache is not None:
+        logger.info("Prediction cache: {} hits, {} misses, {} entries, {:.2f} GB".format(
+            cache.hits, cache.misses, len(cache), cache.size() / float(1 << 30)))
     result_path = result_root(cfg, create=True) + '.yml'
     with open(result_path, 'w') as f:
         yaml.dump(results, f,  default_flow_style=False)
@@ -458,6 +475,8 @@ if __name__ == "__main__":
                                   True by default",
     )
     parser.set_defaults(eval_flip=True)
+    parser.add_argument("--tta", nargs="?", type=str, default="",
+                        help="extra test-time augmentations, comma separated among vflip, rot90")
 
     parser.add_argument(
         "--measure_time",
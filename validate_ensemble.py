@@ -0,0 +1,132 @@
+"""
+Score an ensemble of runs in one pass.
+
+The checkpoints of the run folders given to --runs are loaded once, each with
+the steps and hidden size of its own config. Every test image is decoded and
+normalized once, all the members run on the same device batch, their last step
+probabilities are averaged on the device (`ptsemseg/inference/ensemble.py`) and
+the merged masks go to `runningScore` (and the FOV metrics on DRIVE). No
+intermediate file is written.
+
+python validate_ensemble.py --runs=runs/drive/drive-h32-r3/1234,runs/drive/drive-h32-r6/5678 --device=cuda:0
+"""
+import os
+import copy
+import glob
+import logging
+import timeit
+
+import yaml
+import torch
+from torch.utils import data
+
+from ptsemseg.inference import get_predictor
+from ptsemseg.inference.ensemble import EnsemblePredictor
+from ptsemseg.loader import get_loader, get_void_class
+from ptsemseg.metrics import runningScore, fovScore
+from utils import validate_parser
+from validate import load_model_and_preprocess, step_masks, log_fov_scores, wrap_str
+
+logger = logging.getLogger('ptsemseg')
+
+
+def load_run(run_dir):
+    """config of a run folder, with cfg['logdir'] and cfg['training']['resume'] pointing to its best model."""
+    config_paths = glob.glob(os.path.join(run_dir, 'config*')) + glob.glob(os.path.join(run_dir, '*.y*ml'))
+    if not config_paths:
+        raise FileNotFoundError("No config found in {}".format(run_dir))
+    with open(config_paths[0]) as fp:
+        cfg = yaml.load(fp, Loader=yaml.Loader)
+    cfg['logdir'] = run_dir
+    if not os.path.exists(os.path.join(run_dir, cfg['training'].get('resume') or '')):
+        best_paths = glob.glob(os.path.join(run_dir, '*best_model*'))
+        if not best_paths:
+            raise FileNotFoundError("No best model found in {}".format(run_dir))
+        cfg['training']['resume'] = os.path.basename(best_paths[0])
+    return cfg
+
+
+def member_args(args, cfg):
+    """Command line arguments with the steps and hidden size of the member of `cfg`."""
+    margs = copy.copy(args)
+    margs.steps = cfg['model'].get('steps', args.steps)
+    margs.hidden_size = cfg['model'].get('hidden_size', args.hidden_size)
+    margs.model_path = os.path.join(cfg['logdir'], cfg['training']['resume'])
+    return margs
+
+
+if __name__ == "__main__":
+    parser = validate_parser()
+    parser.add_argument("--runs", nargs="?", type=str, default="", help="comma separated run folders")
+    parser.add_argument("--weights", nargs="?", type=str, default="",
+                        help="comma separated weights of the runs, uniform if empty")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    device = torch.device(args.device)
+    cfgs = [load_run(run_dir) for run_dir in args.runs.split(',') if run_dir]
+    data_cfg = cfgs[0]['data']
+    for cfg in cfgs[1:]:
+        for key in ['dataset', 'path', 'img_rows', 'img_cols']:
+            if cfg['data'][key] != data_cfg[key]:
+                raise ValueError("Ensemble members differ in data {}: {} and {}".format(
+                    key, data_cfg[key], cfg['data'][key]))
+
+    # Same input pipeline as validate.py, shared by all the members.
+    dataset = data_cfg['dataset']
+    fov_only = dataset in ['drive']
+    is_void_class = get_void_class(dataset)
+    loader = get_loader(dataset)(
+        data_cfg['path'],
+        split=data_cfg['test_split'],
+        is_transform=True,
+        img_size=(data_cfg['img_rows'], data_cfg['img_cols']),
+        img_norm=dataset not in ['cityscapes'],
+        **({'return_mask': True} if fov_only else {})
+    )
+    testloader = data.DataLoader(loader, batch_size=1, num_workers=8)
+    n_classes = loader.n_classes
+
+    predictors = []
+    for cfg in cfgs:
+        margs = member_args(args, cfg)
+        model, model_path = load_model_and_preprocess(cfg, margs, n_classes, device)
+        logger.info("Member {} ({} steps, hidden size {}) from {}".format(
+            cfg['model']['arch'], margs.steps, margs.hidden_size, model_path))
+        predictors.append(get_predictor(model, cfg['model']['arch'], margs, n_classes))
+    weights = [float(w) for w in args.weights.split(',')] if args.weights else None
+    predictor = EnsemblePredictor(predictors, weights)
+
+    running_metrics = runningScore(n_classes, void=is_void_class)
+    fov_metrics = fovScore(1) if fov_only else None
+    computation_time, img_no = 0., 0
+    with torch.no_grad():
+        for images, labels, *fov in testloader:
+            start_time = timeit.default_timer()
+            images = images.to(device)
+            outputs = predictor(images)
+            labels = labels.to(device)
+            running_metrics.update(labels, step_masks([outputs])[0].long())
+            if fov_metrics is not None:
+                fov_metrics.update(outputs.exp()[:, 1][None], labels, fov[0])
+            computation_time += timeit.default_timer() - start_time
+            img_no += images.shape[0]
+    logger.info("{} images, {} members, {:.2f} fps".format(img_no, len(predictors), img_no / computation_time))
+
+    results = {0: {}}
+    score, class_iou, _ = running_metrics.get_scores()
+    for k, v in score.items():
+        logger.info(wrap_str(k, v))
+        results[0][k] = float(v)
+    for i in range(n_classes - 1 if is_void_class else n_classes):
+        logger.info(wrap_str("iou class {}: \t".format(i), class_iou[i]))
+        results[0]['iou{}'.format(i)] = float(class_iou[i])
+    if fov_metrics is not None:
+        log_fov_scores(logger, fov_metrics, results)
+
+    result_path = args.out_path or os.path.join('results', dataset, 'ensemble.yml')
+    os.makedirs(os.path.dirname(result_path) or '.', exist_ok=True)
+    with open(result_path, 'w') as fp:
+        yaml.dump({'runs': args.runs.split(','), 'test': results}, fp, default_flow_style=False)
+    logger.info("Results written to {}".format(result_path))